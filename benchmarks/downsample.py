@@ -0,0 +1,116 @@
+"""Times downsample_array() on an in-memory array and on contiguous,
+chunked and gzip-compressed h5 datasets of the same movie.
+
+The input is a reproducible random uint16 movie. For h5 datasets, every
+strategy is also timed reading each bin's block once and reducing or
+selecting from it in memory, the alternative to the per-frame reads of
+the single-frame strategies.
+
+Example
+-------
+With slapp installed (pip install -e .):
+
+    python benchmarks/downsample.py --frames 1240 --height 512 \\
+        --width 512 --repeat 3
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable
+
+import h5py
+import numpy as np
+
+from slapp.transforms.array_utils import (
+        downsample_array, downsample_bin_edges)
+
+
+def best_time(function: Callable, repeat: int) -> float:
+    """the shortest wall time of repeat calls of function, in seconds"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def per_bin_reads(dataset: h5py.Dataset, input_fps: int, output_fps: int,
+                  strategy: str, random_seed: int = 0) -> np.ndarray:
+    """downsampling which reads each bin's block once"""
+    bin_edges = downsample_bin_edges(dataset.shape[0], input_fps, output_fps)
+    bin_sizes = np.diff(bin_edges)
+    rng = np.random.default_rng(random_seed)
+    array_out = np.zeros((len(bin_sizes), *dataset.shape[1:]))
+    for i in range(len(bin_sizes)):
+        block = dataset[bin_edges[i]:bin_edges[i + 1]]
+        if strategy == 'average':
+            array_out[i] = block.mean(axis=0)
+        elif strategy == 'first':
+            array_out[i] = block[0]
+        elif strategy == 'last':
+            array_out[i] = block[-1]
+        else:
+            array_out[i] = block[rng.integers(0, bin_sizes[i])]
+    return array_out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--frames", type=int, default=1240)
+    parser.add_argument("--height", type=int, default=512)
+    parser.add_argument("--width", type=int, default=512)
+    parser.add_argument("--input-fps", type=int, default=31)
+    parser.add_argument("--output-fps", type=int, default=4)
+    parser.add_argument("--chunk-frames", type=int, default=32,
+                        help="frames per HDF5 chunk of the chunked datasets")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    movie = rng.integers(0, 2**12, size=(args.frames, args.height,
+                                         args.width), dtype='uint16')
+    layouts = {
+            'contiguous': {},
+            'chunked': {'chunks': (args.chunk_frames, args.height,
+                                   args.width)},
+            'gzip': {'chunks': (args.chunk_frames, args.height, args.width),
+                     'compression': 'gzip'}}
+
+    print(f"{args.frames} frames of {args.height}x{args.width}, "
+          f"{args.input_fps}Hz -> {args.output_fps}Hz, "
+          f"best of {args.repeat}")
+    print(f"{'strategy':10}{'source':12}{'float64':>10}{'float32':>10}"
+          f"{'per bin':>10}")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        h5_path = Path(tmpdir) / "movie.h5"
+        with h5py.File(h5_path, "w") as f:
+            for name, kwargs in layouts.items():
+                f.create_dataset(name, data=movie, **kwargs)
+
+        with h5py.File(h5_path, "r") as f:
+            sources = {'ndarray': movie,
+                       **{name: f[name] for name in layouts}}
+            for strategy in ['average', 'first', 'last', 'random']:
+                for name, source in sources.items():
+                    times = [best_time(
+                        lambda: downsample_array(
+                            source, args.input_fps, args.output_fps,
+                            strategy, args.seed, dtype),
+                        args.repeat) for dtype in ['float64', 'float32']]
+                    row = f"{strategy:10}{name:12}" + \
+                        "".join(f"{t:>9.2f}s" for t in times)
+                    if name != 'ndarray':
+                        t = best_time(
+                            lambda: per_bin_reads(
+                                source, args.input_fps, args.output_fps,
+                                strategy, args.seed),
+                            args.repeat)
+                        row += f"{t:>9.2f}s"
+                    print(row)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,8 +3,11 @@
 # labeling effort.
 import slapp.utils.query_utils as qu
 import argschema
+import contextlib
 import h5py
+import marshmallow as mm
 import pathlib
+from typing import Optional
 from slapp.data_selection.utils import find_full_movie
 
 
@@ -23,6 +26,13 @@ class SegmentationManifestSchema(argschema.ArgSchema):
                      "binning. `nbinned` parameter for Suite2P will "
                      "be determined by nframes/bin_size on a per-"
                      "experiment basis."))
+    db_pool_size = argschema.fields.Int(
+        required=False,
+        default=1,
+        validator=mm.validate.Range(min=0),
+        description=("number of connections to each database opened by "
+                     "this run and reused for its queries. 0 opens a new "
+                     "connection per query."))
 
 
 class ManifestEntrySchema(argschema.ArgSchema):
@@ -40,7 +50,27 @@ class SegmentationManifest(argschema.ArgSchemaParser):
     default_schema = SegmentationManifestSchema
     default_output_schema = SegmentationManifestOutputSchema
 
-    def run(self, lims_dbconn, label_dbconn):
+    def run(self, lims_dbconn: Optional[qu.DbConnection] = None,
+            label_dbconn: Optional[qu.DbConnection] = None):
+        """write the segmentation manifest of the selected experiments.
+        Connections which are not provided are opened from the LIMS_ and
+        LABELING_ environment credentials, and closed at the end of the
+        run."""
+        with contextlib.ExitStack() as stack:
+            if lims_dbconn is None:
+                lims_dbconn = stack.enter_context(qu.DbConnection(
+                    **qu.get_db_credentials(env_prefix="LIMS_",
+                                            **qu.lims_defaults),
+                    pool_size=self.args['db_pool_size']))
+            if label_dbconn is None:
+                label_dbconn = stack.enter_context(qu.DbConnection(
+                    **qu.get_db_credentials(env_prefix="LABELING_",
+                                            **qu.label_defaults),
+                    pool_size=self.args['db_pool_size']))
+            self._run(lims_dbconn, label_dbconn)
+
+    def _run(self, lims_dbconn: qu.DbConnection,
+             label_dbconn: qu.DbConnection):
         self.logger.name = type(self).__name__
 
         # from labeling database, find the experiment ids we want
@@ -92,14 +122,5 @@ class SegmentationManifest(argschema.ArgSchemaParser):
 
 
 if __name__ == "__main__":  # pragma: no cover
-    lims_credentials = qu.get_db_credentials(
-            env_prefix="LIMS_",
-            **qu.lims_defaults)
-    lims_connection = qu.DbConnection(**lims_credentials)
-    label_credentials = qu.get_db_credentials(
-            env_prefix="LABELING_",
-            **qu.label_defaults)
-    label_connection = qu.DbConnection(**label_credentials)
-
     sm = SegmentationManifest()
-    sm.run(lims_connection, label_connection)
+    sm.run()
@@ -1,9 +1,11 @@
 import slapp.utils.query_utils as qu
 import base64
+import contextlib
 import os
 import argschema
 import marshmallow as mm
 import numpy as np
+from typing import Optional
 
 
 insert_statement_template = (
@@ -34,6 +36,13 @@ class DataSelectorSchema(argschema.ArgSchema):
         required=False,
         default="",
         description="logged in postgres entry as comment_string")
+    db_pool_size = argschema.fields.Int(
+        required=False,
+        default=1,
+        validator=mm.validate.Range(min=0),
+        description=("number of connections to each database opened by "
+                     "this run and reused for its queries. 0 opens a new "
+                     "connection per query."))
 
     @mm.post_load
     def check_lengths(self, data, **kwargs):
@@ -49,14 +58,34 @@ class DataSelectorSchema(argschema.ArgSchema):
 class DataSelector(argschema.ArgSchemaParser):
     default_schema = DataSelectorSchema
 
-    def run(self, lims_dbconn, label_dbconn):
+    def run(self, lims_dbconn: Optional[qu.DbConnection] = None,
+            label_dbconn: Optional[qu.DbConnection] = None):
+        """select the experiments, and record the selection in the
+        labeling database. Connections which are not provided are opened
+        from the LIMS_ and LABELING_ environment credentials, and closed
+        at the end of the run."""
+        with contextlib.ExitStack() as stack:
+            if lims_dbconn is None:
+                lims_dbconn = stack.enter_context(qu.DbConnection(
+                    **qu.get_db_credentials(env_prefix="LIMS_",
+                                            **qu.lims_defaults),
+                    pool_size=self.args['db_pool_size']))
+            if label_dbconn is None:
+                label_dbconn = stack.enter_context(qu.DbConnection(
+                    **qu.get_db_credentials(env_prefix="LABELING_",
+                                            **qu.label_defaults),
+                    pool_size=self.args['db_pool_size']))
+            self._run(lims_dbconn, label_dbconn)
+
+    def _run(self, lims_dbconn: qu.DbConnection,
+             label_dbconn: qu.DbConnection):
         self.logger.name = type(self).__name__
 
         experiment_ids = []
         b64_queries = []
         for qstring in self.args['query_strings']:
             experiment_ids.append(
-                    [i['exp_id'] for i in lims_dbconn.query(qstring)])
+                    [i['exp_id'] for i in lims_dbconn.iter_query(qstring)])
             self.logger.info(
                     f"{qstring}\n returned {len(experiment_ids[-1])} ids")
             b64_queries.append(
@@ -97,15 +126,6 @@ class DataSelector(argschema.ArgSchemaParser):
 
 
 if __name__ == "__main__":  # pragma: no cover
-    lims_credentials = qu.get_db_credentials(
-            env_prefix="LIMS_",
-            **qu.lims_defaults)
-    lims_connection = qu.DbConnection(**lims_credentials)
-    label_credentials = qu.get_db_credentials(
-            env_prefix="LABELING_",
-            **qu.label_defaults)
-    label_connection = qu.DbConnection(**label_credentials)
-
     query_string_template = (
             "SELECT oe.id AS exp_id "
             "FROM ophys_experiments as oe "
@@ -122,4 +142,4 @@ if __name__ == "__main__":  # pragma: no cover
         }
 
     selector = DataSelector(input_data=args)
-    selector.run(lims_connection, label_connection)
+    selector.run()
@@ -1,11 +1,11 @@
-from typing import List, Tuple, Union, Optional
+from typing import Iterable, List, Tuple, Union, Optional
 from scipy.sparse import coo_matrix
 import numpy as np
 import cv2
 
 import slapp.utils.query_utils as query_utils
 from slapp.transforms.array_utils import (
-        center_pad_2d, crop_2d_array)
+        center_pad_2d, content_boundaries, crop_2d_array)
 import imgaug.augmenters as iaa
 
 
@@ -125,8 +125,11 @@ class ROI:
         experiment_id: the unique id for the segmentation run
         roi_id: the unique id for the ROI in the segmentation run
         _sparse_coo: the sparse matrix containing the probability mask
-        for the ROI
+        for the ROI. Built from the coordinate arrays on first use.
     """
+    __slots__ = ('image_shape', 'experiment_id', 'roi_id', 'trace',
+                 'is_binary', '_coo_rows', '_coo_cols', '_coo_data',
+                 '_coo', '_stamp')
 
     def __init__(self,
                  coo_rows: Union[np.array, List[int]],
@@ -140,10 +143,21 @@ class ROI:
         self.image_shape = image_shape
         self.experiment_id = experiment_id
         self.roi_id = roi_id
-        self._sparse_coo = coo_matrix((coo_data, (coo_rows, coo_cols)),
-                                      shape=image_shape)
+        self._coo_rows = coo_rows
+        self._coo_cols = coo_cols
+        self._coo_data = coo_data
+        self._coo = None
         self.trace = trace
         self.is_binary = is_binary
+        self._stamp = None
+
+    @property
+    def _sparse_coo(self) -> coo_matrix:
+        if self._coo is None:
+            self._coo = coo_matrix(
+                    (self._coo_data, (self._coo_rows, self._coo_cols)),
+                    shape=self.image_shape)
+        return self._coo
 
     @classmethod
     def roi_from_query(cls, roi_id: int,
@@ -163,15 +177,116 @@ class ROI:
             ("SELECT * FROM segmentation_runs WHERE "
              f"id={roi['segmentation_run_id']}"))[0]
 
-        return ROI(coo_rows=roi['coo_row'],
+        return cls._from_records(roi, segmentation_run)
+
+    @classmethod
+    def rois_from_segmentation_run(
+            cls, segmentation_run_id: int,
+            db_conn: query_utils.DbConnection,
+            segmentation_run: Optional[dict] = None) -> List["ROI"]:
+        """
+        Builds all the ROI objects of a segmentation run with one query
+        of the rois table, rather than 2 queries per ROI with
+        roi_from_query().
+        Args:
+            segmentation_run_id: Unique Id of the segmentation run
+            db_conn: connection to the labeling database
+            segmentation_run: the segmentation_runs row for this id, if
+                the caller already has it. Otherwise it is queried.
+
+        Returns: list of ROI objects, ordered by roi id
+        """
+        segmentation_run, rois = cls._segmentation_run_records(
+                segmentation_run_id, db_conn, segmentation_run)
+        return [cls._from_records(roi, segmentation_run) for roi in rois]
+
+    @staticmethod
+    def _segmentation_run_records(
+            segmentation_run_id: int,
+            db_conn: query_utils.DbConnection,
+            segmentation_run: Optional[dict] = None
+            ) -> Tuple[dict, Iterable[dict]]:
+        """the segmentation_runs row, queried if not provided, and an
+        iterator over the rois rows of a segmentation run, ordered by id"""
+        if segmentation_run is None:
+            segmentation_run = db_conn.query(
+                ("SELECT * FROM segmentation_runs WHERE "
+                 f"id={segmentation_run_id}"))[0]
+
+        # rows are fetched in batches, so the raw records of all ROIs are
+        # not held in memory next to the ROI objects
+        rois = db_conn.iter_query(
+            ("SELECT id, coo_row, coo_col, coo_data, trace FROM rois "
+             f"WHERE segmentation_run_id={segmentation_run_id} "
+             "ORDER BY id"))
+        return segmentation_run, rois
+
+    @classmethod
+    def _from_records(cls, roi: dict, segmentation_run: dict) -> "ROI":
+        """ROI object from a rois row and its segmentation_runs row"""
+        return cls(coo_rows=roi['coo_row'],
                    coo_cols=roi['coo_col'],
                    coo_data=roi['coo_data'],
                    image_shape=segmentation_run['video_shape'],
                    experiment_id=segmentation_run['ophys_experiment_id'],
-                   roi_id=roi_id,
+                   roi_id=roi['id'],
                    trace=roi['trace']
                    )
 
+    def _local_stamp(
+            self, margin: int = 0) -> Tuple[np.ndarray, Tuple[int, int]]:
+        """dense representation of the bounding box of the ROI, rather
+        than of the full frame. The unpadded stamp is built once from the
+        sparse matrix and reused.
+
+        Parameters
+        ----------
+        margin: int
+            number of pixels added on each side of the bounding box,
+            clipped to the frame
+
+        Returns
+        -------
+        stamp: numpy.ndarray
+            2D dense representation of the (padded) bounding box
+        origin: tuple(int, int)
+            full-frame (row, col) of stamp[0, 0]
+
+        """
+        if self._stamp is None:
+            coo = self._sparse_coo
+            if coo.nnz == 0:
+                top = left = 0
+                stamp = np.zeros((0, 0), dtype=coo.dtype)
+            else:
+                top, left = coo.row.min(), coo.col.min()
+                stamp = np.zeros((coo.row.max() - top + 1,
+                                  coo.col.max() - left + 1),
+                                 dtype=coo.dtype)
+                # duplicate entries are summed, as in coo_matrix.toarray()
+                np.add.at(stamp, (coo.row - top, coo.col - left), coo.data)
+            self._stamp = (stamp, (int(top), int(left)))
+
+        stamp, (top, left) = self._stamp
+        if margin == 0:
+            return stamp, (top, left)
+
+        height, width = self._sparse_coo.shape
+        pad_top = min(margin, top)
+        pad_left = min(margin, left)
+        pad_bot = max(0, min(margin, height - top - stamp.shape[0]))
+        pad_right = max(0, min(margin, width - left - stamp.shape[1]))
+        stamp = np.pad(stamp, ((pad_top, pad_bot), (pad_left, pad_right)))
+        return stamp, (top - pad_top, left - pad_left)
+
+    def _place_in_frame(
+            self, stamp: np.ndarray, origin: Tuple[int, int]) -> np.ndarray:
+        """full-frame array with stamp placed at origin"""
+        frame = np.zeros(self._sparse_coo.shape, dtype=stamp.dtype)
+        frame[origin[0]:(origin[0] + stamp.shape[0]),
+              origin[1]:(origin[1] + stamp.shape[1])] = stamp
+        return frame
+
     def generate_ROI_mask(
             self, shape: Tuple[int, int] = None, full: bool = False):
         """return a 2D dense representation of the mask
@@ -189,7 +304,12 @@ class ROI:
             2D dense representation of the mask
 
         """
-        mask = sized_mask(self._sparse_coo.toarray(), shape=shape, full=full)
+        stamp, origin = self._local_stamp()
+        if full:
+            mask = self._place_in_frame(stamp, origin)
+        else:
+            # copied, so callers can not modify the cached stamp
+            mask = sized_mask(stamp.copy(), shape=shape)
 
         return mask
 
@@ -226,11 +346,45 @@ class ROI:
             uint8 2D dense representation of the mask outline.
 
         """
+        mask, origin = self._outline_stamp(
+                absolute_threshold=absolute_threshold,
+                quantile=quantile,
+                dilation_kernel_size=dilation_kernel_size,
+                inner_outline=inner_outline)
+
+        if full:
+            mask = self._place_in_frame(mask, origin)
+        else:
+            mask = sized_mask(mask, shape=shape)
+
+        # convert to 0 outline on 255 background
+        mask = 255 * (1 - mask)
+
+        return mask
+
+    def _outline_stamp(
+            self, absolute_threshold: float = None, quantile: float = 0.1,
+            dilation_kernel_size: int = 1, inner_outline: bool = True
+            ) -> Tuple[np.ndarray, Tuple[int, int]]:
+        """the outline (1) of the ROI in its local stamp, see
+        generate_ROI_outline() for the parameters
+
+        Returns
+        -------
+        mask: numpy.ndarray
+            uint8 outline, 1 on 0
+        origin: tuple(int, int)
+            full-frame (row, col) of mask[0, 0]
+
+        """
+        # the outline and its dilation can reach past the bounding box
+        # of the ROI, by at most the kernel size
+        stamp, origin = self._local_stamp(margin=dilation_kernel_size + 1)
         if self.is_binary:
-            binary = self._sparse_coo.toarray()
+            binary = stamp
         else:
             binary = binary_mask_from_threshold(
-                self._sparse_coo,
+                stamp,
                 absolute_threshold=absolute_threshold,
                 quantile=quantile)
 
@@ -250,9 +404,246 @@ class ROI:
         if inner_outline:
             mask = mask & binary
 
-        mask = sized_mask(mask, shape=shape, full=full)
+        return mask, origin
 
-        # convert to 0 outline on 255 background
-        mask = 255 * (1 - mask)
+    def generate_full_outline(
+            self, template: np.ndarray,
+            absolute_threshold: float = None,
+            quantile: float = 0.1,
+            dilation_kernel_size: int = 1, inner_outline: bool = True
+            ) -> np.ndarray:
+        """the full-frame outline drawn onto a template, for example a
+        white frame with a scale bar rendered once per experiment. Only
+        the neighbourhood of the ROI is computed; the rest of the frame
+        is a copy of the template.
 
-        return mask
+        With a template of 255 with black annotations, the result equals
+        annotating generate_ROI_outline(full=True) the same way.
+
+        Parameters
+        ----------
+        template: numpy.ndarray
+            uint8 full-frame image onto which the outline is drawn (0)
+        absolute_threshold, quantile, dilation_kernel_size, inner_outline:
+            see generate_ROI_outline()
+
+        Returns
+        -------
+        outline: numpy.ndarray
+            uint8 full-frame outline
+
+        """
+        mask, origin = self._outline_stamp(
+                absolute_threshold=absolute_threshold,
+                quantile=quantile,
+                dilation_kernel_size=dilation_kernel_size,
+                inner_outline=inner_outline)
+        outline = template.copy()
+        window = outline[origin[0]:(origin[0] + mask.shape[0]),
+                         origin[1]:(origin[1] + mask.shape[1])]
+        window[mask.astype(bool)] = 0
+        return outline
+
+
+class ROISet:
+    """All the ROIs of an experiment, stored as concatenated arrays
+    instead of one sparse matrix per ROI. The pixels of ROI i are
+    rows[offsets[i]:offsets[i + 1]], and likewise for cols and data.
+    Indexing or iterating gives ROI objects whose coordinates are views
+    into these arrays.
+
+    Parameters
+    ----------
+    offsets: numpy.ndarray
+        N + 1 increasing indices into rows, cols and data, starting at 0
+    rows: numpy.ndarray
+        full-frame row of each pixel
+    cols: numpy.ndarray
+        full-frame column of each pixel
+    data: numpy.ndarray
+        value of each pixel
+    image_shape: tuple(int, int)
+        the shape of the image the ROIs are contained within
+    experiment_ids: numpy.ndarray
+        experiment id of each ROI
+    roi_ids: numpy.ndarray
+        id of each ROI
+    traces: numpy.ndarray
+        (N, ntime) traces of the ROIs, or None
+    is_binary: bool
+        whether the ROIs are binary masks
+
+    """
+
+    def __init__(self,
+                 offsets: np.ndarray,
+                 rows: np.ndarray,
+                 cols: np.ndarray,
+                 data: np.ndarray,
+                 image_shape: Tuple[int, int],
+                 experiment_ids: np.ndarray,
+                 roi_ids: np.ndarray,
+                 traces: Optional[np.ndarray] = None,
+                 is_binary: bool = False):
+        self.offsets = np.asarray(offsets, dtype=int)
+        self.rows = np.asarray(rows)
+        self.cols = np.asarray(cols)
+        self.data = np.asarray(data)
+        self.image_shape = image_shape
+        self.experiment_ids = np.asarray(experiment_ids)
+        self.roi_ids = np.asarray(roi_ids)
+        self.traces = traces
+        self.is_binary = is_binary
+        if len(self.offsets) != len(self.roi_ids) + 1:
+            raise ValueError(f"{len(self.offsets)} offsets do not match "
+                             f"{len(self.roi_ids)} ROIs")
+        if (self.traces is not None) and \
+                (len(self.traces) != len(self.roi_ids)):
+            raise ValueError(f"{len(self.traces)} traces do not match "
+                             f"{len(self.roi_ids)} ROIs")
+
+    @classmethod
+    def from_coo_matrices(cls,
+                          coos: List[coo_matrix],
+                          image_shape: Tuple[int, int],
+                          experiment_ids: Union[np.ndarray, List[int]],
+                          roi_ids: Union[np.ndarray, List[int]],
+                          traces: Optional[np.ndarray] = None,
+                          is_binary: bool = False) -> "ROISet":
+        """ROISet from one coo_matrix per ROI, in full-frame coordinates"""
+        offsets = np.zeros(len(coos) + 1, dtype=int)
+        offsets[1:] = np.cumsum([c.nnz for c in coos])
+        # np.concatenate() needs at least one array
+        coos = coos if len(coos) else [coo_matrix((0, 0))]
+        return cls(offsets=offsets,
+                   rows=np.concatenate([c.row for c in coos]),
+                   cols=np.concatenate([c.col for c in coos]),
+                   data=np.concatenate([c.data for c in coos]),
+                   image_shape=image_shape,
+                   experiment_ids=experiment_ids,
+                   roi_ids=roi_ids,
+                   traces=traces,
+                   is_binary=is_binary)
+
+    @classmethod
+    def from_rois(cls, rois: List[ROI]) -> "ROISet":
+        """ROISet from a list of ROI objects of the same frame shape"""
+        if len(rois) == 0:
+            raise ValueError("can not make an ROISet from no ROIs")
+        traces = None
+        if all(roi.trace is not None for roi in rois):
+            traces = np.array([roi.trace for roi in rois])
+        return cls.from_coo_matrices(
+                [roi._sparse_coo for roi in rois],
+                image_shape=rois[0].image_shape,
+                experiment_ids=[roi.experiment_id for roi in rois],
+                roi_ids=[roi.roi_id for roi in rois],
+                traces=traces,
+                is_binary=all(roi.is_binary for roi in rois))
+
+    @classmethod
+    def from_segmentation_run(
+            cls, segmentation_run_id: int,
+            db_conn: query_utils.DbConnection,
+            segmentation_run: Optional[dict] = None) -> "ROISet":
+        """ROISet of all the ROIs of a segmentation run, from one query of
+        the rois table, as ROI.rois_from_segmentation_run(), without an
+        ROI object per ROI. The ROIs are ordered by roi id."""
+        segmentation_run, records = ROI._segmentation_run_records(
+                segmentation_run_id, db_conn, segmentation_run)
+        offsets = [0]
+        rows, cols, data, roi_ids, traces = [], [], [], [], []
+        for record in records:
+            offsets.append(offsets[-1] + len(record['coo_row']))
+            rows.extend(record['coo_row'])
+            cols.extend(record['coo_col'])
+            data.extend(record['coo_data'])
+            roi_ids.append(record['id'])
+            traces.append(record['trace'])
+        if any(trace is None for trace in traces):
+            traces = None
+        return cls(offsets=offsets,
+                   rows=np.array(rows, dtype=int),
+                   cols=np.array(cols, dtype=int),
+                   data=np.array(data, dtype=float),
+                   image_shape=segmentation_run['video_shape'],
+                   experiment_ids=np.full(
+                       len(roi_ids), segmentation_run['ophys_experiment_id']),
+                   roi_ids=np.array(roi_ids, dtype=int),
+                   traces=None if traces is None else np.array(traces))
+
+    def __len__(self) -> int:
+        return len(self.roi_ids)
+
+    def __getitem__(self, i: int) -> ROI:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f"ROI index {i} out of range for "
+                             f"{len(self)} ROIs")
+        start, stop = self.offsets[i], self.offsets[i + 1]
+        return ROI(coo_rows=self.rows[start:stop],
+                   coo_cols=self.cols[start:stop],
+                   coo_data=self.data[start:stop],
+                   image_shape=self.image_shape,
+                   experiment_id=self.experiment_ids[i].item(),
+                   roi_id=self.roi_ids[i].item(),
+                   trace=None if self.traces is None else self.traces[i],
+                   is_binary=self.is_binary)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def _roi_index(self) -> np.ndarray:
+        """the index of the ROI of each pixel"""
+        return np.repeat(np.arange(len(self)), np.diff(self.offsets))
+
+    def areas(self) -> np.ndarray:
+        """number of nonzero pixels of each ROI"""
+        return np.bincount(self._roi_index(), weights=self.data != 0,
+                           minlength=len(self)).astype(int)
+
+    def bounds(self) -> np.ndarray:
+        """bounding boxes of the ROIs
+
+        Returns
+        -------
+        bounds: numpy.ndarray
+            (N, 4) array of [top, bot, left, right] for each ROI, with the
+            same convention as array_utils.content_boundary_2d(): bot and
+            right are the maximum index + 1. ROIs without pixels are
+            [0, 0, 0, 0].
+
+        """
+        return content_boundaries(self.offsets, self.rows, self.cols)
+
+    def masks(self, shape: Tuple[int, int]) -> np.ndarray:
+        """dense masks of all ROIs, each centered in a window of fixed shape
+
+        Parameters
+        ----------
+        shape: tuple(int, int)
+            [h, w] of the window around each ROI. The bounding box of an
+            ROI is centered with array_utils.center_pad_2d() conventions.
+            Pixels of ROIs larger than the window are cropped.
+
+        Returns
+        -------
+        masks: numpy.ndarray
+            (N, h, w) masks
+
+        """
+        bounds = self.bounds()
+        top = (shape[0] - (bounds[:, 1] - bounds[:, 0])) // 2 - bounds[:, 0]
+        left = (shape[1] - (bounds[:, 3] - bounds[:, 2])) // 2 - bounds[:, 2]
+        index = self._roi_index()
+        rows = self.rows + top[index]
+        cols = self.cols + left[index]
+        inside = (rows >= 0) & (rows < shape[0]) & \
+            (cols >= 0) & (cols < shape[1])
+        masks = np.zeros((len(self), *shape), dtype=self.data.dtype)
+        # duplicate entries are summed, as in coo_matrix.toarray()
+        np.add.at(masks, (index[inside], rows[inside], cols[inside]),
+                  self.data[inside])
+        return masks
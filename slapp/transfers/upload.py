@@ -1,15 +1,38 @@
 import argschema
+import contextlib
 import datetime
 import slapp.transfers.utils as utils
 import slapp.utils.query_utils as query_utils
 import numpy as np
 import pathlib
+import re
 import jsonlines
 from multiprocessing.pool import ThreadPool
 from functools import partial
+from typing import Optional, Tuple
 import marshmallow as mm
 
 
+# references to a tile of an atlas sheet, <sheet>#xywh=<x>,<y>,<w>,<h>,
+# and to an entry of a roi_artifacts.h5 file, <file>.h5#<kind>/<index>
+_packed_refs = [
+        re.compile(r"(?P<path>.+)#(?P<fragment>xywh=\d+,\d+,\d+,\d+)"),
+        re.compile(r"(?P<path>.+\.h5)#(?P<fragment>\w+/\d+)")]
+
+
+def split_packed_ref(value) -> Optional[Tuple[str, str]]:
+    """(file path, fragment) of a reference to a tile of an atlas sheet
+    or to an entry of a roi_artifacts.h5 file. None for any other value,
+    including file paths which contain '#'."""
+    if not isinstance(value, str):
+        return None
+    for pattern in _packed_refs:
+        match = pattern.fullmatch(value)
+        if match is not None:
+            return match['path'], match['fragment']
+    return None
+
+
 class UploadSchema(argschema.ArgSchema):
     roi_manifests_ids = argschema.fields.List(
         argschema.fields.Int,
@@ -54,6 +77,13 @@ class UploadSchema(argschema.ArgSchema):
         description=("file to be written to S3 as overall manifest, "
                      "saved locally. If path not provided, will default "
                      "to <timestamp>_s3_manifest.jsonl in output_json dir"))
+    db_pool_size = argschema.fields.Int(
+        required=False,
+        default=1,
+        validator=mm.validate.Range(min=0),
+        description=("number of connections to each database opened by "
+                     "this run and reused for its queries. 0 opens a new "
+                     "connection per query."))
 
     @mm.pre_load
     def set_local_manifest_path(self, data, **kwargs):
@@ -86,7 +116,21 @@ class LabelDataUploader(argschema.ArgSchemaParser):
     default_schema = UploadSchema
     default_output_schema = UploadOutputSchema
 
-    def run(self, db_conn: query_utils.DbConnection):
+    def run(self, db_conn: Optional[query_utils.DbConnection] = None):
+        """upload the artifacts and manifests. If the manifests are read
+        from the database and db_conn is not provided, a connection is
+        opened from the LABELING_ environment credentials, and closed at
+        the end of the run."""
+        with contextlib.ExitStack() as stack:
+            if (db_conn is None) & bool(self.args["roi_manifests_ids"]):
+                db_conn = stack.enter_context(query_utils.DbConnection(
+                    **query_utils.get_db_credentials(
+                        env_prefix="LABELING_",
+                        **query_utils.label_defaults),
+                    pool_size=self.args['db_pool_size']))
+            self._run(db_conn)
+
+    def _run(self, db_conn: Optional[query_utils.DbConnection]):
         self.logger.name = type(self).__name__
 
         # unique timestamp for this invocation
@@ -168,24 +212,60 @@ class LabelDataUploader(argschema.ArgSchemaParser):
                           for e, r in zip(experiment_ids, results)}
         upload_responses.extend([r for r in results])
 
+        # find unique atlas sheets and roi_artifacts.h5 files. The
+        # references are found per manifest, as manifests of png, atlas
+        # and hdf5 runs, with different keys, can be uploaded together.
+        refs = []
+        for m in manifests:
+            split = {k: split_packed_ref(v) for k, v in m.items()}
+            refs.append({k: v for k, v in split.items() if v is not None})
+        sheets = {}
+        for m, manifest_refs in zip(manifests, refs):
+            for sheet_path, _ in manifest_refs.values():
+                sheets[sheet_path] = m['experiment-id']
+        self.logger.info(f"{len(sheets)} atlas sheets and h5 files to "
+                         "upload")
+        s3_sheets = {}
+        if sheets:
+            args = [{'file_name': sheet_path,
+                     'bucket': self.args['s3_bucket_name'],
+                     'key': (prefix + "/" + f"{eid}_" +
+                             pathlib.PurePath(sheet_path).name)}
+                    for sheet_path, eid in sheets.items()]
+            chunked_args = [
+                    (
+                        utils.ConfiguredUploadClient(
+                            **self.args['client_config']),
+                        i.tolist())
+                    for i in np.array_split(args,
+                                            self.args['parallelization'])]
+            with ThreadPool(self.args['parallelization']) as pool:
+                results = pool.starmap(utils.upload_files, chunked_args)
+            results = [i for r in results for i in r]
+            s3_sheets = {sheet_path: utils.s3_uri(r['bucket'], r['key'])
+                         for sheet_path, r in zip(sheets, results)}
+            upload_responses.extend([r for r in results])
+
         # upload the per-ROI manifests
         s3_manifests = []
         upload_partial = partial(
                 utils.upload_manifest_contents,
-                utils.ConfiguredUploadClient(**self.args['client_config']),
-                skip_keys=['full-video-source-ref'])
+                utils.ConfiguredUploadClient(**self.args['client_config']))
         args = []
-        for manifest in manifests:
-            args.append((manifest, self.args['s3_bucket_name'], prefix))
+        for manifest, manifest_refs in zip(manifests, refs):
+            args.append((manifest, self.args['s3_bucket_name'], prefix,
+                         ['full-video-source-ref'] + list(manifest_refs)))
         with ThreadPool(self.args['parallelization']) as pool:
             results = pool.starmap(upload_partial, args)
         s3_manifests, responses = list(zip(*results))
         for r in responses:
             upload_responses.extend(r)
 
-        for s3_manifest in s3_manifests:
+        for s3_manifest, manifest_refs in zip(s3_manifests, refs):
             s3_manifest['full-video-source-ref'] = \
                     s3_full_videos[s3_manifest['experiment-id']]
+            for k, (sheet_path, fragment) in manifest_refs.items():
+                s3_manifest[k] = s3_sheets[sheet_path] + "#" + fragment
 
         # upload the manifest
         utils.manifest_file_from_jsons(
@@ -239,10 +319,5 @@ class LabelDataUploader(argschema.ArgSchemaParser):
 
 
 if __name__ == "__main__":  # pragma: no cover
-    db_credentials = query_utils.get_db_credentials(
-            env_prefix="LABELING_",
-            **query_utils.label_defaults)
-    db_connection = query_utils.DbConnection(**db_credentials)
-
     ldu = LabelDataUploader()
-    ldu.run(db_connection)
+    ldu.run()
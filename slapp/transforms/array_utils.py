@@ -1,6 +1,6 @@
 import math
 import logging
-from typing import Tuple, Type, Union
+from typing import Generator, Iterable, Tuple, Type, Union
 import numpy as np
 from scipy.sparse import coo_matrix
 import h5py
@@ -72,52 +72,210 @@ def content_extents(
         to be passed into numpy.pad as pad_width
 
     """
-    boundaries = content_boundary_2d(arr)
-    height = boundaries[1] - boundaries[0]
-    width = boundaries[3] - boundaries[2]
+    boundaries = np.array([content_boundary_2d(arr)])
+    indexing_bounds, pad_width = batch_content_extents(
+            boundaries, shape, target_shape)
 
-    vertical_pad = shape[0] - height
-    horizontal_pad = shape[1] - width
+    indexing_bounds = tuple(indexing_bounds[0].tolist())
+    pad_width = tuple([tuple(i) for i in pad_width[0].tolist()])
 
-    if vertical_pad % 2 == 0:
-        top_pad = bottom_pad = int(vertical_pad / 2)
-    else:
-        top_pad = math.floor(vertical_pad / 2)
-        bottom_pad = top_pad + 1
-    if horizontal_pad % 2 == 0:
-        left_pad = right_pad = int(horizontal_pad / 2)
-    else:
-        left_pad = math.floor(horizontal_pad / 2)
-        right_pad = left_pad + 1
+    return indexing_bounds, pad_width
+
+
+def content_boundaries(offsets: np.ndarray, rows: np.ndarray,
+                       cols: np.ndarray) -> np.ndarray:
+    """Minimal row/column boundaries of many sparse 2d arrays at once,
+    for example all the ROIs of an experiment.
+
+    Parameters
+    ----------
+    offsets: numpy.ndarray
+        N + 1 increasing indices. The entries of array i are
+        rows[offsets[i]:offsets[i + 1]] and cols[offsets[i]:offsets[i + 1]]
+    rows: numpy.ndarray
+        row index of each entry
+    cols: numpy.ndarray
+        column index of each entry
+
+    Returns
+    -------
+    boundaries: numpy.ndarray
+        (N, 4) array of [top_bound, bot_bound, left_bound, right_bound]
+        for each array, as returned by content_boundary_2d(). Arrays
+        without entries are [0, 0, 0, 0].
+
+    """
+    offsets = np.asarray(offsets)
+    boundaries = np.zeros((len(offsets) - 1, 4), dtype=int)
+    nonempty = np.flatnonzero(np.diff(offsets))
+    if nonempty.size == 0:
+        return boundaries
+    starts = offsets[nonempty]
+    boundaries[nonempty, 0] = np.minimum.reduceat(rows, starts)
+    boundaries[nonempty, 1] = np.maximum.reduceat(rows, starts) + 1
+    boundaries[nonempty, 2] = np.minimum.reduceat(cols, starts)
+    boundaries[nonempty, 3] = np.maximum.reduceat(cols, starts) + 1
+    return boundaries
+
+
+def batch_content_extents(
+        boundaries: np.ndarray,
+        shape: Tuple[int, int],
+        target_shape: Tuple[int, int] = None) -> Tuple[np.ndarray,
+                                                       np.ndarray]:
+    """content_extents() of many arrays at once, from their content
+    boundaries.
+
+    Parameters
+    ----------
+    boundaries: numpy.ndarray
+        (N, 4) array of [top_bound, bot_bound, left_bound, right_bound],
+        as returned by content_boundaries()
+    shape: (Tuple[int,int]) Desired final shape after padding is applied.
+    target_shape: (Tuple[int, int]) Extent of array to be indexed. If None
+        padding will still handle top and left, but bottom and right padding
+        will always be zero
 
-    top = boundaries[0] - top_pad
-    bot = boundaries[1] + bottom_pad
-    left = boundaries[2] - left_pad
-    right = boundaries[3] + right_pad
-
-    pad_width = [[0, 0], [0, 0]]
-    if top < 0:
-        pad_width[0][0] = abs(top)
-        top = 0
-    if left < 0:
-        pad_width[1][0] = abs(left)
-        left = 0
+    Returns
+    -------
+    indexing_bounds: numpy.ndarray
+        (N, 4) array of row/column boundaries
+    pad_width: numpy.ndarray
+        (N, 2, 2) array. pad_width[i] can be passed into numpy.pad as
+        pad_width
+
+    """
+    boundaries = np.asarray(boundaries, dtype=int).reshape(-1, 4)
+    # rows are [top, bot], [left, right]
+    bounds = boundaries.reshape(-1, 2, 2)
+    content_shape = bounds[:, :, 1] - bounds[:, :, 0]
+
+    pad = np.asarray(shape, dtype=int) - content_shape
+    # odd padding puts the extra pixel after
+    before = pad // 2
+    after = pad - before
+
+    start = bounds[:, :, 0] - before
+    stop = bounds[:, :, 1] + after
+
+    pad_width = np.zeros_like(bounds)
+    pad_width[:, :, 0] = np.maximum(0, -start)
+    start = np.maximum(0, start)
     if target_shape is not None:
-        dh = target_shape[0] - bot
-        if dh < 0:
-            pad_width[0][1] = abs(dh)
-            bot = target_shape[0]
-        dw = target_shape[1] - right
-        if dw < 0:
-            pad_width[1][1] = abs(dw)
-            right = target_shape[1]
-
-    indexing_bounds = (top, bot, left, right)
-    pad_width = tuple([tuple(i) for i in pad_width])
+        target_shape = np.asarray(target_shape, dtype=int)
+        pad_width[:, :, 1] = np.maximum(0, stop - target_shape)
+        stop = np.minimum(stop, target_shape)
+
+    indexing_bounds = np.stack([start, stop], axis=2).reshape(-1, 4)
 
     return indexing_bounds, pad_width
 
 
+class PaddedArray:
+    """An array padded with zeros once, on its last two (row, col) axes,
+    so that windows planned by content_extents() are returned as views
+    instead of numpy.pad copies.
+
+    Parameters
+    ----------
+    array: numpy.ndarray
+        array with shape (..., row, col), for example a projection or a
+        video
+    margin: tuple(int, int)
+        number of zeros added before and after the row and column axes.
+        Windows that need more padding than this are still correct, but
+        are copies.
+    out: numpy.ndarray
+        zero-filled array of the padded shape to copy array into, for
+        example a numpy.memmap. If None, one is allocated.
+    chunk_size: int
+        number of entries along axis=0 copied at once, for arrays with
+        more than 2 dimensions
+
+    """
+
+    def __init__(self, array: np.ndarray, margin: Tuple[int, int],
+                 out: np.ndarray = None, chunk_size: int = 100):
+        self.margin = tuple(int(i) for i in margin)
+        padded_shape = self.padded_shape(array.shape, self.margin)
+        if out is None:
+            out = np.zeros(padded_shape, dtype=array.dtype)
+        elif out.shape != padded_shape:
+            raise ValueError(f"out has shape {out.shape}, expected "
+                             f"{padded_shape}")
+        self.padded = out
+        interior = self.array
+        if array.ndim == 2:
+            interior[:] = array
+        else:
+            for start in range(0, array.shape[0], chunk_size):
+                interior[start:(start + chunk_size)] = \
+                    array[start:(start + chunk_size)]
+
+    @staticmethod
+    def padded_shape(shape: Tuple[int, ...],
+                     margin: Tuple[int, int]) -> Tuple[int, ...]:
+        """shape of an array of shape, padded by margin"""
+        return (*shape[:-2],
+                shape[-2] + 2 * int(margin[0]),
+                shape[-1] + 2 * int(margin[1]))
+
+    @classmethod
+    def from_padded(cls, padded: np.ndarray,
+                    margin: Tuple[int, int]) -> "PaddedArray":
+        """PaddedArray from an array which is already padded by margin,
+        without copying it. margin=(0, 0) wraps an unpadded array."""
+        obj = cls.__new__(cls)
+        obj.margin = tuple(int(i) for i in margin)
+        obj.padded = padded
+        return obj
+
+    @property
+    def array(self) -> np.ndarray:
+        """view of the unpadded array"""
+        m0, m1 = self.margin
+        return self.padded[...,
+                           m0:(self.padded.shape[-2] - m0),
+                           m1:(self.padded.shape[-1] - m1)]
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        """shape of the unpadded array"""
+        return self.array.shape
+
+    def window(self, indexing_bounds: Tuple[int, int, int, int],
+               pad_width: Tuple[Tuple[int, int], Tuple[int, int]]
+               ) -> np.ndarray:
+        """the same as numpy.pad(array[..., top:bot, left:right],
+        pad_width), as a view when the margin covers pad_width
+
+        Parameters
+        ----------
+        indexing_bounds: tuple
+            4-tuple of row/column boundaries, as returned by
+            content_extents()
+        pad_width: tuple(tuple, tuple)
+            padding of the row and column axes, as returned by
+            content_extents()
+
+        Returns
+        -------
+        window: numpy.ndarray
+            the padded window
+
+        """
+        top, bot, left, right = indexing_bounds
+        (pad_top, pad_bot), (pad_left, pad_right) = pad_width
+        m0, m1 = self.margin
+        if (max(pad_top, pad_bot) <= m0) & (max(pad_left, pad_right) <= m1):
+            return self.padded[...,
+                               (m0 + top - pad_top):(m0 + bot + pad_bot),
+                               (m1 + left - pad_left):(m1 + right + pad_right)]
+        lead = ((0, 0),) * (self.padded.ndim - 2)
+        return np.pad(self.array[..., top:bot, left:right],
+                      (*lead, *[tuple(i) for i in pad_width]))
+
+
 def crop_2d_array(arr: Union[np.ndarray, coo_matrix]) -> np.ndarray:
     """
     Crop a 2d array to a rectangle surrounding all nonzero elements.
@@ -193,12 +351,230 @@ def center_pad_2d(arr: np.ndarray, shape: Tuple[int, int],
                   mode="constant", constant_values=(value,))
 
 
+def downsample_bin_edges(
+        npts_in: int,
+        input_fps: int = 31,
+        output_fps: int = 4) -> np.ndarray:
+    """Edges of the bins used to downsample along axis=0. The bins are
+    the same as np.array_split(np.arange(npts_in), npts_out).
+
+    Parameters
+    ----------
+        npts_in: int
+            number of input points
+        input_fps: int
+            frames-per-second of the input array
+        output_fps: int
+            frames-per-second of the output array
+
+    Returns:
+        bin_edges: numpy.ndarray
+            npts_out + 1 increasing indices. Bin i spans
+            [bin_edges[i], bin_edges[i + 1])
+    """
+    if output_fps > input_fps:
+        raise ValueError('Output FPS cannot be greater than input FPS')
+    npts_out = int(npts_in * output_fps / input_fps)
+    if npts_out < 1:
+        raise ValueError(f"{npts_in} points at {input_fps} fps can not be "
+                         f"downsampled to {output_fps} fps")
+    nlong = npts_in % npts_out
+    bin_sizes = np.full(npts_out, npts_in // npts_out)
+    bin_sizes[:nlong] += 1
+    return np.concatenate([[0], np.cumsum(bin_sizes)])
+
+
+def downsample_bins(
+        array: Union[h5py.Dataset, np.ndarray],
+        bin_edges: np.ndarray,
+        strategy: str = 'average',
+        rng: np.random.Generator = None,
+        dtype: Union[str, np.dtype] = 'float64',
+        block_size: int = 32) -> np.ndarray:
+    """Downsamples an array-like object along axis=0 over explicit bins.
+    Useful for downsampling a long array in blocks of whole bins.
+
+    'average' and 'maximum' reduce runs of equal-sized bins of numpy
+    arrays, in blocks of whole bins, with a single reshaped reduction
+    each. h5 datasets are read and reduced one bin, one hyperslab, at a
+    time, as reading them in larger blocks was not faster, and 'first',
+    'last' and 'random' only read the selected frames. Compressed, or
+    otherwise filtered, h5 datasets are instead read in blocks of whole
+    HDF5 chunks with downsample_blocks(), as every read decodes all the
+    chunks it touches: reading one bin or frame at a time decoded each
+    chunk once per bin.
+
+    Parameters
+    ----------
+        array: h5py.Dataset or numpy.ndarray
+            the input array
+        bin_edges: numpy.ndarray
+            increasing indices into axis=0 of array, as returned by
+            downsample_bin_edges()
+        strategy: str
+            downsampling strategy. 'random', 'maximum', 'average',
+            'first', 'last'.
+        rng: numpy.random.Generator
+            source of randomness if strategy is 'random'. Passing the
+            same generator for consecutive blocks reproduces downsampling
+            of the whole array.
+        dtype: str or numpy.dtype
+            dtype of the output array
+        block_size: int
+            approximate maximum number of frames of a numpy array reduced,
+            or of a filtered h5 dataset read, at once. A block always
+            contains at least one whole bin, or HDF5 chunk.
+
+    Returns:
+        array_out: numpy.ndarray
+            array downsampled along axis=0, len(bin_edges) - 1 entries
+    """
+    if strategy not in ['random', 'maximum', 'average', 'first', 'last']:
+        raise ValueError(f"downsampling strategy '{strategy}' not defined")
+    bin_edges = np.asarray(bin_edges)
+    bin_sizes = np.diff(bin_edges)
+    nbins = len(bin_sizes)
+    array_out = np.zeros((nbins, *array.shape[1:]), dtype=dtype)
+    if strategy == 'random' and rng is None:
+        rng = np.random.default_rng()
+
+    if isinstance(array, h5py.Dataset) and nbins > 0 and \
+            array.id.get_create_plist().get_nfilters() > 0:
+        chunk_frames = array.chunks[0]
+        frames = max(1, block_size // chunk_frames) * chunk_frames
+        block_edges = np.concatenate([
+                bin_edges[:1],
+                np.arange((bin_edges[0] // frames + 1) * frames,
+                          bin_edges[-1], frames),
+                bin_edges[-1:]])
+        blocks = (array[start:end] for start, end
+                  in zip(block_edges[:-1], block_edges[1:]))
+        i = 0
+        for chunk in downsample_blocks(blocks, block_edges, bin_edges,
+                                       strategy, rng, dtype, block_size):
+            array_out[i:(i + len(chunk))] = chunk
+            i += len(chunk)
+        return array_out
+
+    # strategies which select a single input frame per bin
+    if strategy in ['random', 'first', 'last']:
+        if strategy == 'first':
+            indices = bin_edges[:-1]
+        elif strategy == 'last':
+            indices = bin_edges[1:] - 1
+        else:
+            # same draws as rng.choice() of each bin in turn
+            indices = bin_edges[:-1] + rng.integers(0, bin_sizes)
+        if isinstance(array, h5py.Dataset):
+            # h5py point selections (array[list]) are much slower than
+            # reading the selected frames one hyperslab at a time
+            for i, index in enumerate(indices):
+                array_out[i] = array[index]
+        else:
+            for i in range(0, nbins, block_size):
+                array_out[i:(i + block_size)] = \
+                    array[indices[i:(i + block_size)]]
+        return array_out
+
+    if isinstance(array, h5py.Dataset):
+        for i in range(nbins):
+            block = array[bin_edges[i]:bin_edges[i + 1]]
+            if strategy == 'average':
+                array_out[i] = block.sum(axis=0, dtype='float64') / \
+                    bin_sizes[i]
+            else:
+                array_out[i] = block.max(axis=0)
+        return array_out
+
+    bins_per_block = max(1, block_size // max(1, bin_sizes.max()))
+    for i in range(0, nbins, bins_per_block):
+        j = min(i + bins_per_block, nbins)
+        block = array[bin_edges[i]:bin_edges[j]]
+        # runs of consecutive, equal-sized bins
+        run_starts = np.concatenate(
+                [[i], i + 1 + np.flatnonzero(np.diff(bin_sizes[i:j])), [j]])
+        for k, m in zip(run_starts[:-1], run_starts[1:]):
+            run = block[(bin_edges[k] - bin_edges[i]):
+                        (bin_edges[m] - bin_edges[i])]
+            run = run.reshape(m - k, bin_sizes[k], *run.shape[1:])
+            if strategy == 'average':
+                array_out[k:m] = \
+                    run.sum(axis=1, dtype='float64') / bin_sizes[k]
+            else:
+                array_out[k:m] = run.max(axis=1)
+
+    return array_out
+
+
+def downsample_blocks(
+        blocks: Iterable[np.ndarray],
+        block_edges: np.ndarray,
+        bin_edges: np.ndarray,
+        strategy: str = 'average',
+        rng: np.random.Generator = None,
+        dtype: Union[str, np.dtype] = 'float64',
+        block_size: int = 32) -> Generator[np.ndarray, None, None]:
+    """Downsamples consecutive blocks of frames over bins which need not
+    align with the blocks, so that the blocks can follow the storage
+    layout of the input, for example whole HDF5 chunks. The frames of a
+    bin which continues into the next block are carried over. Bins are
+    downsampled in order, so concatenating the results gives the same
+    as downsample_bins() of the whole array.
+
+    Parameters
+    ----------
+        blocks: iterable of numpy.ndarray
+            the frames between consecutive block_edges
+        block_edges: numpy.ndarray
+            increasing frame indices, from bin_edges[0] to bin_edges[-1]
+        bin_edges: numpy.ndarray
+            increasing frame indices, as returned by
+            downsample_bin_edges()
+        strategy, rng, dtype, block_size
+            as for downsample_bins()
+
+    Yields:
+        chunk: numpy.ndarray
+            the downsampled bins ending in a block, if any
+    """
+    bin_edges = np.asarray(bin_edges)
+    next_bin = 0
+    carry = None
+    for start, end, block in zip(block_edges[:-1], block_edges[1:], blocks):
+        chunks = []
+        offset = 0
+        if carry is not None:
+            head_end = bin_edges[next_bin + 1] - start
+            if head_end > len(block):
+                carry = np.concatenate([carry, block])
+                continue
+            straddling = np.concatenate([carry, block[:head_end]])
+            chunks.append(downsample_bins(straddling, [0, len(straddling)],
+                                          strategy, rng, dtype, block_size))
+            next_bin += 1
+            offset = head_end
+            carry = None
+        last_bin = np.searchsorted(bin_edges, end, side='right') - 1
+        if last_bin > next_bin:
+            chunks.append(downsample_bins(
+                block[offset:(bin_edges[last_bin] - start)],
+                bin_edges[next_bin:(last_bin + 1)] - bin_edges[next_bin],
+                strategy, rng, dtype, block_size))
+            next_bin = last_bin
+        if bin_edges[next_bin] < end:
+            carry = block[(bin_edges[next_bin] - start):].copy()
+        if chunks:
+            yield np.concatenate(chunks)
+
+
 def downsample_array(
         array: Union[h5py.Dataset, np.ndarray],
         input_fps: int = 31,
         output_fps: int = 4,
         strategy: str = 'average',
-        random_seed: int = 0) -> np.ndarray:
+        random_seed: int = 0,
+        dtype: Union[str, np.dtype] = 'float64',
+        block_size: int = 32) -> np.ndarray:
     """Downsamples an array-like object along axis=0
 
     Parameters
@@ -215,6 +591,10 @@ def downsample_array(
             multi-dimensional arrays
         random_seed: int
             passed to numpy.random.default_rng if strategy is 'random'
+        dtype: str or numpy.dtype
+            dtype of the output array
+        block_size: int
+            approximate maximum number of frames reduced at once
 
     Returns:
         array_out: numpy.ndarray
@@ -225,43 +605,321 @@ def downsample_array(
     if (strategy == 'maximum') & (len(array.shape) > 1):
         raise ValueError("downsampling with strategy 'maximum' is not defined")
 
-    npts_in = array.shape[0]
-    npts_out = int(npts_in * output_fps / input_fps)
-    bin_list = np.array_split(np.arange(npts_in), npts_out)
+    bin_edges = downsample_bin_edges(array.shape[0], input_fps, output_fps)
+    rng = np.random.default_rng(random_seed)
+
+    return downsample_bins(array, bin_edges, strategy, rng, dtype,
+                           block_size)
 
-    array_out = np.zeros((npts_out, *array.shape[1:]))
 
-    if strategy == 'random':
-        rng = np.random.default_rng(random_seed)
+def projections_from_chunks(
+        chunks: Iterable[np.ndarray],
+        quantiles: "StreamingQuantiles" = None
+        ) -> Tuple[np.ndarray, np.ndarray, int]:
+    """Accumulates average and maximum projections over chunks of frames,
+    so that the full video never needs to be in memory.
 
-    sampling_strategies = {
-            'random': lambda arr, idx: arr[rng.choice(idx)],
-            'maximum': lambda arr, idx: arr[idx].max(axis=0),
-            'average': lambda arr, idx: arr[idx].mean(axis=0),
-            'first': lambda arr, idx: arr[idx[0]],
-            'last': lambda arr, idx: arr[idx[-1]]
-            }
+    Parameters
+    ----------
+    chunks: iterable of numpy.ndarray
+        consecutive chunks of a video, each of shape (nframes, row, col)
+    quantiles: StreamingQuantiles
+        if provided, updated with each chunk, for quantiles of the whole
+        video from the same pass
 
-    sampler = sampling_strategies[strategy]
-    for i, bin_indices in enumerate(bin_list):
-        array_out[i] = sampler(array, bin_indices)
+    Returns
+    -------
+    avg_projection: numpy.ndarray
+        mean along axis=0 of the concatenated chunks
+    max_projection: numpy.ndarray
+        maximum along axis=0 of the concatenated chunks
+    nframes: int
+        total number of frames seen
 
-    return array_out
+    """
+    total = None
+    max_projection = None
+    nframes = 0
+    for chunk in chunks:
+        if total is None:
+            total = np.zeros(chunk.shape[1:], dtype='float64')
+            max_projection = chunk.max(axis=0)
+        else:
+            np.maximum(max_projection, chunk.max(axis=0), out=max_projection)
+        total += chunk.sum(axis=0, dtype='float64')
+        nframes += chunk.shape[0]
+        if quantiles is not None:
+            quantiles.update(chunk)
+    if nframes == 0:
+        raise ValueError("no frames found to project")
+    return total / nframes, max_projection, nframes
+
+
+def _lerp(a: np.ndarray, b: np.ndarray, t: np.ndarray) -> np.ndarray:
+    """linear interpolation with the rounding of numpy.quantile()"""
+    diff_b_a = np.subtract(b, a)
+    lerp = np.add(a, diff_b_a * t)
+    np.subtract(b, diff_b_a * (1 - t), out=lerp, where=t >= 0.5)
+    return lerp
+
+
+class StreamingQuantiles:
+    """Quantiles of data seen one chunk at a time, for example the frames
+    of a movie that does not fit in memory.
+
+    Modes:
+        'integer': a histogram of every possible value, for integer data
+            of at most 16 bits. Quantiles are exact.
+        'histogram': a fixed number of equal-width bins, which double in
+            width when data outside their range arrives. Histograms of
+            the same number of bins can be merged. Quantiles are within
+            StreamingQuantiles.error of the exact value.
+        'exact': keeps all the data, and uses numpy.quantile(). For
+            parity with in-memory results.
+        'auto': 'integer' for integer data of at most 16 bits, else
+            'histogram'. Decided by the first chunk.
+
+    Quantiles use the 'linear' method of numpy.quantile().
+
+    Parameters
+    ----------
+    mode: str
+        'auto', 'integer', 'histogram' or 'exact'
+    nbins: int
+        number of bins in 'histogram' mode
+
+    Example
+    -------
+    >>> estimator = StreamingQuantiles()
+    >>> for chunk in chunks:
+    ...     estimator.update(chunk)
+    >>> lower_cutoff, upper_cutoff = estimator.quantile([0.1, 0.999])
+
+    """
+
+    def __init__(self, mode: str = 'auto', nbins: int = 2**16):
+        if mode not in ['auto', 'integer', 'histogram', 'exact']:
+            raise ValueError(f"quantile mode '{mode}' not defined")
+        self.mode = mode
+        self.nbins = nbins
+        self.count = 0
+        self.min = None
+        self.max = None
+        self._counts = None
+        self._offset = 0
+        self._lo = None
+        self._width = None
+        self._values = []
+
+    @property
+    def error(self) -> float:
+        """bound on the absolute error of quantile()"""
+        if self.mode == 'histogram':
+            return 0.0 if self._width is None else self._width
+        return 0.0
+
+    def update(self, chunk: np.ndarray):
+        """add the values of chunk, of any shape"""
+        chunk = np.asarray(chunk).ravel()
+        if chunk.size == 0:
+            return
+        if self.mode == 'auto':
+            dtype = chunk.dtype
+            self.mode = 'integer' if (dtype.kind in 'ui') & \
+                (dtype.itemsize <= 2) else 'histogram'
+        cmin, cmax = chunk.min(), chunk.max()
+        self.min = cmin if self.min is None else min(self.min, cmin)
+        self.max = cmax if self.max is None else max(self.max, cmax)
+        self.count += chunk.size
+
+        if self.mode == 'exact':
+            self._values.append(chunk.copy())
+        elif self.mode == 'integer':
+            if self._counts is None:
+                info = np.iinfo(chunk.dtype)
+                if info.bits > 16:
+                    raise ValueError("'integer' mode is for integers of at "
+                                     f"most 16 bits, not {info.bits}")
+                self._offset = info.min
+                self._counts = np.zeros(2**info.bits, dtype='int64')
+            self._counts += np.bincount(
+                    chunk.astype('int64') - self._offset,
+                    minlength=len(self._counts))
+        else:
+            self._histogram_update(chunk, cmin, cmax)
+
+    def _histogram_update(self, chunk: np.ndarray, cmin: float,
+                          cmax: float):
+        if self._counts is None:
+            self._lo = float(cmin)
+            span = float(cmax) - float(cmin)
+            self._width = span / (self.nbins - 1) if span > 0 else 1.0
+            self._counts = np.zeros(self.nbins, dtype='int64')
+        self._grow(float(cmin), float(cmax))
+        index = ((chunk - self._lo) / self._width).astype('int64')
+        np.clip(index, 0, self.nbins - 1, out=index)
+        self._counts += np.bincount(index, minlength=self.nbins)
+
+    def _grow(self, vmin: float, vmax: float):
+        """widen the bins, by powers of 2, until they cover [vmin, vmax].
+        Each old bin falls in exactly one new bin."""
+        factor = 1
+        while True:
+            width = self._width * factor
+            shift = max(0, int(np.ceil((self._lo - vmin) / width)))
+            lo = self._lo - shift * width
+            if (lo + self.nbins * width > vmax) & \
+                    (shift + (self.nbins - 1) // factor < self.nbins):
+                break
+            factor *= 2
+        if (factor == 1) & (shift == 0):
+            return
+        new_index = shift + np.arange(self.nbins) // factor
+        counts = np.zeros(self.nbins, dtype='int64')
+        np.add.at(counts, new_index, self._counts)
+        self._counts = counts
+        self._lo = lo
+        self._width = width
+
+    def merge(self, other: "StreamingQuantiles"):
+        """add the values seen by another estimator of the same mode"""
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.__dict__.update(
+                    {k: (v.copy() if isinstance(v, (np.ndarray, list))
+                         else v)
+                     for k, v in other.__dict__.items()})
+            return
+        if self.mode != other.mode:
+            raise ValueError(f"can not merge '{other.mode}' quantiles "
+                             f"into '{self.mode}' quantiles")
+        if self.mode == 'exact':
+            self._values.extend(other._values)
+        elif self.mode == 'integer':
+            if self._offset != other._offset:
+                raise ValueError("can not merge quantiles of different "
+                                 "integer types")
+            self._counts += other._counts
+        else:
+            if self.nbins != other.nbins:
+                raise ValueError("can not merge quantiles with different "
+                                 "numbers of bins")
+            # rebin other onto bins covering both
+            self._grow(other._lo, other._lo + other.nbins * other._width)
+            centers = other._lo + (np.arange(other.nbins) + 0.5) * \
+                other._width
+            index = ((centers - self._lo) / self._width).astype('int64')
+            np.clip(index, 0, self.nbins - 1, out=index)
+            np.add.at(self._counts, index, other._counts)
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.count += other.count
+
+    def quantile(self, q: Union[float, Iterable[float]]
+                 ) -> Union[float, np.ndarray]:
+        """quantiles of all the values seen so far
+
+        Parameters
+        ----------
+        q: float or iterable of float
+            quantiles, between 0 and 1
+
+        Returns
+        -------
+        quantiles: float or numpy.ndarray
+            same shape as q
+
+        """
+        if self.count == 0:
+            raise ValueError("no values seen to compute quantiles of")
+        q = np.asarray(q, dtype='float64')
+        if self.mode == 'exact':
+            return np.quantile(np.concatenate(self._values), q)
+
+        # the ranks numpy.quantile() interpolates between
+        virtual = np.atleast_1d(q) * (self.count - 1)
+        previous = np.floor(virtual)
+        gamma = virtual - previous
+        following = np.minimum(previous + 1, self.count - 1)
+        cumulative = np.cumsum(self._counts)
+        if self.mode == 'integer':
+            a = np.searchsorted(cumulative, previous, side='right') + \
+                self._offset
+            b = np.searchsorted(cumulative, following, side='right') + \
+                self._offset
+            result = _lerp(a.astype('float64'), b.astype('float64'), gamma)
+            return result.reshape(q.shape)[()]
+
+        # the values of those ranks are assumed uniformly spread within
+        # their bin, so each is within one bin width of the exact value
+        def ranked_values(ranks):
+            index = np.searchsorted(cumulative, ranks, side='right')
+            before = np.where(index > 0, cumulative[index - 1], 0)
+            fraction = (ranks - before + 0.5) / self._counts[index]
+            values = self._lo + (index + fraction) * self._width
+            values = np.clip(values, self.min, self.max)
+            # the extremes are known exactly
+            values[ranks == 0] = self.min
+            values[ranks == self.count - 1] = self.max
+            return values
+
+        result = _lerp(ranked_values(previous), ranked_values(following),
+                       gamma)
+        return result.reshape(q.shape)[()]
+
+
+def normalize_lut(dtype: Union[str, np.dtype], lower_cutoff: float,
+                  upper_cutoff: float) -> np.ndarray:
+    """Lookup table of normalize_array() for every value of an integer
+    dtype of at most 16 bits
+
+    Parameters
+    ----------
+    dtype: str or numpy.dtype
+        integer dtype of the arrays to be normalized
+    lower_cutoff: float
+        threshold, below which will be = 0
+    upper_cutoff: float
+        threshold, above which will be = 255
+
+    Returns
+    -------
+    lut: numpy.ndarray (uint8)
+        lut[value - numpy.iinfo(dtype).min] is the normalized value
+
+    """
+    info = np.iinfo(dtype)
+    if info.bits > 16:
+        raise ValueError(f"no lookup table for {info.bits}-bit integers")
+    values = np.arange(info.min, info.max + 1, dtype='float64')
+    return normalize_array(values, lower_cutoff, upper_cutoff)
 
 
 def normalize_array(
         array: np.ndarray, lower_cutoff: float,
-        upper_cutoff: float) -> np.ndarray:
+        upper_cutoff: float, out: np.ndarray = None,
+        chunk_size: int = 100) -> np.ndarray:
     """Normalize an array into uint8 with cutoff values
 
+    Float arrays are normalized in chunks along axis=0, in place in a
+    single chunk-sized buffer. Integer arrays of at most 16 bits, like
+    uint16 movies, are mapped through a lookup table of every possible
+    value instead.
+
     Parameters
     ----------
-    array: numpy.ndarray (float)
+    array: numpy.ndarray or h5py.Dataset
         array to be normalized
     lower_cutoff: float
         threshold, below which will be = 0
     upper_cutoff: float
         threshold, abovewhich will be = 255
+    out: numpy.ndarray (uint8)
+        destination with the shape of array, for example a numpy.memmap.
+        If None, one is allocated.
+    chunk_size: int
+        number of entries along axis=0 normalized at once
 
     Returns
     -------
@@ -269,9 +927,38 @@ def normalize_array(
         normalized array
 
     """
-    normalized = np.copy(array)
-    normalized[array < lower_cutoff] = lower_cutoff
-    normalized[array > upper_cutoff] = upper_cutoff
-    normalized -= lower_cutoff
-    normalized = np.uint8(normalized * 255 / (upper_cutoff - lower_cutoff))
-    return normalized
+    if out is None:
+        out = np.empty(array.shape, dtype='uint8')
+    elif out.shape != array.shape:
+        raise ValueError(f"out has shape {out.shape}, expected "
+                         f"{array.shape}")
+    if array.ndim == 0:
+        out[()] = normalize_array(np.asarray(array).reshape(1),
+                                  lower_cutoff, upper_cutoff)[0]
+        return out
+
+    dtype = np.dtype(array.dtype)
+    if (dtype.kind in 'ui') and (dtype.itemsize <= 2):
+        lut = normalize_lut(dtype, lower_cutoff, upper_cutoff)
+        offset = np.iinfo(dtype).min
+        for start in range(0, array.shape[0], chunk_size):
+            chunk = np.asarray(array[start:(start + chunk_size)])
+            if offset != 0:
+                chunk = chunk.astype('int32') - offset
+            np.take(lut, chunk, out=out[start:(start + chunk_size)])
+        return out
+
+    # same operations, and so the same rounding, as a whole-array
+    # (array.clip() - lower_cutoff) * 255 / (upper_cutoff - lower_cutoff)
+    buffer_dtype = dtype if dtype.kind == 'f' else np.dtype('float64')
+    buffer = np.empty((min(chunk_size, array.shape[0]), *array.shape[1:]),
+                      dtype=buffer_dtype)
+    for start in range(0, array.shape[0], chunk_size):
+        chunk = array[start:(start + chunk_size)]
+        normalized = buffer[:len(chunk)]
+        np.clip(chunk, lower_cutoff, upper_cutoff, out=normalized)
+        normalized -= lower_cutoff
+        normalized *= 255
+        normalized /= (upper_cutoff - lower_cutoff)
+        out[start:(start + chunk_size)] = normalized
+    return out
@@ -0,0 +1,578 @@
+import concurrent.futures
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+import h5py
+import imageio
+import numpy as np
+
+
+def write_png(path: Union[str, Path], image: np.ndarray,
+              compression: int = 9, **kwargs) -> int:
+    """write a png, returning its size in bytes
+
+    Parameters
+    ----------
+    path: str or Path
+        destination
+    image: numpy.ndarray
+        the image
+    compression: int
+        zlib compression level, 0 (fastest) to 9 (smallest)
+    kwargs:
+        other PNG writer arguments, for example transparency
+
+    Returns
+    -------
+    nbytes: int
+        size of the written file
+
+    """
+    imageio.imsave(path, image, format="PNG-PIL", compression=compression,
+                   **kwargs)
+    return os.path.getsize(path)
+
+
+class PngWriter:
+    """Writes png files on a pool of threads, so that compressing them,
+    which releases the GIL, overlaps with making the next ones.
+
+    At most max_pending writes are queued; submit() blocks until there
+    is room, which bounds the memory held by queued images. Images must
+    not be modified after they are submitted.
+
+    Parameters
+    ----------
+    max_workers: int
+        number of writing threads. 0 writes each png when submitted.
+    compression: int
+        zlib compression level, 0 (fastest) to 9 (smallest)
+    max_pending: int
+        maximum number of queued writes. Default 4 * max_workers.
+
+    Example
+    -------
+    >>> with PngWriter(max_workers=4, compression=6) as writer:
+    ...     for path, image in images:
+    ...         writer.submit(path, image)
+    >>> writer.stats
+    {'files': 1000, 'bytes': 12000000, 'write_s': 3.2, ...}
+
+    """
+
+    def __init__(self, max_workers: int = 4, compression: int = 9,
+                 max_pending: Optional[int] = None):
+        if (compression < 0) | (compression > 9):
+            raise ValueError("PNG compression level must be between 0 and "
+                             f"9, not {compression}")
+        self.max_workers = max_workers
+        self.compression = compression
+        self._executor = None
+        if max_workers > 0:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=max_workers)
+            if max_pending is None:
+                max_pending = 4 * max_workers
+            self._slots = threading.BoundedSemaphore(max_pending)
+        self._pending: List[concurrent.futures.Future] = []
+        self._lock = threading.Lock()
+        self._closed = False
+        self._start = None
+        self._end = None
+        self.files = 0
+        self.bytes = 0
+        self.write_s = 0.0
+        self.wait_s = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _write(self, path: Union[str, Path], image: np.ndarray, **kwargs):
+        start = time.perf_counter()
+        nbytes = write_png(path, image, compression=self.compression,
+                           **kwargs)
+        with self._lock:
+            self.files += 1
+            self.bytes += nbytes
+            self.write_s += time.perf_counter() - start
+
+    def submit(self, path: Union[str, Path], image: np.ndarray, **kwargs):
+        """queue image to be written to path. kwargs are passed to the
+        PNG writer, for example transparency."""
+        if self._start is None:
+            self._start = time.perf_counter()
+        if self._executor is None:
+            self._write(path, image, **kwargs)
+            return
+        self._slots.acquire()
+        future = self._executor.submit(self._write, path, image, **kwargs)
+        future.add_done_callback(lambda _: self._slots.release())
+        self._pending.append(future)
+
+    def submit_json(self, path: Union[str, Path], obj):
+        """write a small json artifact, for example a trace, right away"""
+        with open(path, "w") as f:
+            json.dump(obj, f)
+
+    def flush(self) -> dict:
+        """wait for the queued writes, raising the first error of any of
+        them, and return the write statistics"""
+        start = time.perf_counter()
+        pending, self._pending = self._pending, []
+        for future in pending:
+            future.result()
+        self.wait_s += time.perf_counter() - start
+        return self.stats
+
+    def close(self) -> dict:
+        """flush() and stop the threads. Closing again only returns the
+        statistics."""
+        if self._closed:
+            return self.stats
+        try:
+            self.flush()
+        finally:
+            self._closed = True
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+            self._end = time.perf_counter()
+        stats = self.stats
+        logging.info(f"wrote {stats['files']} png files, "
+                     f"{stats['bytes'] / 1e6:.1f} MB, at "
+                     f"{stats['mb_per_s']:.1f} MB/s")
+        return stats
+
+    def abort(self):
+        """drop the queued writes and stop the threads, for example after
+        an error"""
+        self._closed = True
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+        self._pending = []
+
+    @property
+    def stats(self) -> dict:
+        """files and bytes written, seconds spent writing (summed over
+        threads), seconds waited in flush(), and throughput over the wall
+        time from the first submit() to close()"""
+        wall_s = 0.0
+        if self._start is not None:
+            end = time.perf_counter() if self._end is None else self._end
+            wall_s = end - self._start
+        return {
+            'files': self.files,
+            'bytes': self.bytes,
+            'write_s': self.write_s,
+            'wait_s': self.wait_s,
+            'wall_s': wall_s,
+            'mb_per_s': self.bytes / 1e6 / wall_s if wall_s > 0 else 0.0}
+
+
+class TileBuffer:
+    """Holds the images of some paths in memory, for example in an ROI
+    worker process which returns them to the process packing them into
+    an atlas or container, and passes the images of other paths to a
+    writer. json artifacts are held or passed likewise.
+
+    Parameters
+    ----------
+    paths: iterable of Path
+        paths of the images to hold
+    writer: PngWriter
+        writes the images of other paths
+
+    """
+
+    def __init__(self, paths: Iterable[Union[str, Path]],
+                 writer: PngWriter):
+        self.paths = {Path(p) for p in paths}
+        self.writer = writer
+        self.images: List[Tuple[Path, np.ndarray, dict]] = []
+        self.jsons: List[Tuple[Path, object]] = []
+
+    def submit(self, path: Union[str, Path], image: np.ndarray, **kwargs):
+        if Path(path) in self.paths:
+            self.images.append((Path(path), image, kwargs))
+        else:
+            self.writer.submit(path, image, **kwargs)
+
+    def submit_json(self, path: Union[str, Path], obj):
+        if Path(path) in self.paths:
+            self.jsons.append((Path(path), obj))
+        else:
+            self.writer.submit_json(path, obj)
+
+    def take(self) -> Tuple[List[Tuple[Path, np.ndarray, dict]],
+                            List[Tuple[Path, object]]]:
+        """the held (path, image, kwargs) and (path, json object), which
+        are then released"""
+        images, self.images = self.images, []
+        jsons, self.jsons = self.jsons, []
+        return images, jsons
+
+    @staticmethod
+    def replay(held: Tuple[list, list], writer):
+        """submit what take() returned, for example in another process,
+        to writer"""
+        images, jsons = held
+        for path, image, kwargs in images:
+            writer.submit(path, image, **kwargs)
+        for path, obj in jsons:
+            writer.submit_json(path, obj)
+
+
+class AtlasWriter:
+    """Packs images of the same shape into a few large png sheets, rather
+    than writing one small png per image. Each path submitted in place of
+    a png is assigned a tile, by kind of image: the images of one kind
+    are packed in the sheets of that kind, in the order of their index.
+
+    Sheet k of a kind is written as {kind}_atlas_{k}.png in output_dir,
+    with the png arguments of the first tile of that kind, for example
+    transparency. An index, atlas_index.json, records
+    the tile of each path. Images of paths without a tile are passed to
+    the png writer.
+
+    Parameters
+    ----------
+    output_dir: Path
+        destination of the sheets and index
+    tiles: dict
+        {path: (kind, index)} of the images to pack
+    tile_shape: tuple(int, int)
+        shape of each image
+    columns: int
+        tiles per row of a sheet
+    tiles_per_sheet: int
+        maximum tiles per sheet, a multiple of columns
+    writer: PngWriter
+        writes the sheets, and the images without a tile
+
+    Example
+    -------
+    >>> atlas = AtlasWriter(output_dir, {mask_path: ('mask', 0)}, (128, 128),
+    ...                     writer=PngWriter())
+    >>> atlas.submit(mask_path, mask, transparency=0)
+    >>> atlas.ref(mask_path)
+    '/output/mask_atlas_0.png#xywh=0,0,128,128'
+    >>> atlas.close()
+
+    """
+    index_name = "atlas_index.json"
+
+    def __init__(self, output_dir: Union[str, Path],
+                 tiles: Dict[Union[str, Path], Tuple[str, int]],
+                 tile_shape: Tuple[int, int], columns: int = 32,
+                 tiles_per_sheet: int = 1024,
+                 writer: Optional[PngWriter] = None):
+        if (columns < 1) | (tiles_per_sheet % columns != 0):
+            raise ValueError(f"tiles_per_sheet ({tiles_per_sheet}) must be "
+                             f"a multiple of columns ({columns})")
+        self.output_dir = Path(output_dir)
+        self.tiles = {Path(k): v for k, v in tiles.items()}
+        self.tile_shape = tuple(tile_shape)
+        self.columns = columns
+        self.tiles_per_sheet = tiles_per_sheet
+        self.writer = PngWriter(max_workers=0) if writer is None else writer
+        self._counts: Dict[str, int] = {}
+        for kind, index in self.tiles.values():
+            self._counts[kind] = max(self._counts.get(kind, 0), index + 1)
+        self._sheets: Dict[Tuple[str, int], np.ndarray] = {}
+        self._kwargs: Dict[str, dict] = {}
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def sheet_path(self, kind: str, sheet: int) -> Path:
+        return self.output_dir / f"{kind}_atlas_{sheet}.png"
+
+    def location(self, path: Union[str, Path]) -> Tuple[Path, int, int]:
+        """(sheet path, row, col) of the top-left pixel of a tile"""
+        kind, index = self.tiles[Path(path)]
+        sheet, position = divmod(index, self.tiles_per_sheet)
+        row, col = divmod(position, self.columns)
+        return (self.sheet_path(kind, sheet),
+                row * self.tile_shape[0], col * self.tile_shape[1])
+
+    def ref(self, path: Union[str, Path]) -> str:
+        """reference to the tile of path, as a media fragment of its
+        sheet ('sheet.png#xywh=x,y,width,height'). Paths without a tile
+        are referenced as they are."""
+        if Path(path) not in self.tiles:
+            return str(path)
+        sheet, row, col = self.location(path)
+        height, width = self.tile_shape
+        return f"{sheet}#xywh={col},{row},{width},{height}"
+
+    def _sheet(self, kind: str, sheet: int, dtype: np.dtype) -> np.ndarray:
+        if (kind, sheet) not in self._sheets:
+            ntiles = min(self.tiles_per_sheet,
+                         self._counts[kind] - sheet * self.tiles_per_sheet)
+            rows = -(-ntiles // self.columns)
+            columns = min(ntiles, self.columns)
+            self._sheets[(kind, sheet)] = np.zeros(
+                    (rows * self.tile_shape[0], columns * self.tile_shape[1]),
+                    dtype=dtype)
+        return self._sheets[(kind, sheet)]
+
+    def submit(self, path: Union[str, Path], image: np.ndarray, **kwargs):
+        """place image in the tile of path, or write it if path has no
+        tile. kwargs are png arguments."""
+        if Path(path) not in self.tiles:
+            self.writer.submit(path, image, **kwargs)
+            return
+        if image.shape != self.tile_shape:
+            raise ValueError(f"image of shape {image.shape} does not fit "
+                             f"tiles of shape {self.tile_shape}")
+        kind, index = self.tiles[Path(path)]
+        self._kwargs.setdefault(kind, kwargs)
+        _, row, col = self.location(path)
+        sheet = self._sheet(kind, index // self.tiles_per_sheet, image.dtype)
+        sheet[row:(row + self.tile_shape[0]),
+              col:(col + self.tile_shape[1])] = image
+
+    def submit_json(self, path: Union[str, Path], obj):
+        self.writer.submit_json(path, obj)
+
+    def close(self) -> dict:
+        """write the sheets and the index, and close the png writer,
+        returning its statistics. Closing again only returns the
+        statistics."""
+        if self._closed:
+            return self.writer.close()
+        self._closed = True
+        for (kind, sheet), array in sorted(self._sheets.items()):
+            self.writer.submit(self.sheet_path(kind, sheet), array,
+                               **self._kwargs[kind])
+        index = {
+            'tile_shape': list(self.tile_shape),
+            'columns': self.columns,
+            'tiles_per_sheet': self.tiles_per_sheet,
+            'sheets': {f"{kind}_{sheet}": str(self.sheet_path(kind, sheet))
+                       for kind, sheet in sorted(self._sheets)},
+            'tiles': {str(path): self.ref(path) for path in self.tiles}}
+        with open(self.output_dir / self.index_name, "w") as f:
+            json.dump(index, f, indent=2)
+        return self.writer.close()
+
+    def abort(self):
+        """drop the sheets, which are not written, and abort the png
+        writer, for example after an error"""
+        self._closed = True
+        self._sheets = {}
+        self.writer.abort()
+
+
+class H5ArtifactWriter:
+    """Stores the per-ROI images and traces of an experiment in a single
+    chunked, compressed h5 file, rather than in one file per artifact.
+
+    Each kind of artifact is a dataset whose entry i belongs to the i-th
+    ROI of roi_ids: images are (nrois, rows, cols) datasets, traces a
+    (nrois, ntimes) dataset of their 'trace' values. Datasets are chunked
+    by chunk_rois ROIs, so consecutive ROIs are read sequentially. Whole
+    chunks are buffered in memory and written, compressed, once.
+    Artifacts of paths without a slot are passed to the png writer.
+
+    Parameters
+    ----------
+    output_path: Path
+        the h5 file
+    slots: dict
+        {path: (kind, index)} of the artifacts to store
+    roi_ids: list of int
+        the ROI id of each index, stored as dataset 'roi_id'
+    chunk_rois: int
+        number of ROIs per chunk
+    compression: int
+        gzip level of the datasets, 0 for none
+    writer: PngWriter
+        writes the artifacts without a slot
+
+    """
+
+    def __init__(self, output_path: Union[str, Path],
+                 slots: Dict[Union[str, Path], Tuple[str, int]],
+                 roi_ids: List[int], chunk_rois: int = 64,
+                 compression: int = 4, writer: Optional[PngWriter] = None):
+        if chunk_rois < 1:
+            raise ValueError(f"chunk_rois must be positive, not {chunk_rois}")
+        self.output_path = Path(output_path)
+        self.slots = {Path(k): v for k, v in slots.items()}
+        self.nrois = len(roi_ids)
+        self.chunk_rois = min(chunk_rois, max(1, self.nrois))
+        self.compression = compression
+        self.writer = PngWriter(max_workers=0) if writer is None else writer
+        self._file = h5py.File(self.output_path, "w")
+        self._file.create_dataset("roi_id", data=np.array(roi_ids,
+                                                          dtype='int64'))
+        # {(kind, chunk): [buffer, number of entries filled]}
+        self._chunks: Dict[Tuple[str, int], list] = {}
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def ref(self, path: Union[str, Path]) -> str:
+        """reference to the entry of path, 'file.h5#kind/index'. Paths
+        without a slot are referenced as they are."""
+        if Path(path) not in self.slots:
+            return str(path)
+        kind, index = self.slots[Path(path)]
+        return f"{self.output_path}#{kind}/{index}"
+
+    def _dataset(self, kind: str, entry: np.ndarray) -> h5py.Dataset:
+        if kind not in self._file:
+            kwargs = {}
+            if self.compression > 0:
+                kwargs = {'compression': 'gzip',
+                          'compression_opts': self.compression}
+            self._file.create_dataset(
+                    kind, shape=(self.nrois, *entry.shape),
+                    dtype=entry.dtype,
+                    chunks=(self.chunk_rois, *entry.shape), **kwargs)
+        return self._file[kind]
+
+    def _store(self, path: Union[str, Path], entry: np.ndarray):
+        kind, index = self.slots[Path(path)]
+        dataset = self._dataset(kind, entry)
+        if entry.shape != dataset.shape[1:]:
+            raise ValueError(f"{kind} of shape {entry.shape} does not fit "
+                             f"the entries of shape {dataset.shape[1:]}")
+        chunk, position = divmod(index, self.chunk_rois)
+        start = chunk * self.chunk_rois
+        size = min(self.chunk_rois, self.nrois - start)
+        if (kind, chunk) not in self._chunks:
+            self._chunks[(kind, chunk)] = [
+                    np.zeros((size, *entry.shape), dtype=dataset.dtype), 0]
+        buffered = self._chunks[(kind, chunk)]
+        buffered[0][position] = entry
+        buffered[1] += 1
+        if buffered[1] == size:
+            dataset[start:(start + size)] = buffered[0]
+            del self._chunks[(kind, chunk)]
+
+    def submit(self, path: Union[str, Path], image: np.ndarray, **kwargs):
+        """store image in the slot of path, or write it if path has no
+        slot. kwargs are png arguments, not needed in the h5 file."""
+        if Path(path) not in self.slots:
+            self.writer.submit(path, image, **kwargs)
+            return
+        self._store(path, image)
+
+    def submit_json(self, path: Union[str, Path], obj):
+        """store the 'trace' of a trace json in the slot of path, or
+        write it if path has no slot"""
+        if Path(path) not in self.slots:
+            self.writer.submit_json(path, obj)
+            return
+        self._store(path, np.asarray(obj['trace']))
+        kind, _ = self.slots[Path(path)]
+        for k, v in obj.items():
+            if k != 'trace':
+                self._file[kind].attrs[k] = v
+
+    def close(self) -> dict:
+        """write the partly filled chunks, close the file, and close the
+        png writer, returning its statistics. Closing again only returns
+        the statistics."""
+        if self._closed:
+            return self.writer.close()
+        self._closed = True
+        try:
+            for (kind, chunk), (buffer, _) in sorted(self._chunks.items()):
+                start = chunk * self.chunk_rois
+                self._file[kind][start:(start + len(buffer))] = buffer
+        finally:
+            self._chunks = {}
+            self._file.close()
+        return self.writer.close()
+
+    def abort(self):
+        """close and delete the incomplete file, and abort the png
+        writer, for example after an error"""
+        if not self._closed:
+            self._closed = True
+            self._chunks = {}
+            self._file.close()
+            self.output_path.unlink()
+        self.writer.abort()
+
+
+class H5ArtifactStore:
+    """Reads the h5 file of an H5ArtifactWriter
+
+    Parameters
+    ----------
+    path: str or Path
+        the h5 file
+
+    Example
+    -------
+    >>> with H5ArtifactStore("roi_artifacts.h5") as store:
+    ...     mask = store[roi_id]['mask']
+    ...     batch = store.read('max', 0, 256)
+
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self._file = h5py.File(path, "r")
+        self.roi_ids = self._file["roi_id"][()]
+        self._index = {int(i): n for n, i in enumerate(self.roi_ids)}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def __len__(self) -> int:
+        return len(self.roi_ids)
+
+    @property
+    def kinds(self) -> List[str]:
+        return [k for k in self._file if k != "roi_id"]
+
+    def index(self, roi_id: int) -> int:
+        """entry of an ROI in the datasets"""
+        if int(roi_id) not in self._index:
+            raise KeyError(f"roi {roi_id} not in the store")
+        return self._index[int(roi_id)]
+
+    def __getitem__(self, roi_id: int) -> Dict[str, np.ndarray]:
+        """all the artifacts of one ROI, by kind"""
+        n = self.index(roi_id)
+        return {kind: self._file[kind][n] for kind in self.kinds}
+
+    def read(self, kind: str, start: int = 0,
+             stop: Optional[int] = None) -> np.ndarray:
+        """the artifacts of kind of consecutive entries, a sequential
+        read"""
+        return self._file[kind][start:stop]
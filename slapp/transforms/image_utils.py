@@ -1,22 +1,53 @@
+import functools
 from typing import Tuple
 import numpy as np
 import cv2
 
 
+@functools.lru_cache(maxsize=64)
+def scale_pixels(shape: Tuple[int, int],
+                 scale_position: Tuple[int, int],
+                 length: int,
+                 thickness: int,
+                 text: str,
+                 fontScale: float) -> Tuple[np.ndarray, np.ndarray]:
+    """(rows, cols) of the pixels of a scale bar and its label, rendered
+    once per set of arguments. See add_scale().
+
+    The returned arrays are read-only, as they are shared by all callers.
+    """
+    stamp = np.zeros(shape, dtype='uint8')
+    pt1 = (scale_position[0], scale_position[1] - length + 1)
+    pt2 = (scale_position[0] + length - 1, scale_position[1])
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    linetype = cv2.LINE_4
+    cv2.putText(stamp, text, pt2, font, fontScale, 1, thickness, linetype)
+    cv2.line(stamp, scale_position, pt1, 1, thickness, linetype)
+    cv2.line(stamp, scale_position, pt2, 1, thickness, linetype)
+    rows, cols = np.nonzero(stamp)
+    rows.flags.writeable = False
+    cols.flags.writeable = False
+    return rows, cols
+
+
 def add_scale(array: np.ndarray,
               scale_position: Tuple[int, int],
               um_per_pixel: float = 400 / 512,
               scale_size_um: float = 10,
               color: int = 0,
               thickness_um: float = 1.0,
-              fontScale: float = 0.2) -> np.ndarray:
+              fontScale: float = 0.2,
+              inplace: bool = False) -> np.ndarray:
     """
-    Adds a scale bar onto an array using opencv.
+    Adds a scale bar onto an array using opencv. The scale bar is drawn
+    once per shape and set of scale arguments, and set on each array with
+    a single indexed assignment.
 
     Parameters
     ----------
     array: np.ndarray
-        function only accepts np.uint8 2D arrays
+        function only accepts np.uint8 2D arrays, or 3D arrays of 2D
+        images which are all annotated
     scale_position: Tuple
         image coordinates for the corner of the scale bars
     um_per_pixel: float = 400/512
@@ -31,6 +62,8 @@ def add_scale(array: np.ndarray,
         cv2.line and cv2.putText
     fontScale: float
         default 0.3. passed as `fontScale` to cv2.putText. See notes.
+    inplace: bool
+        whether to annotate array itself rather than a copy
 
     Returns
     -------
@@ -40,7 +73,7 @@ def add_scale(array: np.ndarray,
     Raises
     ------
     NotImplementedError
-        if array is not a 2D uint8 np.ndarry
+        if array is not a 2D or 3D uint8 np.ndarry
 
     Notes
     -----
@@ -64,21 +97,20 @@ def add_scale(array: np.ndarray,
     are (0.3, 7), (0.7, 16), (1.0, 22)
 
     """
-    if (array.ndim != 2) | (array.dtype != 'uint8'):
+    if (array.ndim not in [2, 3]) | (array.dtype != 'uint8'):
         raise NotImplementedError(
-            "add_scale() only works for 2D arrays of type uint8. "
+            "add_scale() only works for 2D or 3D arrays of type uint8. "
             f"provided array is {array.ndim}D and type {array.dtype}.")
 
-    annotated = np.copy(array)
-    length = np.round(scale_size_um / um_per_pixel).astype('int')
-    thickness = np.round(thickness_um / um_per_pixel).astype('int')
-    pt1 = (scale_position[0], scale_position[1] - length + 1)
-    pt2 = (scale_position[0] + length - 1, scale_position[1])
-    font = cv2.FONT_HERSHEY_SIMPLEX
-    linetype = cv2.LINE_4
-    cv2.putText(
-            annotated, f"{int(scale_size_um)}um", pt2,
-            font, fontScale, color, thickness, linetype)
-    cv2.line(annotated, scale_position, pt1, color, thickness, linetype)
-    cv2.line(annotated, scale_position, pt2, color, thickness, linetype)
+    annotated = array if inplace else np.copy(array)
+    length = int(np.round(scale_size_um / um_per_pixel))
+    thickness = int(np.round(thickness_um / um_per_pixel))
+    rows, cols = scale_pixels(
+            tuple(array.shape[-2:]),
+            tuple(int(i) for i in scale_position),
+            length,
+            thickness,
+            f"{int(scale_size_um)}um",
+            fontScale)
+    annotated[..., rows, cols] = color
     return annotated
@@ -0,0 +1,181 @@
+import contextlib
+import cProfile
+import json
+import resource
+import sys
+import time
+from pathlib import Path
+from typing import Dict, Generator, List, Optional, Tuple, Union
+
+
+def peak_rss_bytes(who: int = resource.RUSAGE_SELF) -> int:
+    """peak resident set size of this process (RUSAGE_SELF) or of its
+    largest waited-for child process (RUSAGE_CHILDREN), in bytes"""
+    maxrss = resource.getrusage(who).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def cpu_seconds() -> float:
+    """CPU time of this process, all threads, and of its waited-for
+    child processes"""
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+def io_bytes() -> Tuple[Optional[int], Optional[int]]:
+    """bytes read and written by this process through read and write
+    calls, including pipes to encoders. (None, None) where
+    /proc/self/io is not available.
+    """
+    try:
+        with open("/proc/self/io", "r") as f:
+            counters = dict(line.split(": ") for line in f.read().split("\n")
+                            if line)
+    except OSError:
+        return None, None
+    return int(counters['rchar']), int(counters['wchar'])
+
+
+@contextlib.contextmanager
+def timed(timings: Optional[Dict[str, float]],
+          name: str) -> Generator[None, None, None]:
+    """adds the wall time of the block to timings[name]. Does nothing if
+    timings is None."""
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + \
+            time.perf_counter() - start
+
+
+class PipelineReport:
+    """Records where a pipeline run spends its time and memory.
+
+    Each stage records its wall and CPU time, and the bytes read and
+    written during it. CPU time includes worker processes once they have
+    exited. The process keeps a single peak resident set size, so a stage
+    only records the peak so far at its end, which may have been reached
+    by an earlier stage. The run's peak is in the summary. Per-ROI timings, as
+    filled by timed(), are recorded separately and summarized.
+
+    Example
+    -------
+    >>> report = PipelineReport()
+    >>> with report.stage("projections"):
+    ...     avg_projection = video.mean(axis=0)
+    >>> report.add_roi(roi.roi_id, roi.experiment_id, {"png": 0.01})
+    >>> report.write("pipeline_report.json")
+
+    """
+
+    def __init__(self):
+        self.stages: List[dict] = []
+        self.rois: List[dict] = []
+        self.counters: Dict[str, dict] = {}
+        self._start = time.perf_counter()
+        self._start_cpu = cpu_seconds()
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Generator[None, None, None]:
+        """record the resources used by the block as stage name"""
+        wall = time.perf_counter()
+        cpu = cpu_seconds()
+        read, written = io_bytes()
+        try:
+            yield
+        finally:
+            end_read, end_written = io_bytes()
+            self.stages.append({
+                "name": name,
+                "wall_s": time.perf_counter() - wall,
+                "cpu_s": cpu_seconds() - cpu,
+                "peak_rss_so_far_bytes": peak_rss_bytes(),
+                "read_bytes": None if read is None else end_read - read,
+                "write_bytes": (None if written is None
+                                else end_written - written)})
+
+    def add_roi(self, roi_id: int, experiment_id: int,
+                timings: Dict[str, float]):
+        """record the step timings, in seconds, of one ROI"""
+        self.rois.append({"roi_id": int(roi_id),
+                          "experiment_id": int(experiment_id),
+                          **timings})
+
+    def add_counters(self, name: str, counters: dict):
+        """record other json-serializable statistics of the run, for
+        example of the files written"""
+        self.counters[name] = counters
+
+    def summary(self) -> dict:
+        """the report as a json-serializable dict"""
+        steps = sorted({k for roi in self.rois for k in roi}
+                       - {"roi_id", "experiment_id"})
+        roi_summary = {}
+        for step in steps:
+            values = [roi[step] for roi in self.rois if step in roi]
+            roi_summary[step] = {"total_s": sum(values),
+                                 "mean_s": sum(values) / len(values),
+                                 "max_s": max(values)}
+        return {
+            "wall_s": time.perf_counter() - self._start,
+            "cpu_s": cpu_seconds() - self._start_cpu,
+            "peak_rss_bytes": peak_rss_bytes(),
+            "peak_rss_children_bytes": peak_rss_bytes(
+                resource.RUSAGE_CHILDREN),
+            "stages": self.stages,
+            "counters": self.counters,
+            "roi_summary": roi_summary,
+            "rois": self.rois}
+
+    def write(self, path: Union[str, Path]):
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+
+@contextlib.contextmanager
+def profiled(profiler: Optional[str],
+             path: Union[str, Path]) -> Generator[None, None, None]:
+    """profile the block, writing the profile to path
+
+    Parameters
+    ----------
+    profiler: str
+        'cProfile' writes pstats data, 'pyinstrument' writes an html
+        page. pyinstrument is not a requirement and must be installed.
+        If None, the block is not profiled.
+    path: str or Path
+        destination of the profile
+
+    """
+    if profiler is None:
+        yield
+        return
+    if profiler == "cProfile":
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(str(path))
+    elif profiler == "pyinstrument":
+        try:
+            import pyinstrument
+        except ImportError as e:
+            raise ImportError("profiler 'pyinstrument' needs the "
+                              "pyinstrument package installed") from e
+        profile = pyinstrument.Profiler()
+        profile.start()
+        try:
+            yield
+        finally:
+            profile.stop()
+            with open(path, "w") as f:
+                f.write(profile.output_html())
+    else:
+        raise ValueError(f"profiler '{profiler}' not defined")
@@ -0,0 +1,105 @@
+from pathlib import Path
+from typing import Dict, Iterable, List, Union
+
+import h5py
+import numpy as np
+
+
+class TraceStore:
+    """Read access to the traces of an h5 file with a 'roi_names' dataset
+    of ROI ids and a 'data' dataset with one trace per row, in the same
+    order. The file is opened and the id to row index built once, instead
+    of once per ROI.
+
+    Parameters
+    ----------
+    h5_path: str or Path
+        path to the traces h5 file
+
+    Example
+    -------
+    >>> with TraceStore(traces_h5_path) as store:
+    ...     traces = store.get_many([3, 1, 2])
+
+    """
+
+    def __init__(self, h5_path: Union[str, Path]):
+        self.h5_path = h5_path
+        self._file = h5py.File(h5_path, 'r')
+        try:
+            self._data = self._file['data']
+            self._rows: Dict[int, int] = {}
+            roi_names = self._file['roi_names'][()].astype(int)
+        except BaseException:
+            # __exit__ is not called when __init__ raises
+            self._file.close()
+            raise
+        for row, roi_id in enumerate(roi_names):
+            # repeated names resolve to their first row
+            self._rows.setdefault(int(roi_id), row)
+
+    @property
+    def roi_ids(self) -> List[int]:
+        """the ROI ids with a trace, in file order"""
+        return list(self._rows.keys())
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __contains__(self, roi_id: int) -> bool:
+        return int(roi_id) in self._rows
+
+    def row(self, roi_id: int) -> int:
+        """the row of the trace of roi_id in the 'data' dataset
+
+        Raises
+        ------
+        KeyError
+            if there is no trace for roi_id
+
+        """
+        try:
+            return self._rows[int(roi_id)]
+        except KeyError:
+            raise KeyError(f"no trace for roi id {roi_id} in {self.h5_path}")
+
+    def get(self, roi_id: int) -> np.ndarray:
+        """the trace of one ROI"""
+        return self._data[self.row(roi_id)]
+
+    def get_many(self, roi_ids: Iterable[int]) -> np.ndarray:
+        """the traces of several ROIs, read with a single sorted
+        fancy-index read of the 'data' dataset
+
+        Parameters
+        ----------
+        roi_ids: Iterable[int]
+            ROI ids, in any order, repeats allowed
+
+        Returns
+        -------
+        traces: numpy.ndarray
+            traces[i] is the trace of roi_ids[i]
+
+        Raises
+        ------
+        KeyError
+            if there is no trace for one of roi_ids
+
+        """
+        rows = np.array([self.row(i) for i in roi_ids], dtype=int)
+        if rows.size == 0:
+            return np.empty((0, *self._data.shape[1:]),
+                            dtype=self._data.dtype)
+        # h5py requires increasing, unique indices
+        unique_rows, inverse = np.unique(rows, return_inverse=True)
+        return self._data[unique_rows][inverse]
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
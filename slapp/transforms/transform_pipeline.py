@@ -1,32 +1,43 @@
+import contextlib
 import datetime
 import h5py
+import hashlib
 import json
 import jsonlines
 import multiprocessing
 import os
+import tempfile
+from functools import partial
 from pathlib import Path
-from typing import List, Tuple
+from typing import (Dict, Generator, Iterable, List, Optional, Tuple,
+                    Union)
 
 import argschema
-import imageio
 import marshmallow as mm
 import matplotlib.pyplot as plt
 import numpy as np
 
 import slapp.utils.query_utils as query_utils
-from slapp.rois import ROI, coo_from_lims_style
-from slapp.transforms.video_utils import (downsample_h5_video,
-                                          transform_to_webm)
+from slapp.rois import ROI, ROISet, coo_from_lims_style
+from slapp.transforms.video_utils import (H5FrameReader,
+                                          WebmEncoder,
+                                          downsample_h5_video,
+                                          encode_crops,
+                                          encode_video_chunks,
+                                          h5_video_chunks)
 from slapp.transforms.array_utils import (
-        content_extents, downsample_array, normalize_array)
+        PaddedArray, batch_content_extents, content_extents,
+        downsample_array, normalize_array, projections_from_chunks)
+from slapp.transforms.trace_utils import TraceStore
+from slapp.transforms.video_cache import VideoCache, VideoCacheEntry
 from slapp.transforms.image_utils import (
     add_scale)
+from slapp.transforms.instrumentation import PipelineReport, profiled, timed
+from slapp.transforms.artifact_writer import (AtlasWriter, H5ArtifactWriter,
+                                              PngWriter, TileBuffer)
 
 
-insert_str_template = (
-        "INSERT INTO roi_manifests "
-        "(manifest, transform_hash, roi_id) "
-        "VALUES ('{}', '{}', {})")
+roi_manifests_columns = ["manifest", "transform_hash", "roi_id"]
 
 
 class TransformPipelineException(Exception):
@@ -129,6 +140,37 @@ class TransformPipelineSchema(argschema.ArgSchema):
                      "A value of -1 results in "
                      "using multiprocessing.cpu_count()")
     )
+    webm_min_segment_frames = argschema.fields.Int(
+        required=False,
+        default=500,
+        description=("videos are split into segments of at least this "
+                     "many frames for parallel encoding. Shorter videos, "
+                     "like most ROI sub-videos, are encoded as a single "
+                     "segment.")
+    )
+    sub_video_batch_size = argschema.fields.Int(
+        required=False,
+        default=0,
+        validator=mm.validate.Range(min=0),
+        description=("if > 0, encode the ROI sub-videos by iterating over "
+                     "the movie frames once per batch of this many ROIs, "
+                     "feeding each ROI window to its own concurrent ffmpeg "
+                     "writer. 0 encodes each sub-video separately.")
+    )
+    insert_batch_size = argschema.fields.Int(
+        required=False,
+        default=1000,
+        validator=mm.validate.Range(min=1),
+        description=("number of roi_manifests rows inserted per statement "
+                     "when no output_manifest is given"))
+    roi_parallelization = argschema.fields.Int(
+        required=False,
+        default=1,
+        description=("Number of parallel processes to use for creating "
+                     "the per-ROI artifacts. The workers memory-map the "
+                     "normalized video and projections. A value of -1 "
+                     "results in using multiprocessing.cpu_count()")
+    )
     scale_offset = argschema.fields.Int(
         required=False,
         default=3,
@@ -173,6 +215,126 @@ class TransformPipelineSchema(argschema.ArgSchema):
     downsample_video = argschema.fields.Boolean(
         default=False, description='Whether to downsample video'
     )
+    streaming = argschema.fields.Bool(
+        required=False,
+        default=False,
+        description=("read, project, normalize and encode the movie in "
+                     "chunks of frames, rather than loading it into memory. "
+                     "The normalized movie, needed for the ROI sub-videos, "
+                     "is kept in a temporary memory-mapped file."))
+    chunk_size = argschema.fields.Int(
+        required=False,
+        default=1000,
+        validator=mm.validate.Range(min=1),
+        description=("number of input movie frames read at once. In "
+                     "streaming mode, bounds peak memory."))
+    prefetch_chunks = argschema.fields.Int(
+        required=False,
+        default=2,
+        validator=mm.validate.Range(min=0),
+        description=("number of chunks of movie frames read ahead on a "
+                     "background thread while the current chunk is "
+                     "processed. 0 reads synchronously."))
+    png_writers = argschema.fields.Int(
+        required=False,
+        default=4,
+        validator=mm.validate.Range(min=0),
+        description=("number of threads writing the png artifacts while "
+                     "the next ones are made, per ROI worker process. 0 "
+                     "writes them synchronously."))
+    png_compression = argschema.fields.Int(
+        required=False,
+        default=9,
+        validator=mm.validate.Range(min=0, max=9),
+        description=("zlib compression level of the png artifacts, 0 "
+                     "(fastest) to 9 (smallest). Does not change the "
+                     "images."))
+    artifact_format = argschema.fields.Str(
+        required=False,
+        default='png',
+        validator=mm.validate.OneOf(['png', 'atlas', 'hdf5']),
+        description=("'png' writes one png per per-ROI image. 'atlas' packs "
+                     "the images of the crop shape (mask, outline and "
+                     "projections) into a few large pngs per kind, "
+                     "<kind>_atlas_<n>.png, indexed by atlas_index.json; "
+                     "the manifest then references tiles as "
+                     "<sheet>#xywh=x,y,width,height. Full-frame outlines, "
+                     "videos and traces are unchanged. 'hdf5' stores the "
+                     "per-ROI images and traces, in ROI order, in "
+                     "chunked, compressed datasets of a single "
+                     "roi_artifacts.h5 per experiment, referenced as "
+                     "roi_artifacts.h5#<kind>/<index>; videos are "
+                     "unchanged."))
+    atlas_columns = argschema.fields.Int(
+        required=False,
+        default=32,
+        validator=mm.validate.Range(min=1),
+        description="tiles per row of an atlas sheet")
+    atlas_tiles_per_sheet = argschema.fields.Int(
+        required=False,
+        default=1024,
+        validator=mm.validate.Range(min=1),
+        description=("maximum tiles per atlas sheet, a multiple of "
+                     "atlas_columns"))
+    hdf5_chunk_rois = argschema.fields.Int(
+        required=False,
+        default=64,
+        validator=mm.validate.Range(min=1),
+        description=("ROIs per chunk of the roi_artifacts.h5 datasets, the "
+                     "unit in which they are compressed and read"))
+    hdf5_compression = argschema.fields.Int(
+        required=False,
+        default=4,
+        validator=mm.validate.Range(min=0, max=9),
+        description=("gzip level of the roi_artifacts.h5 datasets, 0 for "
+                     "none"))
+    db_pool_size = argschema.fields.Int(
+        required=False,
+        default=1,
+        validator=mm.validate.Range(min=0),
+        description=("number of connections to each database opened by "
+                     "this run and reused for its queries. 0 opens a new "
+                     "connection per query."))
+    write_report = argschema.fields.Bool(
+        required=False,
+        default=False,
+        description=("write a json report of the wall and CPU time and "
+                     "bytes read and written of each pipeline stage, the "
+                     "peak memory of the run, and the steps of each ROI, "
+                     "next to "
+                     "output_manifest (or in artifact_basedir when writing "
+                     "to the database) as <manifest name>_report.json"))
+    profiler = argschema.fields.Str(
+        required=False,
+        default=None,
+        allow_none=True,
+        validator=mm.validate.OneOf(['cProfile', 'pyinstrument']),
+        description=("profile the run with cProfile (pstats data in "
+                     "<manifest name>_profile.prof) or pyinstrument (which "
+                     "must be installed, html in "
+                     "<manifest name>_profile.html)"))
+    artifact_cache = argschema.fields.Bool(
+        required=False,
+        default=False,
+        description=("skip making the artifacts of ROIs whose artifacts in "
+                     "artifact_basedir were made from the same ROI, source "
+                     "movie and args. The numbers of hits and misses are "
+                     "logged and counted in the run report."))
+    video_cache_dir = argschema.fields.Str(
+        required=False,
+        default=None,
+        allow_none=True,
+        description=("if provided, the normalized movie and projections "
+                     "are cached in this directory, keyed by the movie "
+                     "file and the downsampling and normalization args. "
+                     "Later runs with the same movie and args memory-map "
+                     "the cached movie instead of recomputing it."))
+    video_cache_max_gb = argschema.fields.Float(
+        required=False,
+        default=100.0,
+        validator=mm.validate.Range(min=0),
+        description=("size limit of video_cache_dir. The least recently "
+                     "used entries are removed to stay under it."))
 
     @mm.pre_load
     def set_segmentation_run_id(self, data, **kwargs):
@@ -195,13 +357,15 @@ class TransformPipelineSchema(argschema.ArgSchema):
             db_credentials = query_utils.get_db_credentials(
                     env_prefix="LABELING_",
                     **query_utils.label_defaults)
-            db_connection = query_utils.DbConnection(**db_credentials)
             query_string = (
                 "SELECT id FROM segmentation_runs WHERE "
                 f"ophys_experiment_id={data['ophys_experiment_id']} AND "
                 "ophys_segmentation_commit_hash="
                 f"'{data['ophys_segmentation_commit_hash']}'")
-            entries = db_connection.query(query_string)
+            pool_size = int(data.get('db_pool_size', 1))
+            with query_utils.DbConnection(
+                    **db_credentials, pool_size=pool_size) as db_connection:
+                entries = db_connection.query(query_string)
             if len(entries) != 1:
                 raise TransformPipelineException(
                     f"{query_string} did not return exactly 1 result")
@@ -214,22 +378,38 @@ class TransformPipelineSchema(argschema.ArgSchema):
             data["webm_parallelization"] = multiprocessing.cpu_count()
         return data
 
+    @mm.validates_schema
+    def validate_artifact_format(self, data, **kwargs):
+        if data.get('artifact_format', 'png') == 'png':
+            return
+        if (data['artifact_format'] == 'atlas') & \
+                (data['atlas_tiles_per_sheet'] % data['atlas_columns'] != 0):
+            raise mm.ValidationError(
+                "atlas_tiles_per_sheet must be a multiple of atlas_columns")
+        if data['artifact_cache']:
+            raise mm.ValidationError(
+                "artifact_cache is only supported with artifact_format "
+                "'png', as atlas sheets and hdf5 files are written whole")
 
-def xform_from_slapp_db(db_conn: query_utils.DbConnection,
-                        segmentation_run_id: int) -> Tuple[List[ROI], Path]:
+    @mm.post_load
+    def set_roi_parallelization(self, data, **kwargs):
+        if data["roi_parallelization"] == -1:
+            data["roi_parallelization"] = multiprocessing.cpu_count()
+        return data
 
-    # get all ROI ids from this segmentation run
-    query_string = ("SELECT id FROM rois WHERE segmentation_run_id="
-                    f"{segmentation_run_id}")
-    entries = db_conn.query(query_string)
-    roi_ids = [i['id'] for i in entries]
 
-    rois = [ROI.roi_from_query(roi_id, db_conn) for roi_id in roi_ids]
+def xform_from_slapp_db(db_conn: query_utils.DbConnection,
+                        segmentation_run_id: int) -> Tuple[ROISet, Path]:
 
     query_string = ("SELECT * FROM segmentation_runs "
                     f"WHERE id={segmentation_run_id}")
     seg_query = db_conn.query(query_string)[0]
 
+    # all ROIs from this segmentation run, in one query, as from
+    # xform_from_prod_manifest()
+    rois = ROISet.from_segmentation_run(segmentation_run_id, db_conn,
+                                        segmentation_run=seg_query)
+
     return (rois, Path(seg_query['source_video_path']))
 
 
@@ -258,8 +438,29 @@ class ProdSegmentationRunManifestSchema(mm.Schema):
 
 
 def xform_from_prod_manifest(prod_manifest_path: str,
-                             all_ROIs: bool,
-                             include_trace=True) -> Tuple[List[ROI], Path]:
+                             all_ROIs: bool = False,
+                             include_trace=True) -> Tuple[ROISet, Path]:
+    """ROIs of a production segmentation run
+
+    Parameters
+    ----------
+    prod_manifest_path: str
+        path to a json manifest, see ProdSegmentationRunManifestSchema
+    all_ROIs: bool
+        if False, the default as for TransformPipelineSchema, only the
+        ROIs of local_to_global_roi_id_map, with their global ids. If
+        True, all the ROIs, with their local ids.
+    include_trace: bool
+        whether to read the traces of the ROIs from traces_h5_path
+
+    Returns
+    -------
+    rois: ROISet
+        the ROIs
+    movie_path: Path
+        the source movie of the run
+
+    """
     with open(prod_manifest_path, 'r') as f:
         prod_manifest = json.load(f)
     prod_manifest = ProdSegmentationRunManifestSchema().load(prod_manifest)
@@ -268,229 +469,959 @@ def xform_from_prod_manifest(prod_manifest_path: str,
         id_map = {roi['id']: roi['id']
                   for roi in prod_manifest['binarized_rois']}
 
-    rois = []
-    for roi in prod_manifest['binarized_rois']:
-        if roi['id'] not in id_map:
-            # only make manifests for listed ROIs
-            continue
+    # only make manifests for listed ROIs
+    selected = [roi for roi in prod_manifest['binarized_rois']
+                if roi['id'] in id_map]
+
+    if include_trace:
+        with TraceStore(prod_manifest['traces_h5_path']) as store:
+            traces = store.get_many([roi['id'] for roi in selected])
+    else:
+        traces = None
 
-        roi_stamp = coo_from_lims_style(
+    stamps = [coo_from_lims_style(
                 mask_matrix=roi['mask_matrix'],
                 xoffset=roi['x'],
-                yoffset=roi['y'],
-                shape=prod_manifest['movie_frame_shape'])
-        converted_roi_id = id_map[roi['id']]
-
-        if include_trace:
-            with h5py.File(prod_manifest['traces_h5_path'], 'r') as h5f:
-                traces_id_order = list(h5f['roi_names'][:].astype(int))
-                roi_trace = h5f['data'][traces_id_order.index(roi['id'])]
-        else:
-            roi_trace = None
-
-        converted_roi = ROI(coo_rows=roi_stamp.row,
-                            coo_cols=roi_stamp.col,
-                            coo_data=roi_stamp.data.astype('uint8'),
-                            image_shape=prod_manifest['movie_frame_shape'],
-                            experiment_id=prod_manifest['experiment_id'],
-                            roi_id=converted_roi_id,
-                            trace=roi_trace,
-                            is_binary=True)
-        rois.append(converted_roi)
+                yoffset=roi['y'])
+              for roi in selected]
+    for stamp in stamps:
+        stamp.data = stamp.data.astype('uint8')
+    rois = ROISet.from_coo_matrices(
+            stamps,
+            image_shape=prod_manifest['movie_frame_shape'],
+            experiment_ids=np.full(len(selected),
+                                   prod_manifest['experiment_id']),
+            roi_ids=np.array([id_map[roi['id']] for roi in selected],
+                             dtype=int),
+            traces=traces,
+            is_binary=True)
 
     return rois, Path(prod_manifest['movie_path'])
 
 
+# args, other than the source movie, which change the per-ROI artifacts
+artifact_cache_params = [
+        'cropped_shape', 'quantile', 'input_fps', 'output_fps',
+        'playback_factor', 'downsampling_strategy', 'random_seed',
+        'webm_bitrate', 'webm_quality', 'scale_offset', 'full_scale_offset',
+        'scale_size_um', 'full_scale_size_um', 'um_per_pixel',
+        'skip_movies', 'skip_traces']
+
+# per-ROI artifacts of the crop shape, packed into sheets in 'atlas' format
+atlas_artifacts = ['mask', 'outline', 'max', 'avg', 'corr']
+# manifest entries referencing them
+atlas_manifest_keys = ['source-ref', 'roi-mask-source-ref', 'max-source-ref',
+                       'avg-source-ref']
+# per-ROI artifacts stored in roi_artifacts.h5 in 'hdf5' format
+hdf5_artifacts = ['mask', 'outline', 'full_outline', 'max', 'avg', 'corr',
+                  'trace']
+# manifest entries referencing them, the trace only without skip_movies
+hdf5_manifest_keys = atlas_manifest_keys + ['full-outline-source-ref',
+                                            'trace-source-ref']
+
+# args which change the cached normalized movie and projections
+video_cache_params = [
+        'downsample_video', 'input_fps', 'output_fps',
+        'downsampling_strategy', 'random_seed', 'movie_lower_quantile',
+        'movie_upper_quantile', 'projection_lower_quantile',
+        'projection_upper_quantile']
+
+
+def normalized_chunks(
+        chunks: Iterable[np.ndarray], out: np.ndarray, lower_cutoff: float,
+        upper_cutoff: float) -> Generator[np.ndarray, None, None]:
+    """normalize consecutive chunks of a video into a preallocated array
+
+    Parameters
+    ----------
+    chunks: iterable of numpy.ndarray
+        consecutive chunks of frames
+    out: numpy.ndarray
+        uint8 destination for the whole normalized video, for example
+        a numpy.memmap
+    lower_cutoff: float
+        passed to normalize_array()
+    upper_cutoff: float
+        passed to normalize_array()
+
+    Yields
+    ------
+    normalized: numpy.ndarray
+        the slice of out holding the normalized chunk
+
+    """
+    start = 0
+    for chunk in chunks:
+        end = start + chunk.shape[0]
+        normalize_array(chunk, lower_cutoff, upper_cutoff,
+                        out=out[start:end])
+        yield out[start:end]
+        start = end
+
+
+def roi_artifacts(roi: ROI,
+                  video: Optional[Union[np.ndarray, PaddedArray]],
+                  max_projection: Union[np.ndarray, PaddedArray],
+                  avg_projection: Union[np.ndarray, PaddedArray],
+                  correlation_projection: Union[np.ndarray, PaddedArray],
+                  output_dir: Path,
+                  args: dict, playback_fps: float,
+                  encoder: Optional[WebmEncoder],
+                  full_video_path: Optional[Path] = None,
+                  extents: Optional[Tuple] = None,
+                  timings: Optional[Dict[str, float]] = None,
+                  full_outline_template: Optional[np.ndarray] = None,
+                  writer: Optional[PngWriter] = None) -> dict:
+    """create the artifacts for one ROI and return its manifest entry
+
+    Parameters
+    ----------
+    roi: ROI
+        the ROI
+    video: numpy.ndarray or PaddedArray
+        normalized uint8 video (time, row, col). Can be None when
+        args['skip_movies'] is True or encoder is None
+    max_projection: numpy.ndarray or PaddedArray
+        normalized uint8 maximum projection
+    avg_projection: numpy.ndarray or PaddedArray
+        normalized uint8 average projection
+    correlation_projection: numpy.ndarray or PaddedArray
+        correlation projection
+    output_dir: pathlib.Path
+        destination directory for the artifacts
+    args: dict
+        validated TransformPipelineSchema arguments
+    playback_fps: float
+        frames per second of the encoded sub-video and trace
+    encoder: WebmEncoder
+        the sub-video is submitted to this encoder. If None, the
+        sub-video is not encoded here, for example because it is
+        encoded by encode_crops().
+    full_video_path: pathlib.Path
+        path to the experiment-level video, referenced by the manifest
+    extents: tuple
+        (indexing_bounds, pad_width) of the window around the ROI, as
+        returned by content_extents(). If None, computed from the ROI.
+    timings: dict
+        if provided, the seconds spent in each step are added to it
+    full_outline_template: numpy.ndarray
+        as returned by full_outline_template(), shared by the ROIs of an
+        experiment. If None, made here.
+    writer: PngWriter
+        writes the pngs. The files may not exist until it is flushed.
+        If None, they are written before returning.
+
+    Returns
+    -------
+    manifest: dict
+        manifest entry for this ROI
+
+    """
+    # unpadded arrays are wrapped without copying, and their windows
+    # are padded copies
+    video, max_projection, avg_projection, correlation_projection = [
+            i if (i is None) or isinstance(i, PaddedArray)
+            else PaddedArray.from_padded(i, (0, 0))
+            for i in [video, max_projection, avg_projection,
+                      correlation_projection]]
+
+    if writer is None:
+        writer = PngWriter(max_workers=0, compression=args['png_compression'])
+
+    # where to position the scale for the outline
+    scale_position = (
+            args['scale_offset'],
+            args['cropped_shape'][1] - args['scale_offset'])
+    if full_outline_template is None:
+        full_outline_template = full_outline_template_from_args(
+                max_projection.shape, args)
+
+    # mask and outline from ROI class
+    paths = roi_artifact_paths(roi, output_dir)
+    mask_path = paths['mask']
+    outline_path = paths['outline']
+    full_outline_path = paths['full_outline']
+    sub_video_path = paths['video']
+    max_proj_path = paths['max']
+    avg_proj_path = paths['avg']
+    corr_proj_path = paths['corr']
+    trace_path = paths['trace']
+
+    with timed(timings, 'outline'):
+        mask = roi.generate_ROI_mask(
+                shape=args['cropped_shape'])
+        mask = np.uint8(mask * 255 / mask.max())
+        outline = roi.generate_ROI_outline(
+            shape=args['cropped_shape'],
+            quantile=args['quantile'])
+        # the full-frame scale is already in the template
+        full_outline = roi.generate_full_outline(
+            full_outline_template,
+            quantile=args['quantile'])
+
+    with timed(timings, 'png'):
+        writer.submit(mask_path, mask, transparency=0)
+
+    with timed(timings, 'scale'):
+        outline = add_scale(
+                outline,
+                scale_position,
+                args['um_per_pixel'],
+                args['scale_size_um'],
+                color=0,
+                fontScale=0.3,
+                inplace=True)
+
+    with timed(timings, 'png'):
+        writer.submit(outline_path, outline, transparency=255)
+        writer.submit(full_outline_path, full_outline, transparency=255)
+
+    # video sub-frame
+    if extents is None:
+        extents = content_extents(
+                roi._sparse_coo,
+                shape=args['cropped_shape'],
+                target_shape=avg_projection.shape)
+    inds, pads = extents
+    if (not args['skip_movies']) & (encoder is not None):
+        with timed(timings, 'sub_video'):
+            sub_video = video.window(inds, pads)
+            encoder.submit(sub_video, sub_video_path, playback_fps)
+
+    # sub-projections
+    with timed(timings, 'png'):
+        sub_max = max_projection.window(inds, pads)
+        sub_ave = avg_projection.window(inds, pads)
+        sub_corr = correlation_projection.window(inds, pads)
+        writer.submit(max_proj_path, sub_max)
+        writer.submit(avg_proj_path, sub_ave)
+        writer.submit(corr_proj_path, sub_corr)
+
+    if not args['skip_movies']:
+        # trace
+        with timed(timings, 'trace'):
+            trace = downsample_array(
+                    np.array(roi.trace),
+                    args['input_fps'],
+                    args['output_fps'],
+                    args['downsampling_strategy'],
+                    args['random_seed']).tolist()
+            trace_json = {
+                    "pointStart": 0,
+                    "pointInterval": 1.0 / playback_fps,
+                    "dataLength": len(trace),
+                    "trace": trace}
+            writer.submit_json(trace_path, trace_json)
+
+    return roi_manifest(roi, output_dir, args, full_video_path)
+
+
+def full_outline_template_from_args(frame_shape: Tuple[int, int],
+                                    args: dict) -> np.ndarray:
+    """white full frame with the scale of the full-frame outlines, onto
+    which each ROI's outline is drawn
+
+    Parameters
+    ----------
+    frame_shape: tuple(int, int)
+        shape of the movie frames
+    args: dict
+        validated TransformPipelineSchema arguments
+
+    Returns
+    -------
+    template: numpy.ndarray
+        uint8 image of shape frame_shape
+
+    """
+    full_scale_position = (
+            args['full_scale_offset'],
+            frame_shape[1] - args['full_scale_offset'])
+    return add_scale(
+            np.full(frame_shape, 255, dtype='uint8'),
+            full_scale_position,
+            args['um_per_pixel'],
+            args['full_scale_size_um'],
+            color=0,
+            thickness_um=1.5,
+            fontScale=0.8)
+
+
+def roi_artifact_paths(roi: ROI, output_dir: Path) -> Dict[str, Path]:
+    """paths of the per-ROI artifacts, by artifact name"""
+    roi_id = f'{roi.experiment_id}_{roi.roi_id}'
+    return {
+            'mask': output_dir / f"mask_{roi_id}.png",
+            'outline': output_dir / f"outline_{roi_id}.png",
+            'full_outline': output_dir / f"full_outline_{roi_id}.png",
+            'video': output_dir / f"video_{roi_id}.webm",
+            'max': output_dir / f"max_{roi_id}.png",
+            'avg': output_dir / f"avg_{roi_id}.png",
+            'corr': output_dir / f"corr_{roi_id}.png",
+            'trace': output_dir / f"trace_{roi_id}.json"}
+
+
+def roi_manifest(roi: ROI, output_dir: Path, args: dict,
+                 full_video_path: Optional[Path] = None) -> dict:
+    """the manifest entry of an ROI, referencing its artifacts"""
+    paths = roi_artifact_paths(roi, output_dir)
+    manifest = {}
+    manifest['experiment-id'] = roi.experiment_id
+    manifest['roi-id'] = roi.roi_id
+    manifest['source-ref'] = str(paths['outline'])
+    manifest['roi-mask-source-ref'] = str(paths['mask'])
+    manifest['max-source-ref'] = str(paths['max'])
+    manifest['avg-source-ref'] = str(paths['avg'])
+    manifest['full-outline-source-ref'] = str(paths['full_outline'])
+    if not args['skip_movies']:
+        manifest['trace-source-ref'] = str(paths['trace'])
+        manifest['full-video-source-ref'] = str(full_video_path)
+        manifest['video-source-ref'] = str(paths['video'])
+
+    return manifest
+
+
+def roi_artifact_key(roi: ROI, extents: Tuple, fingerprint: str,
+                     args: dict) -> str:
+    """content hash of everything the artifacts of an ROI are made from
+
+    Parameters
+    ----------
+    roi: ROI
+        the ROI. Its ids, pixels and trace are hashed.
+    extents: tuple
+        (indexing_bounds, pad_width) of the window around the ROI
+    fingerprint: str
+        identifies the source movie and projections, for example as
+        returned by VideoCache.key()
+    args: dict
+        validated TransformPipelineSchema arguments. Only the
+        artifact_cache_params are hashed.
+
+    Returns
+    -------
+    key: str
+        hex digest which changes if any of the inputs change
+
+    """
+    h = hashlib.sha256()
+    h.update(json.dumps({
+        'experiment_id': int(roi.experiment_id),
+        'roi_id': int(roi.roi_id),
+        'fingerprint': fingerprint,
+        'extents': np.asarray(extents[0]).tolist() +
+        np.asarray(extents[1]).ravel().tolist(),
+        'args': {k: args[k] for k in artifact_cache_params}},
+        sort_keys=True).encode())
+    coo = roi._sparse_coo
+    for values in [coo.row, coo.col, coo.data]:
+        h.update(np.ascontiguousarray(values).tobytes())
+    if roi.trace is not None:
+        h.update(np.ascontiguousarray(roi.trace, dtype='float64').tobytes())
+    return h.hexdigest()
+
+
+def artifact_key_path(roi: ROI, output_dir: Path) -> Path:
+    """where the key of the artifacts of an ROI is recorded"""
+    return output_dir / f".artifact_key_{roi.experiment_id}_{roi.roi_id}"
+
+
+def artifact_cache_hit(roi: ROI, key: str, output_dir: Path,
+                       args: dict) -> bool:
+    """whether the artifacts of an ROI in output_dir were made from the
+    same inputs, and all still exist
+    """
+    key_path = artifact_key_path(roi, output_dir)
+    if not key_path.exists():
+        return False
+    with open(key_path, "r") as f:
+        if f.read() != key:
+            return False
+    paths = roi_artifact_paths(roi, output_dir)
+    names = ['mask', 'outline', 'full_outline', 'max', 'avg', 'corr']
+    if not args['skip_movies']:
+        names += ['video', 'trace']
+    return all(paths[name].exists() for name in names)
+
+
+def shared_npy(array: np.ndarray, path: Path) -> str:
+    """make an array available to other processes as a .npy file
+
+    Parameters
+    ----------
+    array: numpy.ndarray
+        the array to share. If it is already memory-mapped from a .npy
+        file, that file is used.
+    path: pathlib.Path
+        where to save the array, if needed. '.npy' is appended.
+
+    Returns
+    -------
+    path: str
+        path to a .npy file that can be opened with
+        numpy.load(path, mmap_mode='r')
+
+    """
+    if isinstance(array, np.memmap) and str(array.filename).endswith(".npy"):
+        array.flush()
+        return str(array.filename)
+    path = str(path) + ".npy"
+    np.save(path, array)
+    return path
+
+
+# per-process state for roi_parallelization workers
+_worker_state = {}
+
+
+def _init_roi_worker(shared_paths: dict, encode_sub_videos: bool,
+                     bitrate: str, crf: int,
+                     full_outline_template: np.ndarray,
+                     png_writers: int, png_compression: int):
+    for k, v in shared_paths.items():
+        _worker_state[k] = None
+        if v is not None:
+            path, margin = v
+            _worker_state[k] = PaddedArray.from_padded(
+                    np.load(path, mmap_mode='r'), margin)
+    # pool workers are daemonic and can not start their own encoding
+    # pool. A single-process encoder encodes as the jobs are submitted.
+    _worker_state['full_outline_template'] = full_outline_template
+    _worker_state['writer'] = PngWriter(max_workers=png_writers,
+                                        compression=png_compression)
+    _worker_state['encoder'] = None
+    if encode_sub_videos:
+        _worker_state['encoder'] = WebmEncoder(ncpu=1, bitrate=bitrate,
+                                               crf=crf)
+
+
+def _roi_worker(task: Tuple[ROI, tuple], roi_kwargs: dict,
+                packed_kinds: List[str]) -> Tuple[dict, dict, tuple]:
+    # task is an ROI and its window, as passed by Pool.imap(). The
+    # artifacts packed into atlases or the h5 file are returned to the
+    # main process
+    roi, extents = task
+    paths = roi_artifact_paths(roi, roi_kwargs['output_dir'])
+    tiles = TileBuffer([paths[k] for k in packed_kinds],
+                       _worker_state['writer'])
+    manifest, timings = timed_roi_artifacts(
+            roi, **{**_worker_state, 'writer': tiles}, extents=extents,
+            **roi_kwargs)
+    # the other artifacts exist once the manifest is returned
+    with timed(timings, 'png_wait'):
+        _worker_state['writer'].flush()
+    return manifest, timings, tiles.take()
+
+
+def timed_roi_artifacts(roi: ROI, **kwargs) -> Tuple[dict, dict]:
+    """roi_artifacts(), also returning the seconds spent in each of its
+    steps and in total"""
+    timings = {}
+    with timed(timings, 'total'):
+        manifest = roi_artifacts(roi, timings=timings, **kwargs)
+    return manifest, timings
+
+
 class TransformPipeline(argschema.ArgSchemaParser):
     default_schema = TransformPipelineSchema
 
-    def run(self):
-        self.timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+    def normalized_video(
+            self, video_path: Path, out_dir: Path,
+            full_video_path: Optional[Path], playback_fps: float,
+            margin: Tuple[int, int] = (0, 0),
+            report: Optional[PipelineReport] = None
+            ) -> Tuple[np.ndarray, np.ndarray, Optional[np.ndarray], dict]:
+        """read, project and normalize the movie, and in streaming mode
+        encode the experiment-level video. Otherwise the caller encodes
+        the returned video.
 
-        rois, video_path = xform_from_prod_manifest(
-            prod_manifest_path=self.args['prod_segmentation_run_manifest'],
-            all_ROIs=self.args['all_ROIs'],
-            include_trace=not self.args['skip_traces']
-        )
-        output_dir = Path(self.args['artifact_basedir'])
-        os.makedirs(output_dir, exist_ok=True)
+        Parameters
+        ----------
+        video_path: pathlib.Path
+            path to the source h5 movie
+        out_dir: pathlib.Path
+            in streaming mode, the normalized movie is written to
+            out_dir / VideoCacheEntry.video_name
+        full_video_path: pathlib.Path
+            destination of the full video. None if args['skip_movies']
+        playback_fps: float
+            frames per second of the full video
+        margin: tuple(int, int)
+            the movie is normalized into the interior of a zero-filled
+            buffer padded by margin, as PaddedArray.padded
+        report: PipelineReport
+            if provided, the stages are recorded in it
 
-        if self.args['downsample_video']:
-            video = downsample_h5_video(
+        Returns
+        -------
+        avg_projection: numpy.ndarray
+            normalized uint8 average projection
+        max_projection: numpy.ndarray
+            normalized uint8 maximum projection
+        video: numpy.ndarray
+            normalized uint8 movie, padded by margin, a numpy.memmap in
+            streaming mode. None if args['skip_movies']
+        cutoffs: dict
+            the normalization cutoffs of the movie and projections
+
+        """
+        if report is None:
+            report = PipelineReport()
+        if self.args['streaming']:
+            video_chunks = partial(
+                    h5_video_chunks,
                     video_path,
-                    self.args['input_fps'],
-                    self.args['output_fps'],
-                    self.args['downsampling_strategy'],
-                    self.args['random_seed'])
+                    chunk_size=self.args['chunk_size'],
+                    downsample=self.args['downsample_video'],
+                    input_fps=self.args['input_fps'],
+                    output_fps=self.args['output_fps'],
+                    strategy=self.args['downsampling_strategy'],
+                    random_seed=self.args['random_seed'],
+                    prefetch=self.args['prefetch_chunks'])
+            # reading and downsampling happen in the same pass
+            with report.stage('projections'):
+                avg_projection, max_projection, nframes = \
+                    projections_from_chunks(video_chunks())
         else:
-            with h5py.File(video_path, 'r') as h5f:
-                video = h5f['data'][:]
+            with report.stage('read_movie'):
+                if self.args['downsample_video']:
+                    video = downsample_h5_video(
+                            video_path,
+                            self.args['input_fps'],
+                            self.args['output_fps'],
+                            self.args['downsampling_strategy'],
+                            self.args['random_seed'],
+                            block_size=self.args['chunk_size'],
+                            prefetch=self.args['prefetch_chunks'])
+                else:
+                    video = H5FrameReader(
+                            video_path,
+                            block_size=self.args['chunk_size'],
+                            prefetch=self.args['prefetch_chunks']).read()
 
-        # strategy for normalization: normalize entire video and projections
-        # on quantiles of average projection before per-ROI processing
-        avg_projection = np.mean(video, axis=0)
-        max_projection = np.max(video, axis=0)
-        correlation_projection = plt.imread(self.args[
-                                                'correlation_projection_path'])
+            # strategy for normalization: normalize entire video and
+            # projections on quantiles of average projection before
+            # per-ROI processing
+            with report.stage('projections'):
+                avg_projection = np.mean(video, axis=0)
+                max_projection = np.max(video, axis=0)
+        if self.args['skip_movies']:
+            video = None
         movie_quantiles = [self.args['movie_lower_quantile'],
                            self.args['movie_upper_quantile']]
         proj_quantiles = [self.args['projection_lower_quantile'],
                           self.args['projection_upper_quantile']]
-        # normalize movie according to avg quantiles
-        lower_cutoff, upper_cutoff = np.quantile(
-                avg_projection.flatten(), movie_quantiles)
-        if not self.args['skip_movies']:
-            video = normalize_array(
-                    video, lower_cutoff, upper_cutoff)
-        # normalize avg projection
-        lower_cutoff, upper_cutoff = np.quantile(
-                avg_projection.flatten(), proj_quantiles)
-        avg_projection = normalize_array(
-                avg_projection, lower_cutoff, upper_cutoff)
-        # normalize max projection
-        lower_cutoff, upper_cutoff = np.quantile(
-                max_projection.flatten(), proj_quantiles)
-        max_projection = normalize_array(
-                max_projection, lower_cutoff, upper_cutoff)
-
-        playback_fps = self.args['output_fps'] * self.args['playback_factor']
+        with report.stage('normalize'):
+            # normalize movie according to avg quantiles
+            movie_lower_cutoff, movie_upper_cutoff = np.quantile(
+                    avg_projection.flatten(), movie_quantiles)
+            if self.args['streaming']:
+                if not self.args['skip_movies']:
+                    # the normalized movie is written to disk as it is
+                    # encoded, and memory-mapped for the ROI sub-videos
+                    video = np.lib.format.open_memmap(
+                            out_dir / VideoCacheEntry.video_name,
+                            mode="w+",
+                            dtype="uint8",
+                            shape=PaddedArray.padded_shape(
+                                (nframes, *avg_projection.shape), margin))
+                    video_chunks = normalized_chunks(
+                            video_chunks(),
+                            PaddedArray.from_padded(video, margin).array,
+                            movie_lower_cutoff, movie_upper_cutoff)
+            elif not self.args['skip_movies']:
+                padded = PaddedArray.from_padded(
+                        np.zeros(PaddedArray.padded_shape(video.shape,
+                                                          margin),
+                                 dtype="uint8"),
+                        margin)
+                normalize_array(video, movie_lower_cutoff,
+                                movie_upper_cutoff, out=padded.array)
+                video = padded.padded
+            # normalize avg projection
+            avg_lower_cutoff, avg_upper_cutoff = np.quantile(
+                    avg_projection.flatten(), proj_quantiles)
+            avg_projection = normalize_array(
+                    avg_projection, avg_lower_cutoff, avg_upper_cutoff)
+            # normalize max projection
+            max_lower_cutoff, max_upper_cutoff = np.quantile(
+                    max_projection.flatten(), proj_quantiles)
+            max_projection = normalize_array(
+                    max_projection, max_lower_cutoff, max_upper_cutoff)
 
         # experiment-level artifact
+        if (not self.args['skip_movies']) & self.args['streaming']:
+            # single encoder, fed one normalized chunk at a time.
+            # Reading and normalizing happen in the same pass.
+            with report.stage('encode_full_video'):
+                encode_video_chunks(
+                    video_chunks, output_path=str(full_video_path),
+                    fps=playback_fps, bitrate=self.args['webm_bitrate'],
+                    crf=self.args['webm_quality'])
+                video.flush()
+
+        cutoffs = {
+                'movie': [movie_lower_cutoff, movie_upper_cutoff],
+                'avg_projection': [avg_lower_cutoff, avg_upper_cutoff],
+                'max_projection': [max_lower_cutoff, max_upper_cutoff]}
+        return avg_projection, max_projection, video, cutoffs
+
+    def report_path(self, suffix: str) -> Path:
+        """path of an instrumentation output: next to the output manifest,
+        or in artifact_basedir when the manifests go to the database"""
+        if 'output_manifest' in self.args:
+            manifest = Path(self.args['output_manifest'])
+            return manifest.with_name(manifest.stem + suffix)
+        return Path(self.args['artifact_basedir']) / f"pipeline{suffix}"
+
+    def run(self, db_conn: Optional[query_utils.DbConnection] = None):
+        report = PipelineReport()
+        profiler = self.args['profiler']
+        profile_suffix = {'cProfile': '_profile.prof',
+                          'pyinstrument': '_profile.html'}.get(profiler, '')
+        with profiled(profiler, self.report_path(profile_suffix)):
+            self._run(db_conn, report)
+        if self.args['write_report']:
+            report.write(self.report_path('_report.json'))
+
+    def _run(self, db_conn: Optional[query_utils.DbConnection],
+             report: PipelineReport):
+        self.timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+
+        with report.stage('load_rois'):
+            rois, video_path = xform_from_prod_manifest(
+                prod_manifest_path=self.args[
+                    'prod_segmentation_run_manifest'],
+                all_ROIs=self.args['all_ROIs'],
+                include_trace=not self.args['skip_traces']
+            )
+        output_dir = Path(self.args['artifact_basedir'])
+        os.makedirs(output_dir, exist_ok=True)
+        # the scratch files, writers and encoders are cleaned up, and
+        # their workers stopped, also when a stage fails
+        with contextlib.ExitStack() as stack:
+            manifests = self._artifacts(rois, video_path, output_dir,
+                                        report, stack)
+
+        if 'output_manifest' in self.args:
+            with report.stage('write_manifest'):
+                with open(self.args['output_manifest'], "w") as fp:
+                    jsonlines.Writer(fp).write_all(manifests)
+        else:
+            rows = [(json.dumps(manifest),
+                     os.environ['TRANSFORM_HASH'],
+                     manifest['roi-id'])
+                    for manifest in manifests]
+            with report.stage('db_insert'), \
+                    contextlib.ExitStack() as connection:
+                if db_conn is None:
+                    # opened for this run, closed at its end
+                    db_credentials = query_utils.get_db_credentials(
+                            env_prefix="LABELING_",
+                            **query_utils.label_defaults)
+                    db_conn = connection.enter_context(
+                            query_utils.DbConnection(
+                                **db_credentials,
+                                pool_size=self.args['db_pool_size']))
+                db_conn.bulk_insert_rows(
+                        "roi_manifests", roi_manifests_columns, rows,
+                        batch_size=self.args['insert_batch_size'])
+
+    def _encoder(self, stack: contextlib.ExitStack) -> WebmEncoder:
+        """a pool of encoding workers for the videos of this run, stopped
+        when stack exits"""
+        return stack.enter_context(WebmEncoder(
+                ncpu=self.args['webm_parallelization'],
+                min_segment_frames=self.args['webm_min_segment_frames'],
+                bitrate=self.args['webm_bitrate'],
+                crf=self.args['webm_quality']))
+
+    def _artifacts(self, rois: ROISet, video_path: Path, output_dir: Path,
+                   report: PipelineReport,
+                   stack: contextlib.ExitStack) -> List[dict]:
+        """the per-ROI and experiment-level artifacts of rois, returning
+        the manifests of the ROIs"""
+        scratch_dir = Path(stack.enter_context(tempfile.TemporaryDirectory()))
+
+        correlation_projection = plt.imread(self.args[
+                                                'correlation_projection_path'])
+        playback_fps = self.args['output_fps'] * self.args['playback_factor']
+        full_video_path = None
         if not self.args['skip_movies']:
             full_video_path = output_dir / "full_video.webm"
-            transform_to_webm(
-                video=video, output_path=str(full_video_path),
-                fps=playback_fps, ncpu=self.args['webm_parallelization'],
-                bitrate=self.args['webm_bitrate'],
-                crf=self.args['webm_quality'])
 
-        # where to position the scales for the outlines
-        scale_position = (
-                self.args['scale_offset'],
-                self.args['cropped_shape'][1] - self.args['scale_offset'])
-        full_scale_position = (
-                self.args['full_scale_offset'],
-                max_projection.shape[1] - self.args['full_scale_offset'])
+        cache = None
+        cache_entry = None
+        if self.args['video_cache_dir'] is not None:
+            cache = VideoCache(
+                    self.args['video_cache_dir'],
+                    max_bytes=int(self.args['video_cache_max_gb'] * 1e9))
+            cache_key = cache.key(
+                    video_path,
+                    {k: self.args[k] for k in video_cache_params})
+            cache_entry = cache.get(
+                    cache_key, require_video=not self.args['skip_movies'])
 
-        # create the per-ROI artifacts
-        insert_statements = []
-        manifests = []
-        for roi in rois:
-            roi_id = f'{roi.experiment_id}_{roi.roi_id}'
-
-            # mask and outline from ROI class
-            mask_path = output_dir / f"mask_{roi_id}.png"
-            outline_path = output_dir / f"outline_{roi_id}.png"
-            full_outline_path = output_dir / f"full_outline_{roi_id}.png"
-            sub_video_path = output_dir / f"video_{roi_id}.webm"
-            max_proj_path = output_dir / f"max_{roi_id}.png"
-            avg_proj_path = output_dir / f"avg_{roi_id}.png"
-            corr_proj_path = output_dir / f"corr_{roi_id}.png"
-            trace_path = output_dir / f"trace_{roi_id}.json"
-
-            mask = roi.generate_ROI_mask(
-                    shape=self.args['cropped_shape'])
-            mask = np.uint8(mask * 255 / mask.max())
-            outline = roi.generate_ROI_outline(
-                shape=self.args['cropped_shape'],
-                quantile=self.args['quantile'])
-            full_outline = roi.generate_ROI_outline(
-                shape=self.args['cropped_shape'],
-                quantile=self.args['quantile'],
-                full=True)
-
-            imageio.imsave(mask_path, mask, transparency=0)
-
-            outline = add_scale(
-                    outline,
-                    scale_position,
-                    self.args['um_per_pixel'],
-                    self.args['scale_size_um'],
-                    color=0,
-                    fontScale=0.3)
-            full_outline = add_scale(
-                    full_outline,
-                    full_scale_position,
-                    self.args['um_per_pixel'],
-                    self.args['full_scale_size_um'],
-                    color=0,
-                    thickness_um=1.5,
-                    fontScale=0.8)
-
-            imageio.imsave(outline_path, outline, transparency=255)
-            imageio.imsave(full_outline_path, full_outline, transparency=255)
-
-            # video sub-frame
-            inds, pads = content_extents(
-                    roi._sparse_coo,
+        # ROI sub-videos in a single pass over the movie per batch
+        batched_sub_videos = (self.args['sub_video_batch_size'] > 0) & \
+            (not self.args['skip_movies'])
+        # windows of all the ROIs, planned at once, on the frames of the
+        # movie
+        with report.stage('plan_windows'):
+            with h5py.File(video_path, "r") as h5f:
+                frame_shape = h5f['data'].shape[1:]
+            inds, pads = batch_content_extents(
+                    rois.bounds(),
                     shape=self.args['cropped_shape'],
-                    target_shape=tuple(video.shape[1:]))
+                    target_shape=frame_shape)
+            crops = list(zip(inds, pads))
+        # the sources are padded once, by the largest padding of any
+        # window, so that the window of each ROI is a view rather than a
+        # padded copy
+        margin = pads.max(axis=(0, 2)) if len(crops) else (0, 0)
+        padded_video = (not self.args['skip_movies']) & \
+            (not batched_sub_videos)
+        # without a cache, which holds unpadded movies, the movie is
+        # normalized straight into its padded buffer
+        normalized_padded = padded_video & (cache is None)
+
+        if cache_entry is not None:
+            # the normalized movie and projections of an earlier run
+            avg_projection = cache_entry.avg_projection()
+            max_projection = cache_entry.max_projection()
+            video = None
             if not self.args['skip_movies']:
-                sub_video = np.pad(
-                        video[:, inds[0]:inds[1], inds[2]:inds[3]],
-                        ((0, 0), *pads))
-                transform_to_webm(
-                    video=sub_video, output_path=str(sub_video_path),
-                    fps=playback_fps, ncpu=self.args['webm_parallelization'],
-                    bitrate=self.args['webm_bitrate'],
-                    crf=self.args['webm_quality'])
+                video = cache_entry.video()
+                if self.args['streaming']:
+                    chunk_size = self.args['chunk_size']
+                    with report.stage('encode_full_video'):
+                        encode_video_chunks(
+                            (video[i:(i + chunk_size)]
+                             for i in range(0, video.shape[0], chunk_size)),
+                            output_path=str(full_video_path),
+                            fps=playback_fps,
+                            bitrate=self.args['webm_bitrate'],
+                            crf=self.args['webm_quality'])
+        else:
+            # the normalized movie is written to the cache, if there is
+            # one, else to the scratch directory
+            staging = scratch_dir
+            if cache is not None:
+                staging = cache.stage(cache_key)
+            avg_projection, max_projection, video, cutoffs = \
+                self.normalized_video(
+                        video_path, staging, full_video_path, playback_fps,
+                        margin=margin if normalized_padded else (0, 0),
+                        report=report)
+            if cache is not None:
+                with report.stage('video_cache_write'):
+                    np.save(staging / VideoCacheEntry.avg_name,
+                            avg_projection)
+                    np.save(staging / VideoCacheEntry.max_name,
+                            max_projection)
+                    if (video is not None) and \
+                            not isinstance(video, np.memmap):
+                        np.save(staging / VideoCacheEntry.video_name, video)
+                    cache_entry = cache.commit(cache_key, staging, cutoffs)
+                if video is not None:
+                    # the staged memmap has moved into the cache
+                    video = cache_entry.video()
 
-            # sub-projections
-            sub_max = np.pad(
-                    max_projection[inds[0]:inds[1], inds[2]:inds[3]], pads)
-            sub_ave = np.pad(
-                    avg_projection[inds[0]:inds[1], inds[2]:inds[3]], pads)
-            sub_corr = np.pad(
-                correlation_projection[inds[0]:inds[1], inds[2]:inds[3]], pads)
-            imageio.imsave(max_proj_path, sub_max)
-            imageio.imsave(avg_proj_path, sub_ave)
-            imageio.imsave(corr_proj_path, sub_corr)
+        # ROIs with artifacts in output_dir made from the same inputs are
+        # not made again
+        keys = [None] * len(rois)
+        hits = [False] * len(rois)
+        if self.args['artifact_cache']:
+            with report.stage('artifact_cache_check'):
+                fingerprint = VideoCache.key(
+                        video_path,
+                        {**{k: self.args[k] for k in video_cache_params},
+                         'correlation_projection': VideoCache.key(
+                             self.args['correlation_projection_path'], {})})
+                keys = [roi_artifact_key(roi, crop, fingerprint, self.args)
+                        for roi, crop in zip(rois, crops)]
+                hits = [artifact_cache_hit(roi, key, output_dir, self.args)
+                        for roi, key in zip(rois, keys)]
+        misses = [i for i, hit in enumerate(hits) if not hit]
 
-            if not self.args['skip_movies']:
-                # trace
-                trace = downsample_array(
-                        np.array(roi.trace),
-                        self.args['input_fps'],
-                        self.args['output_fps'],
-                        self.args['downsampling_strategy'],
-                        self.args['random_seed']).tolist()
-                trace_json = {
-                        "pointStart": 0,
-                        "pointInterval": 1.0 / playback_fps,
-                        "dataLength": len(trace),
-                        "trace": trace}
-                with open(trace_path, "w") as fp:
-                    json.dump(trace_json, fp)
-
-            # manifest entry creation
-            manifest = {}
-            manifest['experiment-id'] = roi.experiment_id
-            manifest['roi-id'] = roi.roi_id
-            manifest['source-ref'] = str(outline_path)
-            manifest['roi-mask-source-ref'] = str(mask_path)
-            manifest['max-source-ref'] = str(max_proj_path)
-            manifest['avg-source-ref'] = str(avg_proj_path)
-            manifest['full-outline-source-ref'] = str(full_outline_path)
-            if not self.args['skip_movies']:
-                manifest['trace-source-ref'] = str(trace_path)
-                manifest['full-video-source-ref'] = str(full_video_path)
-                manifest['video-source-ref'] = str(sub_video_path)
+        if batched_sub_videos:
+            sub_video_paths = [roi_artifact_paths(rois[i], output_dir)['video']
+                               for i in misses]
+            with report.stage('encode_sub_videos'):
+                encode_crops(video, [crops[i] for i in misses],
+                             sub_video_paths,
+                             fps=playback_fps,
+                             bitrate=self.args['webm_bitrate'],
+                             crf=self.args['webm_quality'],
+                             max_writers=self.args['sub_video_batch_size'])
 
-            if 'output_manifest' in self.args:
-                manifests.append(manifest)
-            else:
-                insert_str = insert_str_template.format(
-                        json.dumps(manifest),
-                        os.environ['TRANSFORM_HASH'],
-                        roi.roi_id)
+        with report.stage('pad_sources'):
+            sources = {
+                    'max_projection': PaddedArray(max_projection, margin),
+                    'avg_projection': PaddedArray(avg_projection, margin),
+                    'correlation_projection': PaddedArray(
+                        correlation_projection, margin),
+                    'video': None}
+            if normalized_padded:
+                sources['video'] = PaddedArray.from_padded(video, margin)
+            elif padded_video:
+                # the cached movie is copied into a padded buffer
+                out = None
+                if self.args['streaming']:
+                    # the padded video stays on disk, like the normalized
+                    # one
+                    out = np.lib.format.open_memmap(
+                            scratch_dir / "padded_video.npy",
+                            mode="w+",
+                            dtype="uint8",
+                            shape=PaddedArray.padded_shape(video.shape,
+                                                           margin))
+                sources['video'] = PaddedArray(video, margin, out=out)
+        # the full video not yet encoded, which is the unpadded view of
+        # the padded video, if there is one
+        full_video = None
+        if (not self.args['skip_movies']) & (not self.args['streaming']):
+            full_video = video
+            if sources['video'] is not None:
+                full_video = sources['video'].array
+        del video
 
-                insert_statements.append(insert_str)
+        # create the per-ROI artifacts
+        # the full-frame outlines only differ around their ROI
+        full_outline_template = full_outline_template_from_args(
+                avg_projection.shape, self.args)
+        # one pool of png writing threads for the serial loop
+        writer = PngWriter(max_workers=self.args['png_writers'],
+                           compression=self.args['png_compression'])
+        packed_kinds = []
+        packed_keys = []
+        if self.args['artifact_format'] == 'atlas':
+            # the images of the size of the crop are packed into sheets
+            packed_kinds = atlas_artifacts
+            packed_keys = atlas_manifest_keys
+            writer = AtlasWriter(
+                    output_dir,
+                    {roi_artifact_paths(roi, output_dir)[kind]: (kind, i)
+                     for i, roi in enumerate(rois) for kind in packed_kinds},
+                    tile_shape=self.args['cropped_shape'],
+                    columns=self.args['atlas_columns'],
+                    tiles_per_sheet=self.args['atlas_tiles_per_sheet'],
+                    writer=writer)
+        elif self.args['artifact_format'] == 'hdf5':
+            # one file of all the per-ROI images and traces, in ROI order
+            packed_kinds = hdf5_artifacts
+            packed_keys = hdf5_manifest_keys
+            writer = H5ArtifactWriter(
+                    output_dir / "roi_artifacts.h5",
+                    {roi_artifact_paths(roi, output_dir)[kind]: (kind, i)
+                     for i, roi in enumerate(rois) for kind in packed_kinds},
+                    roi_ids=[roi.roi_id for roi in rois],
+                    chunk_rois=self.args['hdf5_chunk_rois'],
+                    compression=self.args['hdf5_compression'],
+                    writer=writer)
+        writer = stack.enter_context(writer)
+        roi_kwargs = {
+                'output_dir': output_dir,
+                'args': self.args,
+                'playback_fps': playback_fps,
+                'full_video_path': full_video_path}
+        with report.stage('roi_artifacts'):
+            if self.args['roi_parallelization'] == 1:
+                # the full video is encoded while the ROI artifacts are
+                # made
+                encoder = self._encoder(stack)
+                if full_video is not None:
+                    encoder.submit(full_video, full_video_path, playback_fps)
+                made = [
+                        timed_roi_artifacts(
+                            rois[i],
+                            **sources,
+                            encoder=None if batched_sub_videos else encoder,
+                            extents=crops[i],
+                            full_outline_template=full_outline_template,
+                            writer=writer,
+                            **roi_kwargs)
+                        for i in misses]
+            else:
+                # workers memory-map the shared arrays instead of receiving
+                # pickled copies of them
+                shared_paths = {
+                        k: None if v is None else
+                        (shared_npy(v.padded, scratch_dir / k), v.margin)
+                        for k, v in sources.items()}
+                if full_video is not None:
+                    # encoded once the workers are done, from disk
+                    if shared_paths['video'] is not None:
+                        path, padding = shared_paths['video']
+                        full_video = PaddedArray.from_padded(
+                                np.load(path, mmap_mode='r'), padding).array
+                    else:
+                        full_video = np.load(
+                                shared_npy(full_video,
+                                           scratch_dir / "full_video"),
+                                mmap_mode='r')
+                # drop in-memory copies before forking the workers
+                del sources
+                with multiprocessing.Pool(
+                        self.args['roi_parallelization'],
+                        initializer=_init_roi_worker,
+                        initargs=(shared_paths,
+                                  not batched_sub_videos,
+                                  self.args['webm_bitrate'],
+                                  self.args['webm_quality'],
+                                  full_outline_template,
+                                  self.args['png_writers'],
+                                  self.args['png_compression'])) as pool:
+                    # the tiles held by each ROI are written as the ROI
+                    # arrives, so that the main process holds the tiles of
+                    # a few ROIs rather than of all of them
+                    made = []
+                    for manifest, timings, held in pool.imap(
+                            partial(_roi_worker, roi_kwargs=roi_kwargs,
+                                    packed_kinds=packed_kinds),
+                            [(rois[i], crops[i]) for i in misses]):
+                        TileBuffer.replay(held, writer)
+                        made.append((manifest, timings))
+                # no encoding workers exist while the ROI workers are forked
+                encoder = self._encoder(stack)
+                if full_video is not None:
+                    encoder.submit(full_video, full_video_path, playback_fps)
+        for i, (_, timings) in zip(misses, made):
+            report.add_roi(rois[i].roi_id, rois[i].experiment_id, timings)
+        # waits for the pngs and videos still being written
+        with report.stage('wait_png_writers'):
+            report.add_counters('png_writes', writer.close())
+        with report.stage('wait_encoders'):
+            encoder.close()
 
-        if 'output_manifest' in self.args:
-            with open(self.args['output_manifest'], "w") as fp:
-                jsonlines.Writer(fp).write_all(manifests)
-        else:
-            db_conn.bulk_insert(insert_statements)
+        manifests = [None] * len(rois)
+        for i, (manifest, _) in zip(misses, made):
+            manifests[i] = manifest
+        if packed_kinds:
+            # references to tiles of the atlas sheets or entries of the h5
+            # file
+            for manifest in manifests:
+                for key in packed_keys:
+                    if key in manifest:
+                        manifest[key] = writer.ref(manifest[key])
+        if self.args['artifact_cache']:
+            for i, roi in enumerate(rois):
+                if hits[i]:
+                    manifests[i] = roi_manifest(roi, output_dir, self.args,
+                                                full_video_path)
+                else:
+                    # recorded once all the artifacts, including the
+                    # sub-video, are written
+                    with open(artifact_key_path(roi, output_dir), "w") as f:
+                        f.write(keys[i])
+            # kept out of the manifests, which list artifact files only
+            report.add_counters('artifact_cache', {
+                    'hits': len(rois) - len(misses),
+                    'misses': len(misses),
+                    'miss_roi_ids': [int(rois[i].roi_id) for i in misses]})
+            self.logger.info(f"artifact cache: {len(rois) - len(misses)} "
+                             f"hits, {len(misses)} misses")
+        return manifests
 
 
 if __name__ == "__main__":  # pragma: no cover
@@ -0,0 +1,227 @@
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+
+
+class VideoCacheEntry:
+    """The cached intermediate products of one source video: the
+    normalized uint8 movie, the normalized projections and the cutoffs
+    they were normalized with.
+
+    Attributes
+    ----------
+    path: pathlib.Path
+        directory of the entry
+    metadata: dict
+        cutoffs and other values stored with the entry
+
+    """
+    video_name = "video.npy"
+    avg_name = "avg_projection.npy"
+    max_name = "max_projection.npy"
+    metadata_name = "metadata.json"
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        with open(self.path / self.metadata_name, "r") as f:
+            self.metadata = json.load(f)
+
+    @property
+    def has_video(self) -> bool:
+        return (self.path / self.video_name).exists()
+
+    def video(self) -> np.memmap:
+        """the normalized movie, memory-mapped read-only"""
+        return np.load(self.path / self.video_name, mmap_mode='r')
+
+    def avg_projection(self) -> np.ndarray:
+        return np.load(self.path / self.avg_name)
+
+    def max_projection(self) -> np.ndarray:
+        return np.load(self.path / self.max_name)
+
+
+class VideoCache:
+    """An on-disk cache of normalized movies and projections, so that
+    pipeline runs which only differ in per-ROI parameters do not re-read,
+    re-downsample and re-normalize the source movie.
+
+    Entries are keyed by the source path, its size and modification time,
+    and the parameters used to make them. When the cache grows over
+    max_bytes, the least recently used entries are removed.
+
+    Parameters
+    ----------
+    cache_dir: str or Path
+        directory holding the cache entries. Created if needed.
+    max_bytes: int
+        size limit of the cache. If None, the cache is not limited.
+
+    Example
+    -------
+    >>> cache = VideoCache("/scratch/video_cache", max_bytes=10**11)
+    >>> key = cache.key(movie_path, params)
+    >>> entry = cache.get(key)
+    >>> if entry is None:
+    ...     staging = cache.stage(key)
+    ...     # write the entry files into staging
+    ...     entry = cache.commit(key, staging, metadata)
+
+    """
+
+    def __init__(self, cache_dir: Union[str, Path],
+                 max_bytes: Optional[int] = None):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(source_path: Union[str, Path], params: dict) -> str:
+        """cache key of a source file and the parameters of its
+        processing. Changing the file, or any parameter, changes the key.
+
+        Parameters
+        ----------
+        source_path: str or Path
+            path to the source movie
+        params: dict
+            json-serializable parameters that affect the cached products
+
+        Returns
+        -------
+        key: str
+            hex digest identifying the cache entry
+
+        """
+        source_path = Path(source_path).resolve()
+        stat = source_path.stat()
+        description = {
+                'source_path': str(source_path),
+                'size': stat.st_size,
+                'mtime_ns': stat.st_mtime_ns,
+                'params': params}
+        return hashlib.sha256(
+                json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def get(self, key: str,
+            require_video: bool = True) -> Optional[VideoCacheEntry]:
+        """the entry for key, or None if there is none
+
+        Parameters
+        ----------
+        key: str
+            as returned by key()
+        require_video: bool
+            whether an entry without the normalized movie is a miss
+
+        Returns
+        -------
+        entry: VideoCacheEntry or None
+
+        """
+        path = self.cache_dir / key
+        if not (path / VideoCacheEntry.metadata_name).exists():
+            return None
+        entry = VideoCacheEntry(path)
+        if require_video and not entry.has_video:
+            return None
+        # the metadata modification time orders the entries for eviction
+        os.utime(path / VideoCacheEntry.metadata_name)
+        return entry
+
+    def stage(self, key: str) -> Path:
+        """an empty directory in which to write the files of a new entry.
+        It becomes the entry with commit().
+        """
+        staging = self.cache_dir / f".{key}.{os.getpid()}.staging"
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+        return staging
+
+    def commit(self, key: str, staging: Path,
+               metadata: dict) -> VideoCacheEntry:
+        """make a staging directory the entry for key, and evict old
+        entries if the cache is too large.
+
+        Several processes may make the same entry at once. An existing
+        entry with all the files of the staging directory wins: the
+        staging directory is discarded and the existing entry returned,
+        so an entry in use by another process is never removed. Only an
+        entry without the normalized movie is replaced by one with it.
+
+        Parameters
+        ----------
+        key: str
+            as returned by key()
+        staging: Path
+            as returned by stage(), with the entry files written to it
+        metadata: dict
+            json-serializable values stored with the entry
+
+        Returns
+        -------
+        entry: VideoCacheEntry
+            the entry for key
+
+        """
+        with open(staging / VideoCacheEntry.metadata_name, "w") as f:
+            json.dump(metadata, f)
+        require_video = (staging / VideoCacheEntry.video_name).exists()
+        path = self.cache_dir / key
+        entry = self.get(key, require_video=require_video)
+        if entry is None:
+            if path.exists():
+                # rename the lesser entry out of the way first, as a
+                # directory cannot replace a non-empty one
+                old = self.cache_dir / f".{key}.{os.getpid()}.old"
+                try:
+                    os.replace(path, old)
+                except OSError:
+                    # already moved or replaced by another process
+                    pass
+                shutil.rmtree(old, ignore_errors=True)
+            try:
+                os.replace(staging, path)
+            except OSError:
+                # another process committed the entry since
+                entry = self.get(key, require_video=require_video)
+                if entry is None:
+                    raise
+        if entry is not None:
+            shutil.rmtree(staging, ignore_errors=True)
+        else:
+            entry = VideoCacheEntry(path)
+        self.evict(keep=key)
+        return entry
+
+    def entries(self) -> List[Tuple[str, int, float]]:
+        """(key, size in bytes, last use time) of every entry"""
+        entries = []
+        for path in self.cache_dir.iterdir():
+            metadata = path / VideoCacheEntry.metadata_name
+            if path.name.startswith(".") or not metadata.exists():
+                continue
+            size = sum(f.stat().st_size for f in path.iterdir())
+            entries.append((path.name, size, metadata.stat().st_mtime))
+        return entries
+
+    def evict(self, keep: Optional[str] = None):
+        """remove the least recently used entries until the cache fits in
+        max_bytes. The entry keep is never removed.
+        """
+        if self.max_bytes is None:
+            return
+        entries = sorted(self.entries(), key=lambda e: e[2])
+        total = sum(e[1] for e in entries)
+        for key, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self.cache_dir / key, ignore_errors=True)
+            total -= size
@@ -1,14 +1,157 @@
 import multiprocessing
+import os
+import queue
 import subprocess
 import tempfile
+import threading
 from pathlib import Path
-from typing import List, Union
+from typing import Generator, Iterable, List, Optional, Tuple, Union
 
 import h5py
 import numpy as np
 
 import imageio_ffmpeg as mpg
-from slapp.transforms.array_utils import downsample_array
+from slapp.transforms.array_utils import (
+        downsample_bin_edges, downsample_blocks)
+
+
+class H5FrameReader:
+    """Reads consecutive blocks of frames of an h5 dataset, reading the
+    next blocks on a background thread while the current one is used.
+
+    Default blocks are whole numbers of the dataset's HDF5 chunks along
+    axis 0, so that no chunk is read (and decompressed) twice.
+
+    Parameters
+    ----------
+    video_path: str or pathlib.Path
+        path to an h5 file
+    block_size: int
+        approximate number of frames per block. Rounded down to a whole
+        number of HDF5 chunks, but at least one chunk.
+    prefetch: int
+        number of blocks read ahead of the consumer. 0 reads each block
+        when it is requested, without a background thread.
+    dataset: str
+        name of the dataset in the h5 file
+
+    Attributes
+    ----------
+    shape: tuple
+        shape of the dataset
+    dtype: numpy.dtype
+        dtype of the dataset
+    chunk_frames: int
+        frames per HDF5 chunk, 1 if the dataset is not chunked
+
+    Example
+    -------
+    >>> reader = H5FrameReader(video_path, block_size=1000, prefetch=2)
+    >>> for block in reader:
+    ...     process(block)
+
+    """
+
+    def __init__(self, video_path: Union[Path, str], block_size: int = 1000,
+                 prefetch: int = 2, dataset: str = 'data'):
+        if block_size < 1:
+            raise ValueError(f"block_size must be positive, not {block_size}")
+        if prefetch < 0:
+            raise ValueError(f"prefetch can not be negative, not {prefetch}")
+        self.video_path = video_path
+        self.prefetch = prefetch
+        self.dataset = dataset
+        with h5py.File(video_path, 'r') as h5f:
+            data = h5f[dataset]
+            self.shape = data.shape
+            self.dtype = data.dtype
+            self.chunk_frames = 1 if data.chunks is None else data.chunks[0]
+        self.block_size = max(1, block_size // self.chunk_frames) * \
+            self.chunk_frames
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __iter__(self) -> Generator[np.ndarray, None, None]:
+        return self.blocks()
+
+    def block_edges(self) -> np.ndarray:
+        """frame boundaries of the default blocks"""
+        return np.append(np.arange(0, self.shape[0], self.block_size),
+                         self.shape[0])
+
+    def blocks(self, edges: Optional[Iterable[int]] = None
+               ) -> Generator[np.ndarray, None, None]:
+        """the frames between consecutive edges
+
+        Parameters
+        ----------
+        edges: iterable of int
+            increasing frame indices. Default block_edges()
+
+        Yields
+        ------
+        block: numpy.ndarray
+            frames edges[i] to edges[i + 1]
+
+        """
+        edges = self.block_edges() if edges is None else np.asarray(edges)
+        ranges = list(zip(edges[:-1], edges[1:]))
+        if self.prefetch == 0:
+            with h5py.File(self.video_path, 'r') as h5f:
+                data = h5f[self.dataset]
+                for start, end in ranges:
+                    yield data[start:end]
+            return
+
+        blocks = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        thread = threading.Thread(
+                target=self._read_ranges, args=(ranges, blocks, stop),
+                daemon=True)
+        thread.start()
+        try:
+            for _ in ranges:
+                block = blocks.get()
+                if isinstance(block, BaseException):
+                    raise block
+                yield block
+        finally:
+            # also stops the thread when the consumer stops early
+            stop.set()
+            thread.join()
+
+    def _read_ranges(self, ranges: List[Tuple[int, int]],
+                     blocks: queue.Queue, stop: threading.Event):
+        """read the ranges into the queue, until done or stopped. An
+        exception is passed through the queue to the consumer."""
+        try:
+            with h5py.File(self.video_path, 'r') as h5f:
+                data = h5f[self.dataset]
+                for start, end in ranges:
+                    if not self._put(blocks, data[start:end], stop):
+                        return
+        except BaseException as e:
+            self._put(blocks, e, stop)
+
+    @staticmethod
+    def _put(blocks: queue.Queue, item, stop: threading.Event) -> bool:
+        while not stop.is_set():
+            try:
+                blocks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def read(self) -> np.ndarray:
+        """the whole dataset, read block by block into one array"""
+        out = np.empty(self.shape, dtype=self.dtype)
+        start = 0
+        for block in self.blocks():
+            out[start:(start + block.shape[0])] = block
+            start += block.shape[0]
+        return out
 
 
 def downsample_h5_video(
@@ -16,7 +159,9 @@ def downsample_h5_video(
         input_fps: int = 31,
         output_fps: int = 4,
         strategy: str = 'average',
-        random_seed: int = 0) -> np.ndarray:
+        random_seed: int = 0,
+        block_size: int = 1000,
+        prefetch: int = 2) -> np.ndarray:
     """Opens an h5 file and downsamples dataset 'data'
     along axis=0
 
@@ -36,21 +181,91 @@ def downsample_h5_video(
             multi-dimensional arrays
         random_seed: int
             passed to numpy.random.default_rng if strategy is 'random'
+        block_size: int
+            approximate maximum number of input frames read at once
+        prefetch: int
+            number of blocks read ahead, see H5FrameReader
 
     Returns:
         video_out: numpy.ndarray
             array downsampled along axis=0
     """
     with h5py.File(video_path, 'r') as h5f:
-        video_out = downsample_array(
-                h5f['data'],
-                input_fps,
-                output_fps,
-                strategy,
-                random_seed)
+        data = h5f['data']
+        bin_edges = downsample_bin_edges(data.shape[0], input_fps, output_fps)
+        video_out = np.zeros((len(bin_edges) - 1, *data.shape[1:]),
+                             dtype='float64')
+    start = 0
+    for chunk in h5_video_chunks(video_path, block_size, True, input_fps,
+                                 output_fps, strategy, random_seed,
+                                 prefetch):
+        video_out[start:(start + chunk.shape[0])] = chunk
+        start += chunk.shape[0]
     return video_out
 
 
+def h5_video_chunks(
+        video_path: Union[Path, str],
+        chunk_size: int = 1000,
+        downsample: bool = False,
+        input_fps: int = 31,
+        output_fps: int = 4,
+        strategy: str = 'average',
+        random_seed: int = 0,
+        prefetch: int = 2) -> Generator[np.ndarray, None, None]:
+    """Reads dataset 'data' of an h5 video in chunks of frames, optionally
+    downsampling each chunk. Concatenating the chunks gives the same
+    result as reading (or downsample_h5_video()) the whole video.
+    Chunks are read ahead by an H5FrameReader.
+
+    Parameters
+    ----------
+        video_path: pathlib.Path
+            path to an h5 video. Should have dataset 'data'. For video,
+            assumes dimensions [time, width, height] and downsampling
+            applies to time.
+        chunk_size: int
+            maximum number of input frames read from the file at once.
+            Downsampling reads whole HDF5 chunks of the dataset, at least
+            one chunk at a time, see H5FrameReader.
+        downsample: bool
+            whether to downsample the chunks
+        input_fps: int
+            frames-per-second of the input array
+        output_fps: int
+            frames-per-second of the output array
+        strategy: str
+            downsampling strategy. 'random', 'average', 'first', 'last'.
+        random_seed: int
+            passed to numpy.random.default_rng if strategy is 'random'
+        prefetch: int
+            number of chunks read ahead, see H5FrameReader
+
+    Yields:
+        chunk: numpy.ndarray
+            consecutive (downsampled) frames of the video
+    """
+    if chunk_size < 1:
+        raise ValueError(f"chunk_size must be positive, not {chunk_size}")
+    reader = H5FrameReader(video_path, block_size=chunk_size,
+                           prefetch=prefetch)
+    if not downsample:
+        # chunk_size is a maximum, which HDF5 chunks may exceed
+        edges = reader.block_edges()
+        if reader.block_size > chunk_size:
+            edges = np.append(np.arange(0, len(reader), chunk_size),
+                              len(reader))
+        yield from reader.blocks(edges)
+        return
+
+    # blocks are whole HDF5 chunks, so that no chunk is read twice
+    bin_edges = downsample_bin_edges(len(reader), input_fps, output_fps)
+    block_edges = reader.block_edges()
+    rng = np.random.default_rng(random_seed)
+    yield from downsample_blocks(reader.blocks(block_edges), block_edges,
+                                 bin_edges, strategy, rng)
+
+
 def concat_videos(video_paths: List[str], output_path: str) -> str:
     """Use ffmpeg to concatenate a list of videos (with the same encoding)
     into a single video.
@@ -83,6 +298,22 @@ def concat_videos(video_paths: List[str], output_path: str) -> str:
     return output_path
 
 
+def _webm_writer(output_path: str, frame_shape: Tuple[int, int], fps: float,
+                 bitrate: str, crf: int) -> Generator:
+    """started imageio-ffmpeg writer with the settings of encode_video()"""
+    # ffmpeg expects video shape in terms of: (width, height)
+    writer = mpg.write_frames(output_path,
+                              (int(frame_shape[1]), int(frame_shape[0])),
+                              pix_fmt_in="gray8",
+                              pix_fmt_out="yuv420p",
+                              codec="libvpx-vp9",
+                              fps=fps,
+                              bitrate=bitrate,
+                              output_params=["-crf", str(crf)])
+    writer.send(None)  # Seed ffmpeg-imageio writer generator
+    return writer
+
+
 def encode_video(video: np.ndarray, output_path: str,
                  fps: float, bitrate: str = "0", crf: int = 20) -> str:
     """Encode a video with vp9 codec via imageio-ffmpeg
@@ -112,26 +343,288 @@ def encode_video(video: np.ndarray, output_path: str,
         Output path of the encoded video
     """
 
-    # ffmpeg expects video shape in terms of: (width, height)
-    video_shape = (video[0].shape[1], video[0].shape[0])
+    return encode_video_chunks([video], output_path, fps, bitrate, crf)
 
-    writer = mpg.write_frames(output_path,
-                              video_shape,
-                              pix_fmt_in="gray8",
-                              pix_fmt_out="yuv420p",
-                              codec="libvpx-vp9",
-                              fps=fps,
-                              bitrate=bitrate,
-                              output_params=["-crf", str(crf)])
 
-    writer.send(None)  # Seed ffmpeg-imageio writer generator
-    for frame in video:
-        writer.send(frame)
+def encode_video_chunks(chunks: Iterable[np.ndarray], output_path: str,
+                        fps: float, bitrate: str = "0",
+                        crf: int = 20) -> str:
+    """Encode a video, supplied as consecutive chunks of frames, with vp9
+    codec via imageio-ffmpeg. The chunks can come from a generator, so
+    that the whole video is never held in memory.
+
+    Parameters
+    ----------
+    chunks : Iterable[np.ndarray]
+        consecutive uint8 chunks of the video, each with shape
+        (time, row, col)
+    output_path : str
+        Desired output path for encoded video
+    fps : float
+        Desired frame rate for encoded video
+    bitrate : str, optional
+        Desired bitrate of output, by default "0". See encode_video()
+    crf : int, optional
+        Desired perceptual quality of output, by default 20. See
+        encode_video()
+
+    Returns
+    -------
+    str
+        Output path of the encoded video
+    """
+    writer = None
+    for chunk in chunks:
+        if writer is None:
+            writer = _webm_writer(output_path, chunk.shape[1:], fps,
+                                  bitrate, crf)
+        for frame in chunk:
+            # frames of a window view are not contiguous, and can not
+            # be written to the ffmpeg pipe as they are
+            writer.send(np.ascontiguousarray(frame))
+    if writer is None:
+        raise ValueError(f"no frames provided to encode {output_path}")
     writer.close()
 
     return output_path
 
 
+def encode_crops(video: np.ndarray,
+                 crops: List[Tuple[Tuple[int, int, int, int],
+                                   Tuple[Tuple[int, int], Tuple[int, int]]]],
+                 output_paths: List[str], fps: float, bitrate: str = "0",
+                 crf: int = 20, max_writers: int = 32,
+                 chunk_size: int = 100) -> List[str]:
+    """Encode many cropped and padded windows of a video, iterating over
+    the frames of the video once per group of max_writers windows. Each
+    frame window is fed to its own concurrent ffmpeg writer, without
+    materializing a per-window video.
+
+    Parameters
+    ----------
+    video : np.ndarray
+        uint8 video with shape (time, row, col), for example a
+        numpy.memmap
+    crops : list
+        (indexing_bounds, pad_width) for each window, as returned by
+        array_utils.content_extents()
+    output_paths : List[str]
+        Output path for each window
+    fps : float
+        Desired frame rate for encoded videos
+    bitrate : str, optional
+        Desired bitrate of output, by default "0". See encode_video()
+    crf : int, optional
+        Desired perceptual quality of output, by default 20. See
+        encode_video()
+    max_writers : int
+        Maximum number of concurrent ffmpeg writers
+    chunk_size : int
+        Number of frames read from video at once
+
+    Returns
+    -------
+    List[str]
+        Output paths of the encoded videos
+    """
+    if len(crops) != len(output_paths):
+        raise ValueError(f"{len(crops)} crops but {len(output_paths)} "
+                         "output paths")
+    output_paths = [str(i) for i in output_paths]
+    for group_start in range(0, len(crops), max_writers):
+        group = range(group_start,
+                      min(group_start + max_writers, len(crops)))
+        writers = []
+        buffers = []
+        windows = []
+        for i in group:
+            inds, pads = crops[i]
+            shape = (inds[1] - inds[0] + sum(pads[0]),
+                     inds[3] - inds[2] + sum(pads[1]))
+            # the padding stays zero, only the interior is overwritten
+            buffers.append(np.zeros(shape, dtype='uint8'))
+            windows.append((
+                (slice(pads[0][0], shape[0] - pads[0][1]),
+                 slice(pads[1][0], shape[1] - pads[1][1])),
+                (slice(inds[0], inds[1]), slice(inds[2], inds[3]))))
+            writers.append(_webm_writer(output_paths[i], shape, fps,
+                                        bitrate, crf))
+        try:
+            for start in range(0, video.shape[0], chunk_size):
+                chunk = np.asarray(video[start:(start + chunk_size)])
+                for frame in chunk:
+                    for writer, buffer, (interior, window) in zip(
+                            writers, buffers, windows):
+                        buffer[interior] = frame[window]
+                        writer.send(buffer)
+        finally:
+            for writer in writers:
+                writer.close()
+
+    return output_paths
+
+
+class WebmEncoder:
+    """A pool of video encoding workers that lives across many encode
+    jobs, for example for the lifetime of a pipeline run. Jobs are
+    scheduled across the workers. Long videos are split into segments,
+    encoded in parallel and concatenated. Short videos are encoded as a
+    single segment by a single worker.
+
+    Parameters
+    ----------
+    ncpu : int
+        Number of worker processes. With ncpu=1 no pool is created and
+        jobs are encoded in the calling process when submitted.
+    min_segment_frames : int
+        Minimum number of frames in a segment. A video with fewer than
+        2 * min_segment_frames frames is encoded as a single segment.
+    max_pending : int
+        Maximum number of jobs in flight. Submitting more waits for the
+        oldest job, which bounds the memory held by queued videos.
+        Defaults to 2 * ncpu.
+    bitrate : str, optional
+        Desired bitrate of output, by default "0". See encode_video()
+    crf : int, optional
+        Desired perceptual quality of output, by default 20. See
+        encode_video()
+
+    Example
+    -------
+    >>> with WebmEncoder(ncpu=4) as encoder:
+    ...     encoder.submit(video, "full.webm", fps=4.0)
+    ...     for roi_video, path in roi_videos:
+    ...         encoder.submit(roi_video, path, fps=4.0)
+    ...     encoder.wait()
+    """
+
+    def __init__(self, ncpu: int = 1, min_segment_frames: int = 500,
+                 max_pending: int = None, bitrate: str = "0",
+                 crf: int = 20):
+        self.ncpu = ncpu
+        self.min_segment_frames = max(1, min_segment_frames)
+        self.max_pending = 2 * ncpu if max_pending is None else max_pending
+        self.bitrate = bitrate
+        self.crf = crf
+        self._pool = multiprocessing.Pool(ncpu) if ncpu > 1 else None
+        self._pending = []
+        self._finished = []
+
+    def submit(self, video: np.ndarray, output_path: str,
+               fps: float) -> None:
+        """Schedule a video for encoding. Call wait() to be sure the
+        output has been written.
+
+        Parameters
+        ----------
+        video : np.ndarray
+            uint8 video to be encoded with shape (time, row, col)
+        output_path : str
+            Output path for the encoded video
+        fps : float
+            Desired frames per second (fps) of the output video
+        """
+        output_path = str(output_path)
+        if self._pool is None:
+            self._finished.append(
+                    encode_video(video, output_path, fps, self.bitrate,
+                                 self.crf))
+            return
+
+        while len(self._pending) >= self.max_pending:
+            self._finish(self._pending.pop(0))
+
+        nsegments = min(self.ncpu,
+                        len(video) // self.min_segment_frames)
+        if nsegments <= 1:
+            result = self._pool.apply_async(
+                    encode_video,
+                    (video, output_path, fps, self.bitrate, self.crf))
+            self._pending.append((output_path, [result], []))
+            return
+
+        segment_files = [tempfile.NamedTemporaryFile(suffix=f"_{i}.webm")
+                         for i in range(nsegments)]
+        results = [self._pool.apply_async(
+                       encode_video,
+                       (segment, segment_file.name, fps, self.bitrate,
+                        self.crf))
+                   for segment, segment_file in zip(
+                       np.array_split(video, nsegments), segment_files)]
+        self._pending.append((output_path, results, segment_files))
+
+    def encode(self, video: np.ndarray, output_path: str, fps: float) -> str:
+        """Encode a video and wait for the result. Other submitted jobs
+        keep running.
+
+        Returns
+        -------
+        str
+            Output path of the encoded video
+        """
+        self.submit(video, output_path, fps)
+        if self._pool is not None:
+            self._finish(self._pending.pop())
+        return self._finished[-1]
+
+    def _finish(self, job) -> None:
+        output_path, results, segment_files = job
+        segment_paths = [result.get() for result in results]
+        if segment_files:
+            concat_videos(segment_paths, output_path)
+            for segment_file in segment_files:
+                segment_file.close()
+        self._finished.append(output_path)
+
+    def wait(self) -> List[str]:
+        """Wait for all submitted jobs to finish
+
+        Returns
+        -------
+        List[str]
+            Output paths of the videos finished since the last wait()
+        """
+        while self._pending:
+            self._finish(self._pending.pop(0))
+        finished = self._finished
+        self._finished = []
+        return finished
+
+    def close(self) -> None:
+        """Wait for all submitted jobs and shut down the workers"""
+        try:
+            self.wait()
+        finally:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def abort(self) -> None:
+        """Stop the workers without waiting for the submitted jobs, for
+        example after an error, and remove the partial outputs of the
+        unfinished jobs"""
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+        for output_path, _, segment_files in self._pending:
+            for segment_file in segment_files:
+                segment_file.close()
+            if os.path.exists(output_path):
+                os.remove(output_path)
+        self._pending = []
+
+
 def transform_to_webm(video: np.ndarray, output_path: str,
                       fps: float, ncpu: int, bitrate: str = "0",
                       crf: int = 20) -> str:
@@ -149,6 +642,7 @@ def transform_to_webm(video: np.ndarray, output_path: str,
     ncpu : int
         Degree of parallelization desired for encoding. Video will be
         split into 'ncpu' parts and each part will be encoded in parallel.
+        Use a WebmEncoder to encode many videos with the same workers.
     bitrate : str, optional
         Desired bitrate of output, by default "0". The default *MUST*
         be zero in order to encode in constant quality mode.
@@ -161,20 +655,6 @@ def transform_to_webm(video: np.ndarray, output_path: str,
     str
         Output path of the encoded video
     """
-
-    split_video = np.array_split(video, ncpu)
-    split_output_paths = [tempfile.NamedTemporaryFile(suffix=f"_{i}.webm")
-                          for i in range(ncpu)]
-
-    mp_pool_args = [(vid, outpath.name, fps, bitrate, crf)
-                    for vid, outpath in zip(split_video, split_output_paths)]
-
-    with multiprocessing.Pool(ncpu) as pool:
-        encode_results = pool.starmap(encode_video, mp_pool_args)
-
-    concat_output = concat_videos(encode_results, output_path)
-
-    for sop in split_output_paths:
-        sop.close()
-
-    return concat_output
+    with WebmEncoder(ncpu, min_segment_frames=1, bitrate=bitrate,
+                     crf=crf) as encoder:
+        return encoder.encode(video, output_path, fps)
@@ -1,4 +1,14 @@
+import collections
+import contextlib
+import itertools
 import os
+import re
+import threading
+import time
+from functools import partial
+from typing import Callable, Generator, Iterable, List, Optional, Sequence
+
+import numpy as np
 import pg8000
 
 
@@ -6,6 +16,20 @@ class CredentialsException(Exception):
     pass
 
 
+class ConnectionPoolException(Exception):
+    pass
+
+
+# postgres limits the number of bind parameters in one statement
+MAX_QUERY_PARAMETERS = 65535
+
+_identifier = re.compile(
+        r"^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)?$")
+
+# unique names for server-side cursors
+_cursor_ids = itertools.count()
+
+
 label_defaults = {
         "host": "aibsdc-dev-db1",
         "database": "ophys_segmentation_labeling",
@@ -74,31 +98,311 @@ def get_db_credentials(
     return db_credentials
 
 
+class ConnectionPool():
+    """A bounded, thread-safe pool of DB-API connections. Connections are
+    reused across checkouts instead of paying a new connection handshake
+    for every query.
+
+    Parameters
+    ----------
+    connect : callable
+        called without arguments to open a new DB-API connection
+    maxsize : int
+        maximum number of open connections, idle or checked out
+    max_idle : float
+        seconds after which an idle connection is closed instead of
+        reused
+    health_check : str
+        statement executed on a connection idle for more than
+        `check_after` seconds before it is handed out. A connection
+        failing the check is closed and replaced. None disables the check.
+    check_after : float
+        idle seconds after which a connection is health checked
+    timeout : float
+        seconds to wait for a connection when `maxsize` connections are
+        checked out, after which ConnectionPoolException is raised. None
+        waits indefinitely, which deadlocks a thread waiting on a
+        connection it holds itself.
+
+    """
+
+    def __init__(self, connect: Callable, maxsize: int = 4,
+                 max_idle: float = 300.0,
+                 health_check: Optional[str] = "SELECT 1",
+                 check_after: float = 30.0,
+                 timeout: Optional[float] = 60.0):
+        if maxsize < 1:
+            raise ConnectionPoolException(
+                    f"maxsize must be at least 1, not {maxsize}")
+        self._connect = connect
+        self.maxsize = maxsize
+        self.max_idle = max_idle
+        self.health_check = health_check
+        self.check_after = check_after
+        self.timeout = timeout
+        # (connection, time it was returned), most recently returned last
+        self._idle = collections.deque()
+        self._size = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    @property
+    def size(self) -> int:
+        """number of open connections, idle or checked out"""
+        with self._condition:
+            return self._size
+
+    @property
+    def idle(self) -> int:
+        """number of idle connections"""
+        with self._condition:
+            return len(self._idle)
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _healthy(self, conn) -> bool:
+        try:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(self.health_check)
+                cursor.fetchall()
+            finally:
+                cursor.close()
+            conn.rollback()
+        except Exception:
+            return False
+        return True
+
+    def _checkout(self, deadline: Optional[float]):
+        """under the lock, either pop an idle connection or reserve a slot
+        for a new one, waiting until one of the two is possible.
+
+        Returns
+        -------
+        conn: DB-API connection or None
+            None if a slot was reserved for a new connection
+        idle_time: float
+            seconds the connection was idle
+        evicted: list
+            connections idle for longer than max_idle, to be closed
+            outside the lock
+
+        """
+        evicted = []
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise ConnectionPoolException("connection pool is closed")
+                now = time.monotonic()
+                while self._idle and (now - self._idle[0][1] > self.max_idle):
+                    evicted.append(self._idle.popleft()[0])
+                    self._size -= 1
+                if self._idle:
+                    conn, returned = self._idle.pop()
+                    return conn, now - returned, evicted
+                if self._size < self.maxsize:
+                    self._size += 1
+                    return None, 0.0, evicted
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        raise ConnectionPoolException(
+                                "no connection available after "
+                                f"{self.timeout} seconds")
+                self._condition.wait(remaining)
+
+    def acquire(self):
+        """check out a connection. `connection()` is preferred, as it
+        always returns the connection to the pool.
+
+        Raises
+        ------
+        ConnectionPoolException
+            if the pool is closed, or no connection became available
+            within `timeout` seconds
+
+        """
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.monotonic() + self.timeout
+        while True:
+            conn, idle_time, evicted = self._checkout(deadline)
+            for old in evicted:
+                self._close_quietly(old)
+            if conn is None:
+                try:
+                    return self._connect()
+                except Exception:
+                    self._forget()
+                    raise
+            if (self.health_check is None) | (idle_time <= self.check_after):
+                return conn
+            if self._healthy(conn):
+                return conn
+            self._close_quietly(conn)
+            self._forget()
+
+    def _forget(self):
+        """give up the slot of a connection that was closed or never
+        opened"""
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+    def release(self, conn, discard: bool = False):
+        """return a connection to the pool
+
+        Parameters
+        ----------
+        conn: DB-API connection
+            a connection obtained from `acquire()`
+        discard: bool
+            close the connection instead of keeping it for reuse
+
+        """
+        with self._condition:
+            if not (discard | self._closed):
+                self._idle.append((conn, time.monotonic()))
+                self._condition.notify()
+                return
+        self._close_quietly(conn)
+        self._forget()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """context manager checking out a connection. If the block raises,
+        the open transaction is rolled back, and the connection is
+        discarded if the rollback fails.
+        """
+        conn = self.acquire()
+        try:
+            yield conn
+        except BaseException:
+            try:
+                conn.rollback()
+            except Exception:
+                self.release(conn, discard=True)
+            else:
+                self.release(conn)
+            raise
+        self.release(conn)
+
+    def close(self):
+        """close the idle connections. Checked out connections are closed
+        when they are released.
+        """
+        with self._condition:
+            self._closed = True
+            idle = [conn for conn, _ in self._idle]
+            self._idle.clear()
+            self._size -= len(idle)
+            self._condition.notify_all()
+        for conn in idle:
+            self._close_quietly(conn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
 class DbConnection():
+    """Connection parameters and query helpers for a postgres database.
+
+    By default, every query opens and closes its own connection. With
+    `pool_size` set, connections are kept in a ConnectionPool and reused,
+    which is cheaper when issuing many queries, and safe to share between
+    threads. A pooled DbConnection should be closed, or used as a context
+    manager.
+
+    A pooled query waits at most `pool_timeout` seconds for a free
+    connection, then raises ConnectionPoolException. `iter_query()` holds
+    its connection until the iterator is exhausted or closed, so with
+    `pool_size` 1 a `query()` issued inside an `iter_query()` loop cannot
+    get a connection and fails after `pool_timeout`. Nested queries need
+    a `pool_size` of at least the nesting depth.
+
+    Parameters
+    ----------
+    user, host, database, password, port
+        connection credentials, as from `get_db_credentials()`
+    pool_size: int
+        maximum number of pooled connections. None or 0 for no pooling.
+    max_idle: float
+        seconds after which an idle pooled connection is closed
+    pool_timeout: float
+        seconds to wait for a free pooled connection. None waits
+        indefinitely.
+    connect: callable
+        DB-API `connect` function, called with the credentials as keyword
+        arguments
+
+    """
 
-    def __init__(self, user, host, database, password, port):
+    def __init__(self, user, host, database, password, port,
+                 pool_size: Optional[int] = None, max_idle: float = 300.0,
+                 pool_timeout: Optional[float] = 60.0,
+                 connect: Callable = pg8000.connect):
         self.user = user
         self.host = host
         self.database = database
         self.password = password
         self.port = port
+        self._connect_function = partial(
+                connect, user=user, host=host, database=database,
+                password=password, port=port)
+        self._pool = None
+        if pool_size:
+            self._pool = ConnectionPool(self._connect_function,
+                                        maxsize=pool_size,
+                                        max_idle=max_idle,
+                                        timeout=pool_timeout)
 
-    @staticmethod
-    def _connect(user, host, database, password, port):
-        conn = pg8000.connect(user=user, host=host, database=database,
-                              password=password, port=port)
-        return conn, conn.cursor()
+    @contextlib.contextmanager
+    def _connection(self):
+        if self._pool is not None:
+            with self._pool.connection() as conn:
+                yield conn
+            return
+        conn = self._connect_function()
+        try:
+            yield conn
+        finally:
+            conn.close()
 
     @staticmethod
-    def _select(cursor, query):
-        cursor.execute(query)
+    def _columns(cursor) -> List[str]:
         try:
-            columns = [d[0].decode("utf-8") for d in cursor.description]
+            return [d[0].decode("utf-8") for d in cursor.description]
         except AttributeError:
             # Version 1.16.6 pg8000 values are already decoded into str
-            columns = [d[0] for d in cursor.description]
+            return [d[0] for d in cursor.description]
+
+    @staticmethod
+    def _select(cursor, query):
+        cursor.execute(query)
+        columns = DbConnection._columns(cursor)
         return [dict(zip(columns, c)) for c in cursor.fetchall()]
 
+    @staticmethod
+    def _column_array(values: list) -> np.ndarray:
+        """values of one column as an array. Columns of sequences, such as
+        postgres arrays, or with NULLs are object arrays with one element
+        per row."""
+        if any([(v is None) | isinstance(v, (list, tuple, dict))
+                for v in values]):
+            column = np.empty(len(values), dtype=object)
+            column[:] = values
+            return column
+        return np.array(values)
+
     def insert(self, statement):
         self.bulk_insert([statement])
 
@@ -110,28 +414,178 @@ class DbConnection():
         statements: list
             each element of statements should be a valid INSERT statement
         """
-        conn, cursor = DbConnection._connect(self.user, self.host,
-                                             self.database,
-                                             self.password, self.port)
-        try:
-            for statement in statements:
-                cursor.execute(statement)
-        finally:
-            conn.commit()
-            cursor.close()
-            conn.close()
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            try:
+                for statement in statements:
+                    cursor.execute(statement)
+            finally:
+                conn.commit()
+                cursor.close()
 
-    def query(self, query):
-        conn, cursor = DbConnection._connect(self.user, self.host,
-                                             self.database,
-                                             self.password, self.port)
+    def bulk_insert_rows(self, table: str, columns: Sequence[str],
+                         rows: Iterable[Sequence],
+                         batch_size: int = 1000) -> int:
+        """insert rows with parameterized multi-row INSERT statements,
+        one server round trip per batch of rows, and a single commit.
+        Values are passed as query parameters, so they need no quoting or
+        escaping.
+
+        Parameters
+        ----------
+        table: str
+            name of the table, optionally schema qualified
+        columns: Sequence[str]
+            names of the columns to insert
+        rows: Iterable[Sequence]
+            each row is a sequence of values, in the order of columns
+        batch_size: int
+            number of rows per INSERT statement. Reduced if needed to stay
+            within the postgres limit of bind parameters per statement.
+
+        Returns
+        -------
+        nrows: int
+            the number of inserted rows
+
+        Raises
+        ------
+        ValueError
+            if table or columns are not plain SQL identifiers, a row does
+            not have one value per column, or batch_size < 1
 
+        """
+        for name in [table, *columns]:
+            if not _identifier.match(name):
+                raise ValueError(f"{name} is not a valid SQL identifier")
+        if len(columns) == 0:
+            raise ValueError("at least one column is required")
+        if batch_size < 1:
+            raise ValueError(f"batch_size must be at least 1, not "
+                             f"{batch_size}")
+        batch_size = min(batch_size, MAX_QUERY_PARAMETERS // len(columns))
+        placeholder = "(" + ", ".join(["%s"] * len(columns)) + ")"
+        prefix = f"INSERT INTO {table} ({', '.join(columns)}) VALUES "
+
+        nrows = 0
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            try:
+                batch: List = []
+                for row in rows:
+                    if len(row) != len(columns):
+                        raise ValueError(
+                                f"row {nrows} has {len(row)} values for "
+                                f"{len(columns)} columns")
+                    batch.append(row)
+                    nrows += 1
+                    if len(batch) == batch_size:
+                        self._insert_batch(cursor, prefix, placeholder, batch)
+                        batch = []
+                if batch:
+                    self._insert_batch(cursor, prefix, placeholder, batch)
+                conn.commit()
+            finally:
+                cursor.close()
+        return nrows
+
+    @staticmethod
+    def _insert_batch(cursor, prefix, placeholder, batch):
+        statement = prefix + ", ".join([placeholder] * len(batch))
+        cursor.execute(statement, tuple([v for row in batch for v in row]))
+
+    def query(self, query):
         # Guard against non-ascii characters in query
         query = ''.join([i if ord(i) < 128 else ' ' for i in query])
 
-        try:
-            results = DbConnection._select(cursor, query)
-        finally:
-            cursor.close()
-            conn.close()
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            try:
+                results = DbConnection._select(cursor, query)
+            finally:
+                cursor.close()
+            if self._pool is not None:
+                # do not leave a pooled connection idle in a transaction
+                conn.rollback()
         return results
+
+    def iter_query(self, query: str, batch_size: int = 1000,
+                   row_format: str = "dict") -> Generator:
+        """iterate over the results of a query, fetching them from a
+        server-side cursor in batches, so that only one batch is held in
+        memory at a time. The connection is held until the iterator is
+        exhausted or closed.
+
+        Parameters
+        ----------
+        query: str
+            a SELECT query
+        batch_size: int
+            number of rows fetched per round trip
+        row_format: str
+            'dict': yield one dict per row, as in query()
+            'namedtuple': yield one namedtuple per row
+            'columns': yield one dict per batch, mapping column names to
+            arrays of the batch values
+
+        Yields
+        ------
+        dict, namedtuple or dict of numpy.ndarray
+            as specified by row_format
+
+        Raises
+        ------
+        ValueError
+            for an invalid row_format or batch_size < 1
+
+        """
+        if row_format not in ["dict", "namedtuple", "columns"]:
+            raise ValueError(f"row_format {row_format} is not one of "
+                             "'dict', 'namedtuple', 'columns'")
+        if batch_size < 1:
+            raise ValueError(f"batch_size must be at least 1, not "
+                             f"{batch_size}")
+
+        # Guard against non-ascii characters in query
+        query = ''.join([i if ord(i) < 128 else ' ' for i in query])
+        name = f"slapp_cursor_{next(_cursor_ids)}"
+
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(f"DECLARE {name} NO SCROLL CURSOR FOR {query}")
+                row_type = None
+                while True:
+                    cursor.execute(f"FETCH FORWARD {batch_size} FROM {name}")
+                    rows = cursor.fetchall()
+                    if len(rows) == 0:
+                        break
+                    if row_type is None:
+                        columns = DbConnection._columns(cursor)
+                        row_type = collections.namedtuple(
+                                "Row", columns, rename=True)
+                    if row_format == "dict":
+                        for row in rows:
+                            yield dict(zip(columns, row))
+                    elif row_format == "namedtuple":
+                        for row in rows:
+                            yield row_type(*row)
+                    else:
+                        yield {column: DbConnection._column_array(list(v))
+                               for column, v in zip(columns, zip(*rows))}
+                cursor.execute(f"CLOSE {name}")
+            finally:
+                cursor.close()
+                # ends the transaction holding the cursor, if still open
+                conn.rollback()
+
+    def close(self):
+        """close pooled connections"""
+        if self._pool is not None:
+            self._pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -62,3 +62,39 @@ def test_segmentation_manifest(
     mock_lims_db_conn_fixture.query.assert_called_once()
     mock_output.assert_called_once()
     assert mock_h5.File.call_count == 4
+
+
+def test_segmentation_manifest_connections(
+        mock_lims_db_conn_fixture, mock_label_db_conn_fixture, monkeypatch,
+        tmp_path):
+    """without connections, run() opens pooled ones and closes them"""
+    connections = {'LIMS_': mock_lims_db_conn_fixture,
+                   'LABELING_': mock_label_db_conn_fixture}
+    opened = []
+
+    def mock_connection(user, pool_size):
+        opened.append((user, pool_size))
+        connection = MagicMock()
+        connection.__enter__.return_value = connections[user]
+        return connection
+
+    mock_h5 = MagicMock()
+    mock_h5.File.return_value.__enter__.return_value = {'data': np.arange(10)}
+    monkeypatch.setattr(sm.SegmentationManifest, "output", MagicMock())
+    monkeypatch.setattr(sm, "find_full_movie", MagicMock())
+    monkeypatch.setattr(sm, "h5py", mock_h5)
+    monkeypatch.setattr(sm.qu, "DbConnection", mock_connection)
+    monkeypatch.setattr(sm.qu, "get_db_credentials",
+                        lambda **kwargs: {'user': kwargs['env_prefix']})
+
+    args = {
+            'experiment_selection_id': 12,
+            'output_json': str(tmp_path / "output.json"),
+            'db_pool_size': 2
+            }
+    sman = sm.SegmentationManifest(input_data=args, args=[])
+    sman.run()
+
+    assert opened == [('LIMS_', 2), ('LABELING_', 2)]
+    mock_label_db_conn_fixture.query.assert_called_once()
+    mock_lims_db_conn_fixture.query.assert_called_once()
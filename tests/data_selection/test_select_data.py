@@ -17,6 +17,8 @@ def mock_db_conn_fixture():
 
     mock_db_conn = MagicMock()
     mock_db_conn.query.side_effect = mock_query
+    mock_db_conn.iter_query.side_effect = \
+        lambda query_string: iter(mock_query(query_string))
     mock_db_conn.insert.side_effect = mock_insert
     return mock_db_conn
 
@@ -44,7 +46,7 @@ def test_select_data(mock_db_conn_fixture, query_strings, counts, monkeypatch):
         selector = sd.DataSelector(input_data=args, args=[])
         selector.run(mock_db_conn_fixture, mock_db_conn_fixture)
 
-        mock_db_conn_fixture.query.assert_has_calls(
+        mock_db_conn_fixture.iter_query.assert_has_calls(
                 [call(q) for q in query_strings])
 
         mock_db_conn_fixture.insert.assert_called_once()
@@ -55,6 +57,35 @@ def test_select_data(mock_db_conn_fixture, query_strings, counts, monkeypatch):
         os.environ.pop('TRANSFORM_HASH')
 
 
+@pytest.mark.parametrize("db_pool_size", [0, 3])
+def test_select_data_connections(mock_db_conn_fixture, monkeypatch,
+                                 db_pool_size):
+    """without connections, run() opens pooled ones and closes them"""
+    mock_connection = MagicMock()
+    mock_connection.return_value.__enter__.return_value = \
+        mock_db_conn_fixture
+    monkeypatch.setattr(sd.qu, "DbConnection", mock_connection)
+    monkeypatch.setattr(sd.qu, "get_db_credentials",
+                        lambda **kwargs: {'user': kwargs['env_prefix']})
+    args = {
+        "query_strings": ["SELECT some stuff"],
+        "sub_selection_counts": [5],
+        "db_pool_size": db_pool_size
+        }
+    os.environ['TRANSFORM_HASH'] = 'example_hash'
+    try:
+        selector = sd.DataSelector(input_data=args, args=[])
+        selector.run()
+    finally:
+        os.environ.pop('TRANSFORM_HASH')
+
+    assert mock_connection.call_args_list == [
+            call(user="LIMS_", pool_size=db_pool_size),
+            call(user="LABELING_", pool_size=db_pool_size)]
+    assert mock_connection.return_value.__exit__.call_count == 2
+    mock_db_conn_fixture.insert.assert_called_once()
+
+
 @pytest.mark.parametrize(
         "query_strings, counts",
         [
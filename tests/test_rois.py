@@ -1,7 +1,10 @@
 import pytest
+from unittest.mock import MagicMock
 import numpy as np
+import cv2
 from scipy.sparse import coo_matrix
 import slapp.rois as roi_module
+from slapp.transforms.array_utils import content_boundary_2d
 
 
 @pytest.mark.parametrize("use_coo", [True, False])
@@ -307,3 +310,251 @@ def test_roi_generate_outline(weighted, full, expected, athresh, quantile):
 def test_coo_from_lims_style(mask_matrix, xoff, yoff, shape, expected):
     coo = roi_module.coo_from_lims_style(mask_matrix, xoff, yoff, shape)
     np.testing.assert_array_equal(coo.toarray(), np.array(expected))
+
+
+@pytest.fixture
+def mock_db_conn(request):
+    segmentation_run = {
+            'id': 42,
+            'video_shape': [10, 10],
+            'ophys_experiment_id': 1234,
+            'source_video_path': '/mock/path'}
+    rois = [
+            {'id': 7, 'coo_row': [1, 2], 'coo_col': [3, 3],
+             'coo_data': [1.0, 0.5], 'trace': [1.0, 2.0, 3.0]},
+            {'id': 9, 'coo_row': [5], 'coo_col': [6],
+             'coo_data': [2.0], 'trace': [4.0, 5.0, 6.0]}]
+    responses = {
+        "SELECT * FROM segmentation_runs WHERE id=42": [segmentation_run],
+        ("SELECT id, coo_row, coo_col, coo_data, trace FROM rois "
+         "WHERE segmentation_run_id=42 ORDER BY id"): rois}
+    db_conn = MagicMock()
+    db_conn.query.side_effect = lambda query_string: responses[query_string]
+    db_conn.iter_query.side_effect = \
+        lambda query_string: iter(responses[query_string])
+    return db_conn, segmentation_run, rois
+
+
+@pytest.mark.parametrize("provide_segmentation_run", [True, False])
+def test_rois_from_segmentation_run(mock_db_conn, provide_segmentation_run):
+    db_conn, segmentation_run, records = mock_db_conn
+    kwargs = {}
+    if provide_segmentation_run:
+        kwargs['segmentation_run'] = segmentation_run
+    rois = roi_module.ROI.rois_from_segmentation_run(42, db_conn, **kwargs)
+
+    # one query for the ROIs, and maybe one for the segmentation run
+    expected_nquery = 0 if provide_segmentation_run else 1
+    assert db_conn.query.call_count == expected_nquery
+    db_conn.iter_query.assert_called_once()
+
+    assert len(rois) == len(records)
+    for roi, record in zip(rois, records):
+        assert roi.roi_id == record['id']
+        assert roi.experiment_id == 1234
+        assert roi.image_shape == [10, 10]
+        assert roi.trace == record['trace']
+        np.testing.assert_array_equal(roi._sparse_coo.row, record['coo_row'])
+        np.testing.assert_array_equal(roi._sparse_coo.col, record['coo_col'])
+        np.testing.assert_array_equal(roi._sparse_coo.data,
+                                      record['coo_data'])
+
+
+def dense_outline(weighted, absolute_threshold, quantile,
+                  dilation_kernel_size, inner_outline):
+    """full-frame outline, computed the way it was before ROIs worked
+    on their bounding box
+    """
+    binary = roi_module.binary_mask_from_threshold(
+            weighted,
+            absolute_threshold=absolute_threshold,
+            quantile=quantile)
+    contours, _ = cv2.findContours(binary,
+                                   cv2.RETR_LIST,
+                                   cv2.CHAIN_APPROX_NONE)
+    xy = np.concatenate(contours).squeeze()
+    mask = np.zeros(binary.shape, dtype='uint8')
+    mask[xy[:, 1], xy[:, 0]] = 1
+    kernel = np.ones((dilation_kernel_size, dilation_kernel_size))
+    mask = cv2.dilate(mask, kernel)
+    if inner_outline:
+        mask = mask & binary
+    return mask
+
+
+@pytest.mark.parametrize("offset", [(0, 0), (10, 12), (26, 25)])
+@pytest.mark.parametrize("dilation_kernel_size", [1, 2, 3])
+@pytest.mark.parametrize("inner_outline", [True, False])
+@pytest.mark.parametrize("shape", [None, (12, 12)])
+def test_roi_local_stamp_matches_full_frame(
+        offset, dilation_kernel_size, inner_outline, shape):
+    """operating on the bounding box of the ROI gives the same masks and
+    outlines as operating on the full frame, including next to the frame
+    edges
+    """
+    rng = np.random.default_rng(42)
+    weighted = np.zeros((32, 32))
+    weighted[offset[0]:(offset[0] + 6), offset[1]:(offset[1] + 7)] = \
+        rng.random((6, 7))[:(32 - offset[0]), :(32 - offset[1])]
+    coo = coo_matrix(weighted)
+    roi = roi_module.ROI(
+            coo.row,
+            coo.col,
+            coo.data,
+            image_shape=weighted.shape,
+            experiment_id=1234,
+            roi_id=4567,
+            trace=[1.234, 2.345])
+
+    for full in [True, False]:
+        expected = roi_module.sized_mask(weighted, shape=shape, full=full)
+        mask = roi.generate_ROI_mask(shape=shape, full=full)
+        np.testing.assert_array_equal(mask, expected)
+
+        expected = dense_outline(weighted, None, 0.1, dilation_kernel_size,
+                                 inner_outline)
+        expected = 255 * (1 - roi_module.sized_mask(
+            expected, shape=shape, full=full))
+        outline = roi.generate_ROI_outline(
+                shape=shape,
+                full=full,
+                dilation_kernel_size=dilation_kernel_size,
+                inner_outline=inner_outline)
+        np.testing.assert_array_equal(outline, expected)
+
+
+@pytest.mark.parametrize("offset", [(0, 0), (10, 12), (26, 25)])
+@pytest.mark.parametrize("dilation_kernel_size", [1, 3])
+def test_roi_full_outline_on_template(offset, dilation_kernel_size):
+    """drawing the outline onto a pre-annotated template equals annotating
+    the full-frame outline
+    """
+    rng = np.random.default_rng(43)
+    weighted = np.zeros((32, 32))
+    weighted[offset[0]:(offset[0] + 6), offset[1]:(offset[1] + 7)] = \
+        rng.random((6, 7))[:(32 - offset[0]), :(32 - offset[1])]
+    coo = coo_matrix(weighted)
+    roi = roi_module.ROI(coo.row, coo.col, coo.data,
+                         image_shape=weighted.shape, experiment_id=1234,
+                         roi_id=4567, trace=[1.234, 2.345])
+
+    def annotate(image):
+        image = image.astype('uint8')
+        cv2.putText(image, "10um", (2, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.3,
+                    0, 1, cv2.LINE_4)
+        cv2.line(image, (2, 31), (14, 31), 0, 2, cv2.LINE_4)
+        return image
+
+    expected = annotate(roi.generate_ROI_outline(
+            full=True, dilation_kernel_size=dilation_kernel_size))
+    template = annotate(np.full((32, 32), 255, dtype='uint8'))
+    outline = roi.generate_full_outline(
+            template, dilation_kernel_size=dilation_kernel_size)
+    np.testing.assert_array_equal(outline, expected)
+    # the template is not modified
+    np.testing.assert_array_equal(
+            template, annotate(np.full((32, 32), 255, dtype='uint8')))
+
+
+@pytest.fixture
+def roi_list():
+    rng = np.random.default_rng(3)
+    rois = []
+    for roi_id, (top, left, h, w) in enumerate(
+            [(0, 0, 3, 4), (10, 12, 5, 2), (25, 26, 7, 6), (4, 20, 1, 1)]):
+        weighted = np.zeros((32, 32))
+        weighted[top:(top + h), left:(left + w)] = \
+            1.0 + rng.random((h, w))
+        coo = coo_matrix(weighted)
+        rois.append(roi_module.ROI(
+            coo.row, coo.col, coo.data,
+            image_shape=(32, 32),
+            experiment_id=1234,
+            roi_id=roi_id,
+            trace=rng.random(5)))
+    return rois
+
+
+def test_roi_set(roi_list):
+    roi_set = roi_module.ROISet.from_rois(roi_list)
+    assert len(roi_set) == len(roi_list)
+    assert roi_set.traces.shape == (len(roi_list), 5)
+
+    for roi, expected in zip(roi_set, roi_list):
+        assert not hasattr(roi, '__dict__')
+        assert roi.roi_id == expected.roi_id
+        assert roi.experiment_id == expected.experiment_id
+        np.testing.assert_array_equal(roi.trace, expected.trace)
+        np.testing.assert_array_equal(roi._sparse_coo.toarray(),
+                                      expected._sparse_coo.toarray())
+    assert roi_set[-1].roi_id == roi_list[-1].roi_id
+    with pytest.raises(IndexError):
+        roi_set[len(roi_list)]
+
+    expected_bounds = [content_boundary_2d(roi._sparse_coo)
+                       for roi in roi_list]
+    np.testing.assert_array_equal(roi_set.bounds(), expected_bounds)
+
+    expected_areas = [roi._sparse_coo.nnz for roi in roi_list]
+    np.testing.assert_array_equal(roi_set.areas(), expected_areas)
+
+    expected_masks = [roi.generate_ROI_mask(shape=(8, 8))
+                      for roi in roi_list]
+    np.testing.assert_array_equal(roi_set.masks((8, 8)), expected_masks)
+
+
+def test_roi_set_empty_roi():
+    coos = [coo_matrix(([1.0, 2.0], ([3, 4], [5, 5])), shape=(10, 10)),
+            coo_matrix((10, 10))]
+    roi_set = roi_module.ROISet.from_coo_matrices(
+            coos, image_shape=(10, 10), experiment_ids=[1, 1],
+            roi_ids=[7, 8])
+    np.testing.assert_array_equal(roi_set.bounds(),
+                                  [[3, 5, 5, 6], [0, 0, 0, 0]])
+    np.testing.assert_array_equal(roi_set.areas(), [2, 0])
+    assert roi_set[1]._sparse_coo.nnz == 0
+    assert roi_set[1].trace is None
+
+    roi_set = roi_module.ROISet.from_coo_matrices(
+            [], image_shape=(10, 10), experiment_ids=[], roi_ids=[])
+    assert len(roi_set) == 0
+    assert roi_set.bounds().shape == (0, 4)
+
+
+def test_roi_set_exception():
+    with pytest.raises(ValueError, match="offsets do not match"):
+        roi_module.ROISet(
+                offsets=[0, 1], rows=[0], cols=[0], data=[1.0],
+                image_shape=(4, 4), experiment_ids=[1, 1], roi_ids=[1, 2])
+    with pytest.raises(ValueError, match="traces do not match"):
+        roi_module.ROISet(
+                offsets=[0, 1], rows=[0], cols=[0], data=[1.0],
+                image_shape=(4, 4), experiment_ids=[1], roi_ids=[1],
+                traces=np.zeros((2, 5)))
+
+
+@pytest.mark.parametrize("provide_segmentation_run", [True, False])
+def test_roi_set_from_segmentation_run(mock_db_conn,
+                                       provide_segmentation_run):
+    db_conn, segmentation_run, records = mock_db_conn
+    kwargs = {}
+    if provide_segmentation_run:
+        kwargs['segmentation_run'] = segmentation_run
+    roi_set = roi_module.ROISet.from_segmentation_run(42, db_conn, **kwargs)
+
+    expected_nquery = 0 if provide_segmentation_run else 1
+    assert db_conn.query.call_count == expected_nquery
+    db_conn.iter_query.assert_called_once()
+
+    # same ROIs as the list loader
+    expected = roi_module.ROI.rois_from_segmentation_run(
+            42, db_conn, segmentation_run=segmentation_run)
+    assert len(roi_set) == len(expected)
+    np.testing.assert_array_equal(roi_set.traces,
+                                  [r['trace'] for r in records])
+    for roi, other in zip(roi_set, expected):
+        assert roi.roi_id == other.roi_id
+        assert roi.experiment_id == other.experiment_id
+        np.testing.assert_array_equal(roi.trace, other.trace)
+        np.testing.assert_array_equal(roi._sparse_coo.toarray(),
+                                      other._sparse_coo.toarray())
@@ -167,3 +167,162 @@ def test_LabelDataUploader(mock_db_conn_fixture, bucket, timestamp, manifest,
     assert 'local_s3_manifest_copy' in j
     assert len(j['failed_uploads']) == 0
     assert len(j['successful_uploads']) == 8
+
+
+def test_LabelDataUploader_atlas(bucket, tmp_path):
+    """atlas sheets and h5 files shared by manifests are uploaded once,
+    and the s3 manifests reference their tiles and entries
+    """
+    sheet = tmp_path / "max_atlas_0.png"
+    with open(sheet, "w") as fp:
+        fp.write('content')
+    h5_path = tmp_path / "roi_artifacts.h5"
+    with open(h5_path, "w") as fp:
+        fp.write('content')
+    manifests = []
+    for roi_id in [1, 2]:
+        manifest = {'experiment-id': 1234, 'roi-id': roi_id}
+        for key in ['source-ref', 'full-video-source-ref']:
+            path = tmp_path / f"{key}_{roi_id}.txt"
+            with open(path, "w") as fp:
+                fp.write('content')
+            manifest[key] = str(path)
+        manifest['full-video-source-ref'] = str(
+                tmp_path / "full-video-source-ref_1.txt")
+        manifest['max-source-ref'] = f"{sheet}#xywh={roi_id * 4},0,4,4"
+        manifest['avg-source-ref'] = f"{h5_path}#avg/{roi_id - 1}"
+        manifests.append(manifest)
+    manifest_path = tmp_path / "manifest.jsonl"
+    with open(manifest_path, "w") as fp:
+        fp.write("\n".join([json.dumps(m) for m in manifests]))
+
+    output_json_path = tmp_path / "output.json"
+    args = {
+            's3_bucket_name': bucket,
+            'timestamp': False,
+            'prefix': 'abc',
+            'output_json': str(output_json_path),
+            'manifest_file': str(manifest_path)}
+    ldu = up.LabelDataUploader(input_data=args, args=[])
+    ldu.run(MagicMock())
+
+    response = boto3.client('s3').list_objects_v2(Bucket=bucket)
+    files_in_s3 = sorted(c['Key'] for c in response['Contents'])
+    assert files_in_s3 == sorted([
+        'abc/1234_max_atlas_0.png', 'abc/1234_roi_artifacts.h5',
+        'abc/1234_full-video-source-ref_1.txt',
+        'abc/source-ref_1.txt', 'abc/source-ref_2.txt', 'abc/manifest.json'])
+
+    with open(output_json_path, 'r') as f:
+        j = json.load(f)
+    assert len(j['failed_uploads']) == 0
+    with open(j['local_s3_manifest_copy'], 'r') as f:
+        s3_manifests = [json.loads(line) for line in f]
+    assert [m['max-source-ref'] for m in s3_manifests] == [
+            f"s3://{bucket}/abc/1234_max_atlas_0.png#xywh={i * 4},0,4,4"
+            for i in [1, 2]]
+    assert [m['avg-source-ref'] for m in s3_manifests] == [
+            f"s3://{bucket}/abc/1234_roi_artifacts.h5#avg/{i}"
+            for i in [0, 1]]
+
+
+def test_LabelDataUploader_connection(mock_db_conn_fixture, bucket,
+                                      tmp_path, monkeypatch):
+    """without a connection, run() opens a pooled one for the manifest
+    query and closes it"""
+    mock_connection = MagicMock()
+    mock_connection.return_value.__enter__.return_value = \
+        mock_db_conn_fixture
+    monkeypatch.setattr(up.query_utils, "DbConnection", mock_connection)
+    monkeypatch.setattr(up.query_utils, "get_db_credentials",
+                        lambda **kwargs: {'user': kwargs['env_prefix']})
+    args = {
+            's3_bucket_name': bucket,
+            'timestamp': False,
+            'prefix': 'abc',
+            'output_json': str(tmp_path / "output.json"),
+            'roi_manifests_ids': [0],
+            'db_pool_size': 2}
+    ldu = up.LabelDataUploader(input_data=args, args=[])
+    ldu.run()
+
+    mock_connection.assert_called_once_with(user="LABELING_", pool_size=2)
+    mock_connection.return_value.__exit__.assert_called_once()
+    mock_db_conn_fixture.query.assert_called_once()
+
+
+def test_LabelDataUploader_mixed_formats(bucket, tmp_path):
+    """manifests of png and atlas runs, with different keys, are uploaded
+    together, each with its own references"""
+    sheet = tmp_path / "max_atlas_0.png"
+    full_video = tmp_path / "full_video.webm"
+    for path in [sheet, full_video]:
+        with open(path, "w") as fp:
+            fp.write('content')
+    # a '#' in a path is not a reference
+    png_dir = tmp_path / "run#2"
+    png_dir.mkdir()
+    manifests = []
+    for roi_id in [1, 2]:
+        manifest = {'experiment-id': 1234, 'roi-id': roi_id,
+                    'full-video-source-ref': str(full_video)}
+        for key in ['source-ref', 'max-source-ref']:
+            path = png_dir / f"{key}_{roi_id}.png"
+            with open(path, "w") as fp:
+                fp.write('content')
+            manifest[key] = str(path)
+        manifests.append(manifest)
+    # the png manifest has a trace, the atlas one does not
+    trace = tmp_path / "trace_1.json"
+    with open(trace, "w") as fp:
+        fp.write('content')
+    manifests[0]['trace-source-ref'] = str(trace)
+    manifests[1]['max-source-ref'] = f"{sheet}#xywh=0,0,4,4"
+    manifest_path = tmp_path / "manifest.jsonl"
+    with open(manifest_path, "w") as fp:
+        fp.write("\n".join([json.dumps(m) for m in manifests]))
+
+    output_json_path = tmp_path / "output.json"
+    args = {
+            's3_bucket_name': bucket,
+            'timestamp': False,
+            'prefix': 'abc',
+            'output_json': str(output_json_path),
+            'manifest_file': str(manifest_path)}
+    ldu = up.LabelDataUploader(input_data=args, args=[])
+    ldu.run(MagicMock())
+
+    response = boto3.client('s3').list_objects_v2(Bucket=bucket)
+    files_in_s3 = sorted(c['Key'] for c in response['Contents'])
+    assert files_in_s3 == sorted([
+        'abc/1234_max_atlas_0.png', 'abc/1234_full_video.webm',
+        'abc/source-ref_1.png', 'abc/source-ref_2.png',
+        'abc/max-source-ref_1.png', 'abc/trace_1.json',
+        'abc/manifest.json'])
+
+    with open(output_json_path, 'r') as f:
+        j = json.load(f)
+    assert len(j['failed_uploads']) == 0
+    with open(j['local_s3_manifest_copy'], 'r') as f:
+        s3_manifests = [json.loads(line) for line in f]
+    assert [m['max-source-ref'] for m in s3_manifests] == [
+            f"s3://{bucket}/abc/max-source-ref_1.png",
+            f"s3://{bucket}/abc/1234_max_atlas_0.png#xywh=0,0,4,4"]
+    assert s3_manifests[0]['trace-source-ref'] == \
+        f"s3://{bucket}/abc/trace_1.json"
+    assert 'trace-source-ref' not in s3_manifests[1]
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("/a/max_atlas_0.png#xywh=0,16,16,16",
+     ("/a/max_atlas_0.png", "xywh=0,16,16,16")),
+    ("/a#1/max_atlas_0.png#xywh=0,16,16,16",
+     ("/a#1/max_atlas_0.png", "xywh=0,16,16,16")),
+    ("/a/roi_artifacts.h5#full_outline/3",
+     ("/a/roi_artifacts.h5", "full_outline/3")),
+    ("/a/run#2/max_1.png", None),
+    ("/a/max_1.png#xywh=0,16", None),
+    ("/a/roi_artifacts.png#avg/3", None),
+    (1234, None)])
+def test_split_packed_ref(value, expected):
+    assert up.split_packed_ref(value) == expected
@@ -1,6 +1,7 @@
 import pytest
 from scipy.sparse import coo_matrix
 import numpy as np
+import h5py
 
 from slapp.transforms import array_utils as au
 
@@ -209,6 +210,101 @@ def test_content_extents(arr, shape, expected):
     assert np.all(bounds == expected)
 
 
+def test_content_boundaries():
+    rng = np.random.default_rng(0)
+    arrs = [coo_matrix(rng.random((12, 10)) > 0.9) for _ in range(20)]
+    arrs.append(coo_matrix((12, 10)))
+    offsets = np.concatenate([[0], np.cumsum([a.nnz for a in arrs])])
+    boundaries = au.content_boundaries(
+            offsets,
+            np.concatenate([a.row for a in arrs]),
+            np.concatenate([a.col for a in arrs]))
+    expected = [au.content_boundary_2d(a) for a in arrs]
+    np.testing.assert_array_equal(boundaries, expected)
+
+
+@pytest.mark.parametrize("shape", [(5, 5), (6, 7)])
+def test_batch_content_extents(shape):
+    """indexing and padding each array with its batch extents is the
+    same as cropping and padding it, including windows that extend past
+    the edges of the array
+    """
+    rng = np.random.default_rng(1)
+    arrs = []
+    for _ in range(30):
+        arr = np.zeros((12, 10))
+        top, left = rng.integers(0, 12), rng.integers(0, 10)
+        arr[top:(top + rng.integers(1, 5)),
+            left:(left + rng.integers(1, 5))] = 1 + rng.random()
+        arrs.append(arr)
+    boundaries = [au.content_boundary_2d(a) for a in arrs]
+    inds, pads = au.batch_content_extents(boundaries, shape, (12, 10))
+    assert inds.shape == (len(arrs), 4)
+    assert pads.shape == (len(arrs), 2, 2)
+    for arr, ind, pad in zip(arrs, inds, pads):
+        indexed = np.pad(arr[ind[0]:ind[1], ind[2]:ind[3]], pad)
+        cropped_padded = au.center_pad_2d(au.crop_2d_array(arr), shape)
+        np.testing.assert_array_equal(indexed, cropped_padded)
+
+
+@pytest.mark.parametrize(
+        "boundaries, shape, target_shape, expected_inds, expected_pads",
+        [
+            # odd padding goes after, no target_shape: no bottom clipping
+            ([[2, 4, 3, 6]], (5, 4), None, [[1, 6, 3, 7]],
+             [[[0, 0], [0, 0]]]),
+            # clipped at the top-left and the bottom-right
+            ([[0, 2, 0, 1], [8, 10, 9, 10]], (4, 5), (10, 10),
+             [[0, 3, 0, 3], [7, 10, 7, 10]],
+             [[[1, 0], [2, 0]], [[0, 1], [0, 2]]]),
+            # content larger than shape is cropped
+            ([[0, 6, 0, 6]], (3, 4), (10, 10), [[2, 5, 1, 5]],
+             [[[0, 0], [0, 0]]]),
+            ])
+def test_batch_content_extents_values(boundaries, shape, target_shape,
+                                      expected_inds, expected_pads):
+    inds, pads = au.batch_content_extents(boundaries, shape, target_shape)
+    np.testing.assert_array_equal(inds, expected_inds)
+    np.testing.assert_array_equal(pads, expected_pads)
+
+
+@pytest.mark.parametrize("leading_shape", [(), (3,)])
+@pytest.mark.parametrize("margin", [(0, 0), (2, 1), (4, 4)])
+def test_padded_array(leading_shape, margin, tmp_path):
+    rng = np.random.default_rng(2)
+    array = rng.integers(1, 255, size=(*leading_shape, 12, 10),
+                         dtype='uint8')
+    out = np.lib.format.open_memmap(
+            tmp_path / "padded.npy", mode="w+", dtype="uint8",
+            shape=au.PaddedArray.padded_shape(array.shape, margin))
+    for padded in [au.PaddedArray(array, margin),
+                   au.PaddedArray(array, margin, out=out, chunk_size=2)]:
+        assert padded.shape == array.shape
+        np.testing.assert_array_equal(padded.array, array)
+        boundaries = [[0, 2, 0, 1], [8, 12, 9, 10], [4, 6, 3, 7]]
+        inds, pads = au.batch_content_extents(boundaries, (5, 5), (12, 10))
+        for ind, pad in zip(inds, pads):
+            lead = ((0, 0),) * len(leading_shape)
+            expected = np.pad(array[..., ind[0]:ind[1], ind[2]:ind[3]],
+                              (*lead, *pad))
+            window = padded.window(ind, pad)
+            np.testing.assert_array_equal(window, expected)
+            covered = np.all(pad.max(axis=1) <= margin)
+            assert np.shares_memory(window, padded.padded) == covered
+
+
+def test_padded_array_from_padded():
+    array = np.arange(20).reshape(4, 5)
+    padded = au.PaddedArray.from_padded(array, (0, 0))
+    assert padded.padded is array
+    np.testing.assert_array_equal(
+            padded.window((0, 2, 0, 2), ((1, 0), (0, 1))),
+            np.pad(array[0:2, 0:2], ((1, 0), (0, 1))))
+
+    with pytest.raises(ValueError, match="out has shape"):
+        au.PaddedArray(array, (1, 1), out=np.zeros((4, 5)))
+
+
 @pytest.mark.parametrize(
         ("arr", "shape"),
         [
@@ -350,3 +446,316 @@ def test_downsample_exceptions(array, input_fps, output_fps, random_seed,
 def test_normalize_array(array, lower_cutoff, upper_cutoff, expected):
     normalized = au.normalize_array(array, lower_cutoff, upper_cutoff)
     np.testing.assert_array_equal(normalized, expected)
+
+
+def copy_normalize(array, lower_cutoff, upper_cutoff):
+    """normalize_array() before it worked in place"""
+    normalized = np.copy(array)
+    normalized[array < lower_cutoff] = lower_cutoff
+    normalized[array > upper_cutoff] = upper_cutoff
+    normalized -= lower_cutoff
+    return np.uint8(normalized * 255 / (upper_cutoff - lower_cutoff))
+
+
+@pytest.mark.parametrize("dtype", ['float64', 'float32'])
+@pytest.mark.parametrize("chunk_size", [1, 7, 100])
+def test_normalize_array_float(dtype, chunk_size):
+    rng = np.random.default_rng(5)
+    array = (rng.random((20, 6, 5)) * 1000).astype(dtype)
+    lower_cutoff, upper_cutoff = np.quantile(array, [0.1, 0.9])
+    expected = copy_normalize(array, lower_cutoff, upper_cutoff)
+    normalized = au.normalize_array(array, lower_cutoff, upper_cutoff,
+                                    chunk_size=chunk_size)
+    assert normalized.dtype == np.uint8
+    np.testing.assert_array_equal(normalized, expected)
+
+    out = np.zeros(array.shape, dtype='uint8')
+    result = au.normalize_array(array, lower_cutoff, upper_cutoff, out=out,
+                                chunk_size=chunk_size)
+    assert result is out
+    np.testing.assert_array_equal(out, expected)
+
+
+@pytest.mark.parametrize("dtype", ['uint16', 'int16', 'uint8'])
+def test_normalize_array_lut(dtype, tmp_path):
+    """the lookup table gives the same values as normalizing the
+    array as float64, also when read from an h5 dataset
+    """
+    rng = np.random.default_rng(6)
+    info = np.iinfo(dtype)
+    array = rng.integers(info.min, info.max, size=(9, 4, 3),
+                         endpoint=True).astype(dtype)
+    lower_cutoff, upper_cutoff = np.quantile(array, [0.2, 0.99])
+    expected = copy_normalize(array.astype('float64'), lower_cutoff,
+                              upper_cutoff)
+    np.testing.assert_array_equal(
+            au.normalize_array(array, lower_cutoff, upper_cutoff,
+                               chunk_size=4),
+            expected)
+
+    h5path = tmp_path / "movie.h5"
+    with h5py.File(h5path, "w") as f:
+        f.create_dataset("data", data=array)
+    with h5py.File(h5path, "r") as f:
+        np.testing.assert_array_equal(
+                au.normalize_array(f["data"], lower_cutoff, upper_cutoff),
+                expected)
+
+
+def test_normalize_array_exceptions():
+    with pytest.raises(ValueError, match="out has shape"):
+        au.normalize_array(np.zeros((3, 3)), 0, 1,
+                           out=np.zeros((3, 2), dtype='uint8'))
+    with pytest.raises(ValueError, match="no lookup table"):
+        au.normalize_lut('int32', 0, 1)
+
+
+@pytest.mark.parametrize("npts_in", [31, 100, 1001])
+@pytest.mark.parametrize("input_fps, output_fps", [(31, 4), (7, 2), (4, 4)])
+def test_downsample_bin_edges(npts_in, input_fps, output_fps):
+    """bins should be the same as the original np.array_split bins"""
+    npts_out = int(npts_in * output_fps / input_fps)
+    expected = np.array_split(np.arange(npts_in), npts_out)
+    edges = au.downsample_bin_edges(npts_in, input_fps, output_fps)
+    assert len(edges) == npts_out + 1
+    for i, expected_bin in enumerate(expected):
+        np.testing.assert_array_equal(
+                np.arange(edges[i], edges[i + 1]), expected_bin)
+
+
+def test_downsample_bin_edges_exceptions():
+    with pytest.raises(ValueError):
+        au.downsample_bin_edges(10, 4, 31)
+    with pytest.raises(ValueError):
+        au.downsample_bin_edges(3, 31, 4)
+
+
+@pytest.mark.parametrize("strategy", ["average", "first", "last", "random"])
+def test_downsample_bins_in_blocks(strategy):
+    """downsampling block by block with a shared rng should be the
+    same as downsampling all at once
+    """
+    rng = np.random.default_rng(42)
+    array = rng.integers(0, 100, size=(103, 3, 4))
+    expected = au.downsample_array(array, 31, 4, strategy, random_seed=3)
+
+    edges = au.downsample_bin_edges(array.shape[0], 31, 4)
+    block_rng = np.random.default_rng(3)
+    blocks = []
+    for i in range(0, len(edges) - 1, 5):
+        j = min(i + 5, len(edges) - 1)
+        blocks.append(au.downsample_bins(
+            array[edges[i]:edges[j]], edges[i:(j + 1)] - edges[i],
+            strategy, block_rng))
+    np.testing.assert_array_equal(np.concatenate(blocks), expected)
+
+
+@pytest.mark.parametrize("strategy", ["average", "first", "last", "random"])
+def test_downsample_bins_compressed_h5(tmp_path, strategy):
+    """bins of part of a compressed dataset"""
+    rng = np.random.default_rng(1)
+    array = rng.integers(0, 100, size=(103, 3, 4))
+    h5path = tmp_path / "array.h5"
+    with h5py.File(h5path, "w") as f:
+        f.create_dataset("data", data=array, chunks=(8, 3, 4),
+                         compression="gzip")
+    edges = au.downsample_bin_edges(103, 31, 4)[3:10]
+    expected = au.downsample_bins(array, edges, strategy,
+                                  np.random.default_rng(2))
+    with h5py.File(h5path, "r") as f:
+        obtained = au.downsample_bins(f["data"], edges, strategy,
+                                      np.random.default_rng(2))
+    np.testing.assert_array_equal(obtained, expected)
+
+
+@pytest.mark.parametrize("block_edges", [
+    [0, 103],
+    [0, 1, 2, 50, 51, 103],
+    list(range(0, 103, 5)) + [103],
+    list(range(104))])
+@pytest.mark.parametrize("strategy", ["average", "first", "last", "random"])
+def test_downsample_blocks(block_edges, strategy):
+    rng = np.random.default_rng(42)
+    array = rng.integers(0, 100, size=(103, 3, 4))
+    expected = au.downsample_array(array, 31, 4, strategy, random_seed=3)
+    blocks = [array[i:j] for i, j in zip(block_edges[:-1], block_edges[1:])]
+    chunks = list(au.downsample_blocks(
+            blocks, block_edges, au.downsample_bin_edges(103, 31, 4),
+            strategy, np.random.default_rng(3)))
+    assert all([len(c) > 0 for c in chunks])
+    np.testing.assert_array_equal(np.concatenate(chunks), expected)
+
+
+@pytest.mark.parametrize("nchunks", [1, 3, 10])
+def test_projections_from_chunks(nchunks):
+    rng = np.random.default_rng(0)
+    video = rng.integers(0, 2**16, size=(50, 6, 7), dtype='uint16')
+    avg, mx, nframes = au.projections_from_chunks(
+            np.array_split(video, nchunks))
+    assert nframes == 50
+    np.testing.assert_allclose(avg, np.mean(video, axis=0))
+    np.testing.assert_array_equal(mx, np.max(video, axis=0))
+
+
+def test_projections_from_chunks_empty():
+    with pytest.raises(ValueError):
+        au.projections_from_chunks([])
+
+
+def loop_downsample(array, input_fps, output_fps, strategy, random_seed):
+    """the original, per-bin, implementation of downsample_array"""
+    npts_in = array.shape[0]
+    npts_out = int(npts_in * output_fps / input_fps)
+    bin_list = np.array_split(np.arange(npts_in), npts_out)
+    array_out = np.zeros((npts_out, *array.shape[1:]))
+    rng = np.random.default_rng(random_seed)
+    sampling_strategies = {
+            'random': lambda arr, idx: arr[rng.choice(idx)],
+            'maximum': lambda arr, idx: arr[idx].max(axis=0),
+            'average': lambda arr, idx: arr[idx].mean(axis=0),
+            'first': lambda arr, idx: arr[idx[0]],
+            'last': lambda arr, idx: arr[idx[-1]]
+            }
+    sampler = sampling_strategies[strategy]
+    for i, bin_indices in enumerate(bin_list):
+        array_out[i] = sampler(array, bin_indices)
+    return array_out
+
+
+@pytest.mark.parametrize("h5_kwargs", [
+    None,
+    {},
+    {'chunks': (10, 5, 6), 'compression': 'gzip'},
+    {'chunks': (40, 5, 6), 'compression': 'gzip'}])
+@pytest.mark.parametrize("block_size", [1, 17, 1000])
+@pytest.mark.parametrize("strategy", ["average", "first", "last", "random"])
+def test_downsample_vs_loop(tmp_path, h5_kwargs, block_size, strategy):
+    rng = np.random.default_rng(7)
+    array = rng.integers(0, 2**16, size=(251, 5, 6), dtype='uint16')
+    expected = loop_downsample(array, 31, 4, strategy, 11)
+    if h5_kwargs is not None:
+        h5path = tmp_path / "array.h5"
+        with h5py.File(h5path, "w") as f:
+            f.create_dataset("data", data=array, **h5_kwargs)
+        with h5py.File(h5path, "r") as f:
+            obtained = au.downsample_array(f["data"], 31, 4, strategy, 11,
+                                           block_size=block_size)
+    else:
+        obtained = au.downsample_array(array, 31, 4, strategy, 11,
+                                       block_size=block_size)
+    assert obtained.dtype == 'float64'
+    np.testing.assert_allclose(obtained, expected, rtol=1e-12)
+
+
+@pytest.mark.parametrize("strategy", ["maximum", "average", "first"])
+def test_downsample_1d_vs_loop(strategy):
+    rng = np.random.default_rng(3)
+    array = rng.random(1000)
+    expected = loop_downsample(array, 31, 4, strategy, 0)
+    np.testing.assert_allclose(
+            au.downsample_array(array, 31, 4, strategy, block_size=50),
+            expected, rtol=1e-12)
+
+
+@pytest.mark.parametrize("dtype", ["float32", "uint16"])
+def test_downsample_dtype(dtype):
+    array = np.arange(70, dtype='uint16').reshape(35, 2)
+    obtained = au.downsample_array(array, 7, 2, "first", dtype=dtype)
+    assert obtained.dtype == dtype
+    np.testing.assert_array_equal(obtained, array[[0, 4, 8, 12, 16, 20, 23,
+                                                   26, 29, 32]])
+
+
+def test_downsample_bins_strategy_exception():
+    with pytest.raises(ValueError):
+        au.downsample_bins(np.zeros(10), np.array([0, 5, 10]), "median")
+
+
+QS = [0.0, 0.1, 0.25, 0.5, 0.77, 0.999, 1.0]
+
+
+@pytest.mark.parametrize("dtype", ["uint8", "uint16", "int16"])
+@pytest.mark.parametrize("mode", ["auto", "integer", "exact"])
+def test_streaming_quantiles_integer(dtype, mode):
+    rng = np.random.default_rng(4)
+    info = np.iinfo(dtype)
+    array = rng.integers(info.min, info.max, size=(37, 8, 9), dtype=dtype)
+    estimator = au.StreamingQuantiles(mode=mode)
+    for i in range(0, 37, 5):
+        estimator.update(array[i:i + 5])
+    assert estimator.error == 0.0
+    np.testing.assert_array_equal(estimator.quantile(QS),
+                                  np.quantile(array, QS))
+    assert estimator.quantile(0.3) == np.quantile(array, 0.3)
+
+
+@pytest.mark.parametrize("nbins", [64, 1000])
+def test_streaming_quantiles_histogram(nbins):
+    rng = np.random.default_rng(5)
+    # chunks that extend the range on both sides
+    chunks = [rng.normal(loc, scale, size=(4, 10, 10))
+              for loc, scale in [(0, 1), (5, 0.1), (-20, 3), (100, 10)]]
+    estimator = au.StreamingQuantiles(nbins=nbins)
+    for chunk in chunks:
+        estimator.update(chunk)
+    assert estimator.mode == 'histogram'
+    expected = np.quantile(np.concatenate(chunks), QS)
+    obtained = estimator.quantile(QS)
+    assert obtained.shape == (len(QS),)
+    assert np.all(np.abs(obtained - expected) <= estimator.error)
+    assert obtained[0] == expected[0]
+    assert obtained[-1] == expected[-1]
+
+
+def test_streaming_quantiles_merge():
+    rng = np.random.default_rng(6)
+    array = rng.random((40, 6, 6)) * 50
+    estimators = [au.StreamingQuantiles(nbins=256) for _ in range(2)]
+    estimators[0].update(array[:25])
+    estimators[1].update(array[25:] + 30)
+    estimators[0].merge(estimators[1])
+    expected = np.quantile(np.concatenate([array[:25], array[25:] + 30]), QS)
+    assert np.all(np.abs(estimators[0].quantile(QS) - expected) <=
+                  estimators[0].error)
+
+    integer = [au.StreamingQuantiles() for _ in range(3)]
+    integer[0].update(np.arange(10, dtype='uint8'))
+    integer[1].update(np.arange(5, 30, dtype='uint8'))
+    integer[2].merge(integer[0])
+    integer[2].merge(integer[1])
+    np.testing.assert_array_equal(
+            integer[2].quantile(QS),
+            np.quantile(np.concatenate([np.arange(10), np.arange(5, 30)]),
+                        QS))
+
+
+def test_streaming_quantiles_constant():
+    estimator = au.StreamingQuantiles()
+    estimator.update(np.full((3, 4), 2.5))
+    np.testing.assert_array_equal(estimator.quantile(QS), 2.5)
+
+
+def test_streaming_quantiles_projections():
+    rng = np.random.default_rng(7)
+    array = rng.integers(0, 2**12, size=(30, 5, 5), dtype='uint16')
+    estimator = au.StreamingQuantiles()
+    au.projections_from_chunks((array[i:i + 7] for i in range(0, 30, 7)),
+                               quantiles=estimator)
+    np.testing.assert_array_equal(estimator.quantile(QS),
+                                  np.quantile(array, QS))
+
+
+def test_streaming_quantiles_exceptions():
+    with pytest.raises(ValueError, match="not defined"):
+        au.StreamingQuantiles(mode="median")
+    with pytest.raises(ValueError, match="no values"):
+        au.StreamingQuantiles().quantile(0.5)
+    with pytest.raises(ValueError, match="at most 16 bits"):
+        au.StreamingQuantiles(mode="integer").update(
+                np.arange(3, dtype='int32'))
+    exact = au.StreamingQuantiles(mode="exact")
+    exact.update(np.arange(3))
+    histogram = au.StreamingQuantiles()
+    histogram.update(np.arange(3.0))
+    with pytest.raises(ValueError, match="can not merge"):
+        exact.merge(histogram)
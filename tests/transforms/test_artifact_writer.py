@@ -0,0 +1,232 @@
+import json
+import h5py
+import imageio
+import numpy as np
+import pytest
+
+from slapp.transforms import artifact_writer
+
+
+@pytest.mark.parametrize("max_workers", [0, 1, 3])
+@pytest.mark.parametrize("compression", [0, 6, 9])
+def test_png_writer(max_workers, compression, tmp_path):
+    rng = np.random.default_rng(0)
+    images = rng.integers(0, 256, size=(10, 16, 16), dtype='uint8')
+    with artifact_writer.PngWriter(max_workers=max_workers,
+                                   compression=compression,
+                                   max_pending=2) as writer:
+        for i, image in enumerate(images):
+            writer.submit(tmp_path / f"{i}.png", image, transparency=0)
+    stats = writer.stats
+    assert stats['files'] == 10
+    assert stats['bytes'] == sum((tmp_path / f"{i}.png").stat().st_size
+                                 for i in range(10))
+    for i, image in enumerate(images):
+        np.testing.assert_array_equal(imageio.imread(tmp_path / f"{i}.png"),
+                                      image)
+
+
+def test_png_writer_compression(tmp_path):
+    image = np.tile(np.arange(64, dtype='uint8'), (64, 1))
+    sizes = [artifact_writer.write_png(tmp_path / f"{level}.png", image,
+                                       compression=level)
+             for level in [0, 9]]
+    assert sizes[1] < sizes[0]
+
+
+def test_png_writer_exceptions(tmp_path):
+    with pytest.raises(ValueError, match="compression"):
+        artifact_writer.PngWriter(compression=10)
+
+    # errors of the writing threads are raised when flushing
+    writer = artifact_writer.PngWriter(max_workers=2)
+    writer.submit(tmp_path / "missing" / "0.png", np.zeros((4, 4), 'uint8'))
+    with pytest.raises(FileNotFoundError):
+        writer.close()
+
+
+def read_tile(ref):
+    """the image referenced by an AtlasWriter.ref()"""
+    path, fragment = ref.split("#xywh=")
+    x, y, width, height = [int(i) for i in fragment.split(",")]
+    return imageio.imread(path)[y:(y + height), x:(x + width)]
+
+
+@pytest.mark.parametrize("columns, tiles_per_sheet", [(2, 4), (3, 3),
+                                                      (32, 1024)])
+def test_atlas_writer(columns, tiles_per_sheet, tmp_path):
+    rng = np.random.default_rng(1)
+    images = rng.integers(0, 256, size=(7, 2, 5, 4), dtype='uint8')
+    tiles = {}
+    for i in range(7):
+        for kind in ["mask", "max"]:
+            tiles[tmp_path / f"{kind}_{i}.png"] = (kind, i)
+    atlas = artifact_writer.AtlasWriter(
+            tmp_path, tiles, (5, 4), columns=columns,
+            tiles_per_sheet=tiles_per_sheet)
+    for i in range(7):
+        atlas.submit(tmp_path / f"mask_{i}.png", images[i, 0],
+                     transparency=0)
+        atlas.submit(tmp_path / f"max_{i}.png", images[i, 1])
+    # images without a tile are written as they are
+    atlas.submit(tmp_path / "other.png", images[0, 0])
+    stats = atlas.close()
+
+    nsheets = -(-7 // tiles_per_sheet)
+    assert stats['files'] == 2 * nsheets + 1
+    assert not (tmp_path / "mask_0.png").exists()
+    np.testing.assert_array_equal(imageio.imread(tmp_path / "other.png"),
+                                  images[0, 0])
+    assert atlas.ref(tmp_path / "other.png") == str(tmp_path / "other.png")
+    for i in range(7):
+        for j, kind in enumerate(["mask", "max"]):
+            ref = atlas.ref(tmp_path / f"{kind}_{i}.png")
+            assert ref.startswith(str(tmp_path / f"{kind}_atlas_"))
+            np.testing.assert_array_equal(read_tile(ref), images[i, j])
+
+    with open(tmp_path / "atlas_index.json", "r") as f:
+        index = json.load(f)
+    assert index['tile_shape'] == [5, 4]
+    assert len(index['sheets']) == 2 * nsheets
+    assert index['tiles'] == {str(path): atlas.ref(path) for path in tiles}
+
+
+def test_atlas_writer_exceptions(tmp_path):
+    with pytest.raises(ValueError, match="multiple of columns"):
+        artifact_writer.AtlasWriter(tmp_path, {}, (5, 4), columns=3,
+                                    tiles_per_sheet=10)
+    atlas = artifact_writer.AtlasWriter(
+            tmp_path, {tmp_path / "a.png": ("mask", 0)}, (5, 4))
+    with pytest.raises(ValueError, match="does not fit"):
+        atlas.submit(tmp_path / "a.png", np.zeros((4, 5), dtype='uint8'))
+
+
+def test_tile_buffer(tmp_path):
+    writer = artifact_writer.PngWriter(max_workers=0)
+    buffer = artifact_writer.TileBuffer(
+            [tmp_path / "held.png", tmp_path / "held.json"], writer)
+    image = np.zeros((3, 3), dtype='uint8')
+    buffer.submit(tmp_path / "held.png", image, transparency=0)
+    buffer.submit(tmp_path / "written.png", image)
+    assert (tmp_path / "written.png").exists()
+    assert not (tmp_path / "held.png").exists()
+    buffer.submit_json(tmp_path / "held.json", {"trace": [1.0]})
+    buffer.submit_json(tmp_path / "written.json", {"trace": [2.0]})
+    with open(tmp_path / "written.json") as f:
+        assert json.load(f) == {"trace": [2.0]}
+    held = buffer.take()
+    assert held == ([(tmp_path / "held.png", image, {'transparency': 0})],
+                    [(tmp_path / "held.json", {"trace": [1.0]})])
+    assert buffer.take() == ([], [])
+
+    # replayed to the writer which would have written them
+    artifact_writer.TileBuffer.replay(held, writer)
+    assert (tmp_path / "held.png").exists()
+    assert (tmp_path / "held.json").exists()
+
+
+@pytest.mark.parametrize("chunk_rois", [1, 2, 64])
+@pytest.mark.parametrize("compression", [0, 4])
+def test_h5_artifact_writer(chunk_rois, compression, tmp_path):
+    rng = np.random.default_rng(0)
+    roi_ids = [12, 5, 30, 7, 9]
+    masks = rng.integers(0, 256, size=(5, 6, 4), dtype='uint8')
+    traces = rng.random(size=(5, 8))
+    slots = {}
+    for i in range(5):
+        slots[tmp_path / f"mask_{i}.png"] = ("mask", i)
+        slots[tmp_path / f"trace_{i}.json"] = ("trace", i)
+    h5_path = tmp_path / "roi_artifacts.h5"
+    writer = artifact_writer.H5ArtifactWriter(
+            h5_path, slots, roi_ids, chunk_rois=chunk_rois,
+            compression=compression)
+    # out of order, as the ROI workers may finish
+    for i in [3, 0, 4, 1, 2]:
+        writer.submit(tmp_path / f"mask_{i}.png", masks[i], transparency=0)
+        writer.submit_json(tmp_path / f"trace_{i}.json",
+                           {"pointInterval": 0.1, "trace": traces[i].tolist()})
+    writer.submit(tmp_path / "other.png", masks[0])
+    writer.close()
+    assert (tmp_path / "other.png").exists()
+    assert not (tmp_path / "mask_0.png").exists()
+    assert writer.ref(tmp_path / "mask_3.png") == f"{h5_path}#mask/3"
+    assert writer.ref(tmp_path / "other.png") == str(tmp_path / "other.png")
+
+    with artifact_writer.H5ArtifactStore(h5_path) as store:
+        assert len(store) == 5
+        assert sorted(store.kinds) == ["mask", "trace"]
+        np.testing.assert_array_equal(store.roi_ids, roi_ids)
+        np.testing.assert_array_equal(store.read("mask"), masks)
+        np.testing.assert_array_equal(store.read("trace", 1, 3), traces[1:3])
+        entry = store[30]
+        np.testing.assert_array_equal(entry["mask"], masks[2])
+        np.testing.assert_array_equal(entry["trace"], traces[2])
+        with pytest.raises(KeyError, match="roi 31"):
+            store[31]
+    with h5py.File(h5_path, "r") as f:
+        assert f["mask"].chunks == (min(chunk_rois, 5), 6, 4)
+        assert f["trace"].attrs["pointInterval"] == 0.1
+        assert f["mask"].compression == ("gzip" if compression else None)
+
+
+def test_h5_artifact_writer_partial(tmp_path):
+    """entries which were not submitted are zero"""
+    slots = {tmp_path / f"{i}.png": ("max", i) for i in range(3)}
+    writer = artifact_writer.H5ArtifactWriter(
+            tmp_path / "a.h5", slots, [1, 2, 3], chunk_rois=2)
+    writer.submit(tmp_path / "0.png", np.ones((2, 2), dtype='uint8'))
+    writer.submit(tmp_path / "2.png", np.ones((2, 2), dtype='uint8'))
+    writer.close()
+    with artifact_writer.H5ArtifactStore(tmp_path / "a.h5") as store:
+        np.testing.assert_array_equal(store.read("max")[:, 0, 0], [1, 0, 1])
+
+
+def test_h5_artifact_writer_exceptions(tmp_path):
+    with pytest.raises(ValueError, match="chunk_rois"):
+        artifact_writer.H5ArtifactWriter(tmp_path / "a.h5", {}, [1],
+                                         chunk_rois=0)
+    writer = artifact_writer.H5ArtifactWriter(
+            tmp_path / "b.h5",
+            {tmp_path / "0.png": ("mask", 0), tmp_path / "1.png": ("mask", 1)},
+            [1, 2])
+    writer.submit(tmp_path / "0.png", np.zeros((5, 4), dtype='uint8'))
+    with pytest.raises(ValueError, match="does not fit"):
+        writer.submit(tmp_path / "1.png", np.zeros((4, 5), dtype='uint8'))
+    writer.close()
+
+
+def test_writers_abort(tmp_path):
+    """an error drops the queued and packed images, and removes the
+    incomplete h5 file"""
+    image = np.zeros((5, 4), dtype='uint8')
+    slots = {tmp_path / "0.png": ("mask", 0), tmp_path / "1.png": ("mask", 1)}
+
+    with pytest.raises(RuntimeError, match="stage failed"):
+        with artifact_writer.AtlasWriter(
+                tmp_path, slots, (5, 4),
+                writer=artifact_writer.PngWriter(max_workers=2)) as atlas:
+            atlas.submit(tmp_path / "0.png", image)
+            raise RuntimeError("stage failed")
+    assert not atlas.sheet_path("mask", 0).exists()
+    assert not (tmp_path / atlas.index_name).exists()
+
+    with pytest.raises(RuntimeError, match="stage failed"):
+        with artifact_writer.H5ArtifactWriter(tmp_path / "a.h5", slots,
+                                              [1, 2]) as writer:
+            writer.submit(tmp_path / "0.png", image)
+            raise RuntimeError("stage failed")
+    assert not (tmp_path / "a.h5").exists()
+
+
+def test_writers_close_twice(tmp_path):
+    image = np.zeros((5, 4), dtype='uint8')
+    slots = {tmp_path / "0.png": ("mask", 0)}
+    with artifact_writer.H5ArtifactWriter(tmp_path / "a.h5", slots,
+                                          [1]) as writer:
+        writer.submit(tmp_path / "0.png", image)
+        writer.submit(tmp_path / "other.png", image)
+        stats = writer.close()
+    assert writer.close() == stats
+    assert stats['files'] == 1
+    with artifact_writer.H5ArtifactStore(tmp_path / "a.h5") as store:
+        np.testing.assert_array_equal(store[1]["mask"], image)
@@ -1,5 +1,6 @@
 import pytest
 import numpy as np
+import cv2
 import slapp.transforms.image_utils as image_utils
 
 
@@ -68,3 +69,60 @@ def test_add_scale_array(test_image, scale_position, um_per_pixel,
 
     assert test_image.dtype == array_with_scale.dtype
     np.testing.assert_array_equal(array_with_scale, expected)
+
+
+def draw_scale(array, scale_position, um_per_pixel, scale_size_um, color,
+               thickness_um, fontScale):
+    """scale bar drawn directly with opencv, as add_scale() used to"""
+    annotated = np.copy(array)
+    length = np.round(scale_size_um / um_per_pixel).astype('int')
+    thickness = np.round(thickness_um / um_per_pixel).astype('int')
+    pt1 = (scale_position[0], scale_position[1] - length + 1)
+    pt2 = (scale_position[0] + length - 1, scale_position[1])
+    cv2.putText(annotated, f"{int(scale_size_um)}um", pt2,
+                cv2.FONT_HERSHEY_SIMPLEX, fontScale, color, thickness,
+                cv2.LINE_4)
+    cv2.line(annotated, scale_position, pt1, color, thickness, cv2.LINE_4)
+    cv2.line(annotated, scale_position, pt2, color, thickness, cv2.LINE_4)
+    return annotated
+
+
+@pytest.mark.parametrize(
+        "shape, scale_position, scale_size_um, color, thickness_um, "
+        "fontScale",
+        [
+            ((128, 128), (5, 123), 10, 0, 1.0, 0.3),
+            ((512, 512), (30, 482), 40, 0, 1.5, 0.8),
+            ((512, 512), (30, 482), 40, 200, 1.5, 0.8),
+            ((40, 60), (2, 38), 5, 255, 1.0, 0.2)])
+def test_add_scale_matches_opencv(shape, scale_position, scale_size_um,
+                                  color, thickness_um, fontScale):
+    rng = np.random.default_rng(0)
+    images = rng.integers(0, 256, size=(3, *shape), dtype='uint8')
+    expected = np.array([
+        draw_scale(image, scale_position, 400 / 512, scale_size_um, color,
+                   thickness_um, fontScale)
+        for image in images])
+
+    for image, expected_image in zip(images, expected):
+        for _ in range(2):
+            # the second call uses the cached stamp
+            obtained = image_utils.add_scale(
+                    image, scale_position, 400 / 512, scale_size_um, color,
+                    thickness_um, fontScale)
+            np.testing.assert_array_equal(obtained, expected_image)
+
+    # a batch of images at once, in place
+    batch = images.copy()
+    obtained = image_utils.add_scale(
+            batch, list(scale_position), 400 / 512, scale_size_um, color,
+            thickness_um, fontScale, inplace=True)
+    assert obtained is batch
+    np.testing.assert_array_equal(batch, expected)
+
+
+def test_add_scale_exceptions():
+    with pytest.raises(NotImplementedError):
+        image_utils.add_scale(np.zeros((4, 4)), (0, 3))
+    with pytest.raises(NotImplementedError):
+        image_utils.add_scale(np.zeros((2, 2, 4, 4), dtype='uint8'), (0, 3))
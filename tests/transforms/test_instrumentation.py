@@ -0,0 +1,62 @@
+import json
+import pstats
+
+import numpy as np
+import pytest
+
+from slapp.transforms import instrumentation
+
+
+def test_timed():
+    timings = {}
+    for _ in range(2):
+        with instrumentation.timed(timings, "step"):
+            pass
+    assert list(timings) == ["step"]
+    assert timings["step"] >= 0
+
+    # no timings, no recording
+    with instrumentation.timed(None, "step"):
+        pass
+
+
+def test_pipeline_report(tmp_path):
+    report = instrumentation.PipelineReport()
+    with report.stage("write"):
+        np.save(tmp_path / "data.npy", np.zeros(10000))
+    with pytest.raises(ZeroDivisionError):
+        with report.stage("fail"):
+            1 / 0
+    report.add_roi(1, 7, {"png": 0.5, "total": 1.0})
+    report.add_roi(2, 7, {"total": 3.0})
+    report.write(tmp_path / "report.json")
+
+    with open(tmp_path / "report.json", "r") as f:
+        summary = json.load(f)
+    assert [s["name"] for s in summary["stages"]] == ["write", "fail"]
+    for stage in summary["stages"]:
+        assert stage["wall_s"] >= 0
+        assert stage["peak_rss_so_far_bytes"] > 0
+        assert summary["peak_rss_bytes"] >= stage["peak_rss_so_far_bytes"]
+    read_bytes, write_bytes = instrumentation.io_bytes()
+    if write_bytes is not None:
+        assert summary["stages"][0]["write_bytes"] >= 80000
+    assert summary["roi_summary"] == {
+            "png": {"total_s": 0.5, "mean_s": 0.5, "max_s": 0.5},
+            "total": {"total_s": 4.0, "mean_s": 2.0, "max_s": 3.0}}
+    assert summary["rois"][1] == {"roi_id": 2, "experiment_id": 7,
+                                  "total": 3.0}
+
+
+def test_profiled(tmp_path):
+    with instrumentation.profiled("cProfile", tmp_path / "profile.prof"):
+        np.zeros(10).sum()
+    pstats.Stats(str(tmp_path / "profile.prof"))
+
+    with instrumentation.profiled(None, tmp_path / "none.prof"):
+        pass
+    assert not (tmp_path / "none.prof").exists()
+
+    with pytest.raises(ValueError, match="not defined"):
+        with instrumentation.profiled("yappi", tmp_path / "profile"):
+            pass
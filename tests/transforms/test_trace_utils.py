@@ -0,0 +1,56 @@
+import h5py
+import numpy as np
+import pytest
+
+from slapp.transforms.trace_utils import TraceStore
+
+
+@pytest.fixture
+def traces_h5(tmp_path):
+    names = np.array([b'4', b'3', b'1', b'2', b'3'])
+    data = np.arange(5 * 6, dtype='float32').reshape(5, 6)
+    h5_path = tmp_path / "traces.h5"
+    with h5py.File(h5_path, "w") as f:
+        f.create_dataset("roi_names", data=names)
+        f.create_dataset("data", data=data)
+    yield h5_path, names.astype(int).tolist(), data
+
+
+@pytest.mark.parametrize("roi_ids", [
+    [1], [3, 1, 2], [2, 2, 4], [4, 3, 1, 2], []])
+def test_trace_store(traces_h5, roi_ids):
+    h5_path, names, data = traces_h5
+    with TraceStore(h5_path) as store:
+        assert store.roi_ids == [4, 3, 1, 2]
+        assert len(store) == 4
+        traces = store.get_many(roi_ids)
+        assert traces.shape == (len(roi_ids), data.shape[1])
+        for roi_id, trace in zip(roi_ids, traces):
+            # same lookup as the list.index() it replaces
+            expected = data[names.index(roi_id)]
+            np.testing.assert_array_equal(trace, expected)
+            np.testing.assert_array_equal(store.get(roi_id), expected)
+            assert roi_id in store
+
+
+def test_trace_store_exception(traces_h5):
+    h5_path, _, _ = traces_h5
+    with TraceStore(h5_path) as store:
+        assert 5 not in store
+        with pytest.raises(KeyError, match="no trace for roi id 5"):
+            store.get(5)
+        with pytest.raises(KeyError):
+            store.get_many([1, 5])
+
+
+def test_trace_store_closes_on_error(tmp_path):
+    h5_path = tmp_path / "traces.h5"
+    with h5py.File(h5_path, "w") as f:
+        f.create_dataset("data", data=np.zeros((2, 3)))
+    # the traceback keeps the half-built store alive
+    with pytest.raises(KeyError) as excinfo:
+        TraceStore(h5_path)
+    # a file still open for reading could not be truncated
+    with h5py.File(h5_path, "w") as f:
+        f.create_dataset("roi_names", data=np.array([b'1', b'2']))
+    assert excinfo.type is KeyError
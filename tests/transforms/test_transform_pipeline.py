@@ -1,49 +1,16 @@
 import pytest
-from unittest.mock import ANY, call, MagicMock
+from unittest.mock import ANY, MagicMock
 from pathlib import Path
-from functools import partial
-import os
 import numpy as np
 import json
 import h5py
+import imageio
+import imageio_ffmpeg as mpg
+import jsonlines
+import marshmallow as mm
 
-from slapp.transforms import transform_pipeline
-
-
-@pytest.fixture
-def mock_db_conn_fixture(request):
-    query_return_values = request.param
-
-    def mock_query(query_string):
-        return query_return_values[query_string]
-
-    def mock_insert(statements):
-        return
-
-    mock_db_conn = MagicMock()
-    mock_db_conn.query.side_effect = mock_query
-    mock_db_conn.bulk_insert.side_effect = mock_insert
-    return mock_db_conn
-
-
-@pytest.fixture
-def mock_roi():
-
-    def mock_roi_from_query(roi_id, db_conn) -> MagicMock:
-        mock_ROI = MagicMock()
-        mock_ROI.roi_id = roi_id
-
-        roi = db_conn.query(f"SELECT * FROM rois WHERE id={roi_id}")[0]
-        segmentation_run = db_conn.query(
-            ("SELECT * FROM segmentation_runs WHERE "
-             f"id={roi['segmentation_run_id']}"))[0]
-
-        mock_ROI.experiment_id = segmentation_run['ophys_experiment_id']
-        return mock_ROI
-
-    mock_ROI = MagicMock()
-    mock_ROI.roi_from_query.side_effect = mock_roi_from_query
-    return mock_ROI
+from slapp.transforms import artifact_writer, transform_pipeline
+from slapp.rois import ROISet
 
 
 @pytest.fixture
@@ -163,126 +130,668 @@ def test_xform_from_prod_manifest(tmp_path, production_roi_manifest):
                 roi.trace, params['trace_content']['trace'][ind])
 
 
-def create_expected_manifest(experiment_id, roi_id, segmentation_run_id,
-                             save_path, dtime):
-    out_dirname = f"seg_run_id_{segmentation_run_id}/{dtime}"
-    expected_manifest = {
-        "experiment-id": experiment_id,
-        "roi-id": roi_id,
-        "source-ref": f"{save_path}/{out_dirname}/outline_{roi_id}.png",
-        "roi-mask-source-ref": f"{save_path}/{out_dirname}/mask_{roi_id}.png",
-        "full-video-source-ref": f"{save_path}/{out_dirname}/full_video.webm",
-        "video-source-ref": f"{save_path}/{out_dirname}/video_{roi_id}.webm",
-        "max-source-ref": f"{save_path}/{out_dirname}/max_{roi_id}.png",
-        "avg-source-ref": f"{save_path}/{out_dirname}/avg_{roi_id}.png",
-        "trace-source-ref": f"{save_path}/{out_dirname}/trace_{roi_id}.json",
-        "full-outline-source-ref": f"{save_path}/{out_dirname}/"
-                                   f"full_outline_{roi_id}.png"
-    }
-    return expected_manifest
-
-
-@pytest.mark.parametrize(("input_data, mock_db_conn_fixture, "
-                          "source_video, "
-                          "expected_manifest_metadata"), [
-    ({"segmentation_run_id": 42,
-      "ophys_experiment_id": 123,
-      "ophys_segmentation_commit_hash": "Marvin",
-      "artifact_basedir": "replace_me_with_a_tmp_path",
-      "cropped_shape": [20, 20],
-      "quantile": 0.2,
-      "input_fps": 31,
-      "output_fps": 4,
-      "downsampling_strategy": 'average',
-      "random_seed": 0},
-
-     {"SELECT id FROM rois WHERE segmentation_run_id=42": [
-         {"id": 0}, {"id": 777}],
-      "SELECT * FROM rois WHERE id=0": [
-          {"segmentation_run_id": 42}],
-      "SELECT * FROM rois WHERE id=777": [
-          {"segmentation_run_id": 42}],
-      "SELECT * FROM segmentation_runs WHERE id=42": [
-         {"source_video_path": "/mock/path", "ophys_experiment_id": 123}
-      ]},
-
-     "/mock/path",
-
-     [{"experiment_id": 123, "roi_id": 0, "segmentation_run_id": 42},
-      {"experiment_id": 123, "roi_id": 777, "segmentation_run_id": 42}]),
-
-], indirect=["mock_db_conn_fixture"])
-def test_transform_pipeline(tmp_path, monkeypatch, mock_db_conn_fixture,
-                            mock_roi, input_data, source_video,
-                            expected_manifest_metadata):
-
-    input_data["artifact_basedir"] = str(tmp_path)
-
-    def normalize_side_effect(value, dummya, dummyb):
-        return value
-
-    mock_downsample_h5_video = MagicMock(return_value=np.zeros((3, 5, 5)))
-    mock_normalize = MagicMock(side_effect=normalize_side_effect)
+@pytest.mark.parametrize(
+        "production_roi_manifest",
+        [(
+            {
+                'binarized_content': [
+                    {'id': i,
+                     'mask_matrix': [[0, 1], [1, 1]],
+                     'x': 10 * i,
+                     'y': 20}
+                    for i in [12, 13, 14]],
+                'movie_shape': (10, 200, 200),
+                'experiment_id': 1234,
+                'id_map': {12: 200023, 13: 200024}}
+            )],
+        indirect=['production_roi_manifest'])
+def test_xform_from_prod_manifest_all_ROIs(tmp_path,
+                                           production_roi_manifest):
+    """all_ROIs defaults to the mapped ROIs only, as in the pipeline
+    schema, and otherwise makes all ROIs with their local ids"""
+    manifest, params = production_roi_manifest
+    man_path = tmp_path / "manifest.json"
+    with open(man_path, "w") as f:
+        json.dump(manifest, f)
+
+    rois, _ = transform_pipeline.xform_from_prod_manifest(
+            man_path, include_trace=False)
+    assert [roi.roi_id for roi in rois] == [200023, 200024]
+
+    rois, _ = transform_pipeline.xform_from_prod_manifest(
+            man_path, all_ROIs=True, include_trace=False)
+    assert [roi.roi_id for roi in rois] == [12, 13, 14]
+    assert [roi.experiment_id for roi in rois] == [1234] * 3
+
+
+@pytest.mark.parametrize("insert_batch_size, expected_batches", [
+    (1000, [3]),
+    (2, [2, 1])])
+def test_transform_pipeline(experiment_fixture, tmp_path, monkeypatch,
+                            insert_batch_size, expected_batches):
+    """the videos go through the WebmEncoder, and the manifests are
+    inserted into roi_manifests in batched, parameterized statements"""
+    mock_encoder = MagicMock()
+    mock_encoder.__enter__.return_value = mock_encoder
+    mock_encoder_class = MagicMock(return_value=mock_encoder)
+    monkeypatch.setattr(transform_pipeline, "WebmEncoder",
+                        mock_encoder_class)
+    mock_pg_conn = MagicMock()
+    mock_cursor = mock_pg_conn.cursor.return_value
+    db_conn = transform_pipeline.query_utils.DbConnection(
+            user="user", host="host", database="db", password="pw",
+            port=5432, connect=MagicMock(return_value=mock_pg_conn))
+    monkeypatch.setenv('TRANSFORM_HASH', 'dummy_hash')
+
+    args = dict(experiment_fixture)
+    args['artifact_basedir'] = str(tmp_path)
+    args['insert_batch_size'] = insert_batch_size
+    args['webm_parallelization'] = 3
+    pipeline = transform_pipeline.TransformPipeline(input_data=args,
+                                                    args=[])
+    pipeline.run(db_conn)
+
+    # the full video and the sub-video of each ROI
+    mock_encoder_class.assert_called_once_with(
+            ncpu=3, min_segment_frames=ANY, bitrate=ANY, crf=ANY)
+    submitted = [c.args[1] for c in mock_encoder.submit.call_args_list]
+    assert submitted == [tmp_path / "full_video.webm"] + [
+            tmp_path / f"video_5678_{roi_id}.webm"
+            for roi_id in [101, 102, 103]]
+    mock_encoder.close.assert_called()
+
+    # one statement per batch of rows, in a single transaction
+    assert mock_cursor.execute.call_count == len(expected_batches)
+    mock_pg_conn.commit.assert_called_once()
+    rows = []
+    for (statement, params), size in zip(
+            [c.args for c in mock_cursor.execute.call_args_list],
+            expected_batches):
+        assert statement == (
+                "INSERT INTO roi_manifests (manifest, transform_hash, "
+                "roi_id) VALUES " + ", ".join(["(%s, %s, %s)"] * size))
+        rows.extend(zip(params[0::3], params[1::3], params[2::3]))
+    assert [(h, i) for _, h, i in rows] == [
+            ('dummy_hash', 101), ('dummy_hash', 102), ('dummy_hash', 103)]
+    for manifest, _, roi_id in rows:
+        manifest = json.loads(manifest)
+        assert manifest['roi-id'] == roi_id
+        assert manifest['experiment-id'] == 5678
+        for key in ['source-ref', 'roi-mask-source-ref', 'max-source-ref',
+                    'avg-source-ref', 'full-outline-source-ref',
+                    'trace-source-ref']:
+            assert Path(manifest[key]).exists()
+        assert manifest['video-source-ref'] == \
+            str(tmp_path / f"video_5678_{roi_id}.webm")
+
+
+@pytest.fixture
+def experiment_fixture(tmp_path):
+    """a small but complete production segmentation run"""
+    rng = np.random.default_rng(1234)
+    nframes, nrows, ncols = 62, 32, 32
+    movie_path = tmp_path / "movie.h5"
+    with h5py.File(movie_path, "w") as f:
+        f.create_dataset(
+                "data",
+                data=rng.integers(0, 2**12, size=(nframes, nrows, ncols),
+                                  dtype='uint16').astype('float64'),
+                chunks=(8, nrows, ncols))
+
+    mask_matrix = [[0, 1, 1, 0],
+                   [1, 1, 1, 1],
+                   [1, 1, 1, 1],
+                   [0, 1, 1, 0]]
+    binarized = [
+            {'id': 1, 'x': 10, 'y': 12, 'mask_matrix': mask_matrix},
+            # near the corner, so the crops need padding
+            {'id': 2, 'x': 0, 'y': 1, 'mask_matrix': mask_matrix},
+            {'id': 3, 'x': 27, 'y': 28, 'mask_matrix': mask_matrix},
+            # not in the id map
+            {'id': 4, 'x': 20, 'y': 5, 'mask_matrix': mask_matrix}]
+    binarized_path = tmp_path / "binarized_rois.json"
+    with open(binarized_path, "w") as f:
+        json.dump(binarized, f)
+
+    traces_path = tmp_path / "traces.h5"
+    with h5py.File(traces_path, "w") as f:
+        f.create_dataset('data', data=rng.random(size=(4, nframes)))
+        f.create_dataset(
+                'roi_names',
+                data=np.array(['4', '3', '1', '2']).astype(np.string_),
+                dtype=h5py.special_dtype(vlen=str))
+
+    corr_path = tmp_path / "correlation.png"
+    imageio.imsave(
+            corr_path,
+            rng.integers(0, 256, size=(nrows, ncols), dtype='uint8'))
+
+    manifest = {
+        'experiment_id': 5678,
+        'binarized_rois_path': str(binarized_path),
+        'movie_path': str(movie_path),
+        'traces_h5_path': str(traces_path),
+        'local_to_global_roi_id_map': {1: 101, 2: 102, 3: 103}}
+    manifest_path = tmp_path / "prod_manifest.json"
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f)
+
+    args = {
+        'prod_segmentation_run_manifest': str(manifest_path),
+        'correlation_projection_path': str(corr_path),
+        'cropped_shape': [16, 16],
+        'downsample_video': True,
+        'input_fps': 31,
+        'output_fps': 4,
+        'scale_offset': 1,
+        'full_scale_offset': 2,
+        'scale_size_um': 4.0,
+        'full_scale_size_um': 8.0,
+        'log_level': 'WARNING'}
+    yield args
+
+
+def run_pipeline(args, outdir):
+    args = dict(args)
+    outdir.mkdir(exist_ok=True)
+    args['artifact_basedir'] = str(outdir)
+    args['output_manifest'] = str(outdir / "manifest.jsonl")
+    pipeline = transform_pipeline.TransformPipeline(input_data=args,
+                                                    args=[])
+    pipeline.run()
+    with jsonlines.open(args['output_manifest'], "r") as reader:
+        manifests = [m for m in reader]
+    return manifests
+
+
+def read_video(video_path):
+    reader = mpg.read_frames(str(video_path), pix_fmt="gray8",
+                             bits_per_pixel=8)
+    meta = reader.__next__()
+    frames = [np.frombuffer(f, dtype='uint8').reshape(meta["size"][::-1])
+              for f in reader]
+    return np.array(frames)
+
+
+def assert_same_artifacts(manifests, expected_manifests,
+                          video_tolerance=0):
+    """checks that 2 pipeline runs produced the same per-ROI artifacts.
+    Videos split differently into segments do not encode identically,
+    video_tolerance is the allowed mean absolute difference of the
+    decoded frames.
+    """
+    assert len(manifests) == len(expected_manifests)
+    for manifest, expected in zip(manifests, expected_manifests):
+        assert set(manifest.keys()) == set(expected.keys())
+        for key, value in manifest.items():
+            if key in ['experiment-id', 'roi-id']:
+                assert value == expected[key]
+            elif key == 'full-video-source-ref':
+                assert Path(value).exists()
+            elif value.endswith('.png'):
+                np.testing.assert_array_equal(imageio.imread(value),
+                                              imageio.imread(expected[key]))
+            elif value.endswith('.json'):
+                with open(value, "r") as f:
+                    obtained_json = json.load(f)
+                with open(expected[key], "r") as f:
+                    expected_json = json.load(f)
+                assert obtained_json == expected_json
+            else:
+                obtained_video = read_video(value).astype(int)
+                expected_video = read_video(expected[key]).astype(int)
+                assert obtained_video.shape == expected_video.shape
+                assert np.abs(obtained_video - expected_video).mean() \
+                    <= video_tolerance
+
+
+@pytest.mark.parametrize("skip_movies", [True, False])
+@pytest.mark.parametrize("chunk_size", [1, 20])
+def test_transform_pipeline_streaming(experiment_fixture, tmp_path,
+                                      skip_movies, chunk_size):
+    """streaming mode should produce the same artifacts as the
+    in-memory mode
+    """
+    args = dict(experiment_fixture)
+    args['skip_movies'] = skip_movies
+    expected_manifests = run_pipeline(args, tmp_path / "in_memory")
+
+    args['streaming'] = True
+    args['chunk_size'] = chunk_size
+    manifests = run_pipeline(args, tmp_path / "streaming")
+
+    assert [m['roi-id'] for m in manifests] == [101, 102, 103]
+    assert_same_artifacts(manifests, expected_manifests)
+
+
+@pytest.mark.parametrize("streaming", [True, False])
+def test_normalized_video_margin(experiment_fixture, tmp_path, streaming):
+    """the movie is normalized into the interior of a zero-filled buffer
+    padded by margin
+    """
+    args = dict(experiment_fixture)
+    args['streaming'] = streaming
+    args['artifact_basedir'] = str(tmp_path)
+    args['output_manifest'] = str(tmp_path / "manifest.jsonl")
+    pipeline = transform_pipeline.TransformPipeline(input_data=args,
+                                                    args=[])
+    with open(args['prod_segmentation_run_manifest'], "r") as f:
+        video_path = Path(json.load(f)['movie_path'])
+
+    results = {}
+    for margin in [(0, 0), (3, 5)]:
+        out_dir = tmp_path / f"margin_{margin[0]}"
+        out_dir.mkdir()
+        results[margin] = pipeline.normalized_video(
+                video_path, out_dir, out_dir / "full_video.webm", 4.0,
+                margin=margin)
+
+    avg_projection, max_projection, video, cutoffs = results[(0, 0)]
+    padded_avg, padded_max, padded, padded_cutoffs = results[(3, 5)]
+    np.testing.assert_array_equal(
+            padded, np.pad(video, [(0, 0), (3, 3), (5, 5)]))
+    np.testing.assert_array_equal(padded_avg, avg_projection)
+    np.testing.assert_array_equal(padded_max, max_projection)
+    assert padded_cutoffs == cutoffs
+
+
+@pytest.mark.parametrize("skip_movies", [True, False])
+@pytest.mark.parametrize("streaming", [True, False])
+def test_transform_pipeline_video_cache(experiment_fixture, tmp_path,
+                                        monkeypatch, skip_movies, streaming):
+    """runs which fill and which use the video cache should produce the
+    same artifacts as a run without it, and a cached run should not read
+    the source movie
+    """
+    args = dict(experiment_fixture)
+    args['skip_movies'] = skip_movies
+    args['streaming'] = streaming
+    expected_manifests = run_pipeline(args, tmp_path / "uncached")
+
+    args['video_cache_dir'] = str(tmp_path / "cache")
+    manifests = run_pipeline(args, tmp_path / "cache_miss")
+    assert_same_artifacts(manifests, expected_manifests)
+    assert len(list((tmp_path / "cache").iterdir())) == 1
+
+    def no_read(*args, **kwargs):
+        raise AssertionError("the source movie should not be read")
+
+    monkeypatch.setattr(transform_pipeline, "h5_video_chunks", no_read)
+    monkeypatch.setattr(transform_pipeline, "downsample_h5_video", no_read)
+    manifests = run_pipeline(args, tmp_path / "cache_hit")
+    assert_same_artifacts(manifests, expected_manifests)
+
+    # a different crop shape does not change the cached movie
+    args['cropped_shape'] = [12, 12]
+    run_pipeline(args, tmp_path / "cache_hit_cropped")
+
+    # a different normalization does
+    args['movie_upper_quantile'] = 0.9
+    with pytest.raises(AssertionError, match="should not be read"):
+        run_pipeline(args, tmp_path / "cache_miss_quantile")
+
+
+@pytest.mark.parametrize("skip_movies", [True, False])
+@pytest.mark.parametrize("sub_video_batch_size", [0, 2])
+def test_transform_pipeline_artifact_cache(experiment_fixture, tmp_path,
+                                           monkeypatch, skip_movies,
+                                           sub_video_batch_size):
+    """a rerun into the same directory only makes the artifacts of ROIs
+    which are new or changed
+    """
+    args = dict(experiment_fixture)
+    args['skip_movies'] = skip_movies
+    args['sub_video_batch_size'] = sub_video_batch_size
+    expected_manifests = run_pipeline(args, tmp_path / "uncached")
+
+    args['artifact_cache'] = True
+    args['write_report'] = True
+    outdir = tmp_path / "cached"
+
+    def cache_counters():
+        with open(outdir / "manifest_report.json", "r") as f:
+            return json.load(f)['counters']['artifact_cache']
+
+    manifests = run_pipeline(args, outdir)
+    assert cache_counters() == {'hits': 0, 'misses': 3,
+                                'miss_roi_ids': [101, 102, 103]}
+    assert_same_artifacts(manifests, expected_manifests)
+    # the manifests have the same keys, which all reference artifacts
+    assert [sorted(m) for m in manifests] == \
+        [sorted(m) for m in expected_manifests]
+
+    # nothing is made again
     mock_imageio = MagicMock()
-    mock_content_extents = MagicMock(return_value=([0, 0, 2, 2], [1, 1, 1, 1]))
-    mock_transform_to_webm = MagicMock()
-    mock_add_scale = MagicMock()
-    mock_np = MagicMock()
-    mock_np.quantile = MagicMock(return_value=(0, 1))
-
-    mpatcher = partial(monkeypatch.setattr, target=transform_pipeline)
-    mpatcher(name="ROI", value=mock_roi)
-    mpatcher(name="downsample_h5_video", value=mock_downsample_h5_video)
-    mpatcher(name="imageio", value=mock_imageio)
-    mpatcher(name="content_extents", value=mock_content_extents)
-    mpatcher(name="normalize_array", value=mock_normalize)
-    mpatcher(name="add_scale", value=mock_add_scale)
-    mpatcher(name="transform_to_webm", value=mock_transform_to_webm)
-    mpatcher(name="np", value=mock_np)
-
-    os.environ['TRANSFORM_HASH'] = 'dummy_hash'
-    pipeline = transform_pipeline.TransformPipeline(input_data=input_data,
+    monkeypatch.setattr(artifact_writer, "imageio", mock_imageio)
+    manifests = run_pipeline(args, outdir)
+    assert cache_counters() == {'hits': 3, 'misses': 0, 'miss_roi_ids': []}
+    assert_same_artifacts(manifests, expected_manifests)
+    mock_imageio.imsave.assert_not_called()
+    monkeypatch.undo()
+
+    # a missing artifact is made again
+    Path(manifests[1]['max-source-ref']).unlink()
+    manifests = run_pipeline(args, outdir)
+    assert cache_counters() == {'hits': 2, 'misses': 1,
+                                'miss_roi_ids': [102]}
+    assert_same_artifacts(manifests, expected_manifests)
+
+    # changed args change every ROI
+    args['quantile'] = 0.3
+    manifests = run_pipeline(args, outdir)
+    assert cache_counters()['misses'] == 3
+
+
+@pytest.mark.parametrize("skip_movies", [True, False])
+@pytest.mark.parametrize("streaming", [True, False])
+def test_transform_pipeline_roi_parallelization(experiment_fixture, tmp_path,
+                                                skip_movies, streaming):
+    """a pool of ROI workers should produce the same artifacts as
+    the serial loop
+    """
+    args = dict(experiment_fixture)
+    args['skip_movies'] = skip_movies
+    args['streaming'] = streaming
+    expected_manifests = run_pipeline(args, tmp_path / "serial")
+
+    args['roi_parallelization'] = 2
+    manifests = run_pipeline(args, tmp_path / "parallel")
+
+    assert [m['roi-id'] for m in manifests] == [101, 102, 103]
+    assert_same_artifacts(manifests, expected_manifests)
+
+
+def test_transform_pipeline_webm_parallelization(experiment_fixture,
+                                                 tmp_path):
+    """encoding with a pool of workers should give the same videos"""
+    args = dict(experiment_fixture)
+    expected_manifests = run_pipeline(args, tmp_path / "serial")
+
+    args['webm_parallelization'] = 2
+    args['webm_min_segment_frames'] = 2
+    manifests = run_pipeline(args, tmp_path / "parallel")
+
+    assert_same_artifacts(manifests, expected_manifests,
+                          video_tolerance=5)
+
+
+@pytest.mark.parametrize("roi_parallelization", [1, 2])
+def test_transform_pipeline_sub_video_batch(experiment_fixture, tmp_path,
+                                            roi_parallelization):
+    """single-pass crop encoding should give the same sub-videos"""
+    args = dict(experiment_fixture)
+    expected_manifests = run_pipeline(args, tmp_path / "per_roi")
+
+    args['sub_video_batch_size'] = 2
+    args['roi_parallelization'] = roi_parallelization
+    manifests = run_pipeline(args, tmp_path / "batched")
+
+    assert_same_artifacts(manifests, expected_manifests)
+
+
+@pytest.mark.parametrize("roi_parallelization", [1, 2])
+@pytest.mark.parametrize("png_writers, png_compression", [(0, 9), (3, 1)])
+def test_transform_pipeline_png_writers(experiment_fixture, tmp_path,
+                                        roi_parallelization, png_writers,
+                                        png_compression):
+    """threaded and less compressed png writing gives the same images"""
+    args = dict(experiment_fixture)
+    args['roi_parallelization'] = roi_parallelization
+    expected_manifests = run_pipeline(args, tmp_path / "default")
+
+    args['png_writers'] = png_writers
+    args['png_compression'] = png_compression
+    manifests = run_pipeline(args, tmp_path / "writers")
+    assert_same_artifacts(manifests, expected_manifests)
+
+
+@pytest.mark.parametrize("roi_parallelization", [1, 2])
+def test_transform_pipeline_atlas(experiment_fixture, tmp_path,
+                                  monkeypatch, roi_parallelization):
+    """the tiles of the atlas sheets are the per-ROI pngs"""
+    args = dict(experiment_fixture)
+    expected_manifests = run_pipeline(args, tmp_path / "png")
+
+    # the ROIs whose tiles are replayed into the writer, by call
+    replayed = []
+    replay = artifact_writer.TileBuffer.replay
+
+    def recorded_replay(held, writer):
+        images, jsons = held
+        replayed.append(sorted({int(path.stem.split("_")[-1])
+                                for path, _, _ in images}))
+        replay(held, writer)
+
+    monkeypatch.setattr(artifact_writer.TileBuffer, "replay",
+                        staticmethod(recorded_replay))
+
+    args['artifact_format'] = 'atlas'
+    args['atlas_columns'] = 2
+    args['atlas_tiles_per_sheet'] = 2
+    args['roi_parallelization'] = roi_parallelization
+    outdir = tmp_path / "atlas"
+    manifests = run_pipeline(args, outdir)
+
+    assert sorted(p.name for p in outdir.glob("max_*.png")) == \
+        ["max_atlas_0.png", "max_atlas_1.png"]
+    assert (outdir / "atlas_index.json").exists()
+    # the tiles from the ROI workers are written one ROI at a time
+    if roi_parallelization == 1:
+        assert replayed == []
+    else:
+        assert replayed == [[101], [102], [103]]
+    for manifest, expected in zip(manifests, expected_manifests):
+        for key in transform_pipeline.atlas_manifest_keys:
+            path, fragment = manifest.pop(key).split("#xywh=")
+            x, y, width, height = [int(i) for i in fragment.split(",")]
+            np.testing.assert_array_equal(
+                    imageio.imread(path)[y:(y + height), x:(x + width)],
+                    imageio.imread(expected.pop(key)))
+    assert_same_artifacts(manifests, expected_manifests)
+
+
+def test_transform_pipeline_atlas_exceptions(experiment_fixture, tmp_path):
+    args = dict(experiment_fixture)
+    args['artifact_format'] = 'atlas'
+    args['artifact_cache'] = True
+    with pytest.raises(mm.ValidationError, match="artifact_cache"):
+        run_pipeline(args, tmp_path)
+    args['artifact_cache'] = False
+    args['atlas_columns'] = 3
+    with pytest.raises(mm.ValidationError, match="multiple"):
+        run_pipeline(args, tmp_path)
+
+
+@pytest.mark.parametrize("skip_movies", [True, False])
+@pytest.mark.parametrize("roi_parallelization", [1, 2])
+def test_transform_pipeline_hdf5(experiment_fixture, tmp_path,
+                                 roi_parallelization, skip_movies):
+    """the entries of roi_artifacts.h5 are the per-ROI pngs and traces"""
+    args = dict(experiment_fixture)
+    args['skip_movies'] = skip_movies
+    expected_manifests = run_pipeline(args, tmp_path / "png")
+
+    args['artifact_format'] = 'hdf5'
+    args['hdf5_chunk_rois'] = 2
+    args['roi_parallelization'] = roi_parallelization
+    outdir = tmp_path / "hdf5"
+    manifests = run_pipeline(args, outdir)
+
+    assert list(outdir.glob("*.png")) == []
+    assert list(outdir.glob("*trace*")) == []
+    h5_path = outdir / "roi_artifacts.h5"
+    with artifact_writer.H5ArtifactStore(h5_path) as store:
+        np.testing.assert_array_equal(
+                store.roi_ids, [m['roi-id'] for m in manifests])
+        for manifest, expected in zip(manifests, expected_manifests):
+            for key in transform_pipeline.hdf5_manifest_keys:
+                if key not in expected:
+                    continue
+                path, fragment = manifest.pop(key).split("#")
+                assert path == str(h5_path)
+                kind, index = fragment.split("/")
+                assert store.index(manifest['roi-id']) == int(index)
+                entry = store[manifest['roi-id']][kind]
+                expected_path = expected.pop(key)
+                if kind == 'trace':
+                    with open(expected_path) as f:
+                        np.testing.assert_array_equal(
+                                entry, json.load(f)['trace'])
+                else:
+                    np.testing.assert_array_equal(
+                            entry, imageio.imread(expected_path))
+    assert_same_artifacts(manifests, expected_manifests)
+
+
+@pytest.mark.parametrize("roi_parallelization", [1, 2])
+def test_transform_pipeline_cleanup(experiment_fixture, tmp_path,
+                                    monkeypatch, roi_parallelization):
+    """a failing stage stops the encoder and removes the incomplete h5
+    file"""
+    aborted = []
+    abort = transform_pipeline.WebmEncoder.abort
+
+    def record_abort(encoder):
+        aborted.append(encoder)
+        abort(encoder)
+
+    def failing_roi_artifacts(*args, **kwargs):
+        raise RuntimeError("roi failed")
+
+    monkeypatch.setattr(transform_pipeline.WebmEncoder, "abort",
+                        record_abort)
+    monkeypatch.setattr(transform_pipeline, "roi_artifacts",
+                        failing_roi_artifacts)
+    args = dict(experiment_fixture)
+    args['artifact_format'] = 'hdf5'
+    args['roi_parallelization'] = roi_parallelization
+    args['webm_parallelization'] = 2
+    with pytest.raises(RuntimeError, match="roi failed"):
+        run_pipeline(args, tmp_path / "out")
+    assert not (tmp_path / "out" / "roi_artifacts.h5").exists()
+    # the encoder is only started once the ROI workers are done
+    assert len(aborted) == (1 if roi_parallelization == 1 else 0)
+
+
+def test_transform_pipeline_db_connection(experiment_fixture, tmp_path,
+                                          monkeypatch):
+    """without a connection, the manifests are inserted through a pooled
+    connection opened and closed by the run"""
+    mock_db_conn = MagicMock()
+    mock_connection = MagicMock()
+    mock_connection.return_value.__enter__.return_value = mock_db_conn
+    monkeypatch.setattr(transform_pipeline.query_utils, "DbConnection",
+                        mock_connection)
+    monkeypatch.setattr(transform_pipeline.query_utils,
+                        "get_db_credentials",
+                        lambda **kwargs: {'user': kwargs['env_prefix']})
+    monkeypatch.setenv('TRANSFORM_HASH', 'dummy_hash')
+    args = dict(experiment_fixture)
+    args['artifact_basedir'] = str(tmp_path)
+    args['db_pool_size'] = 2
+    pipeline = transform_pipeline.TransformPipeline(input_data=args,
+                                                    args=[])
+    pipeline.run()
+
+    mock_connection.assert_called_once_with(user="LABELING_", pool_size=2)
+    mock_connection.return_value.__exit__.assert_called_once()
+    mock_db_conn.bulk_insert_rows.assert_called_once()
+    rows = mock_db_conn.bulk_insert_rows.call_args.args[2]
+    assert [row[2] for row in rows] == [101, 102, 103]
+
+
+def test_transform_pipeline_hdf5_exceptions(experiment_fixture, tmp_path):
+    args = dict(experiment_fixture)
+    args['artifact_format'] = 'hdf5'
+    args['artifact_cache'] = True
+    with pytest.raises(mm.ValidationError, match="artifact_cache"):
+        run_pipeline(args, tmp_path)
+
+
+@pytest.mark.parametrize("streaming", [True, False])
+@pytest.mark.parametrize("roi_parallelization", [1, 2])
+def test_transform_pipeline_report(experiment_fixture, tmp_path, streaming,
+                                   roi_parallelization):
+    """the report and profile are written next to the manifest, and do
+    not change the artifacts
+    """
+    args = dict(experiment_fixture)
+    args['streaming'] = streaming
+    args['roi_parallelization'] = roi_parallelization
+    expected_manifests = run_pipeline(args, tmp_path / "plain")
+
+    args['write_report'] = True
+    args['profiler'] = 'cProfile'
+    outdir = tmp_path / "reported"
+    manifests = run_pipeline(args, outdir)
+    assert_same_artifacts(manifests, expected_manifests)
+    assert (outdir / "manifest_profile.prof").exists()
+
+    with open(outdir / "manifest_report.json", "r") as f:
+        report = json.load(f)
+    stages = [stage['name'] for stage in report['stages']]
+    for stage in ['load_rois', 'projections', 'normalize', 'plan_windows',
+                  'pad_sources', 'roi_artifacts', 'wait_encoders',
+                  'write_manifest']:
+        assert stage in stages
+    assert ('encode_full_video' in stages) == streaming
+    assert ('read_movie' in stages) != streaming
+    assert [roi['roi_id'] for roi in report['rois']] == [101, 102, 103]
+    for step in ['total', 'outline', 'scale', 'png', 'sub_video', 'trace']:
+        assert report['roi_summary'][step]['total_s'] >= 0
+    if roi_parallelization == 1:
+        assert report['counters']['png_writes']['files'] == 18
+
+
+def test_xform_from_slapp_db():
+    responses = {
+        "SELECT * FROM segmentation_runs WHERE id=42": [
+            {'id': 42,
+             'video_shape': [10, 10],
+             'ophys_experiment_id': 1234,
+             'source_video_path': '/mock/path'}],
+        ("SELECT id, coo_row, coo_col, coo_data, trace FROM rois "
+         "WHERE segmentation_run_id=42 ORDER BY id"): [
+            {'id': i, 'coo_row': [1], 'coo_col': [2], 'coo_data': [1.0],
+             'trace': [1.0, 2.0]}
+            for i in range(500)]}
+    db_conn = MagicMock()
+    db_conn.query.side_effect = lambda query_string: responses[query_string]
+    db_conn.iter_query.side_effect = \
+        lambda query_string: iter(responses[query_string])
+
+    rois, video_path = transform_pipeline.xform_from_slapp_db(db_conn, 42)
+
+    # independent of the number of ROIs
+    assert db_conn.query.call_count == 1
+    assert db_conn.iter_query.call_count == 1
+    assert isinstance(rois, ROISet)
+    assert [roi.roi_id for roi in rois] == list(range(500))
+    assert video_path == Path('/mock/path')
+
+
+def test_transform_pipeline_db_insert(experiment_fixture, tmp_path,
+                                      monkeypatch):
+    """without output_manifest, manifests are inserted into roi_manifests
+    with one batched, parameterized insert"""
+    args = dict(experiment_fixture)
+    args['skip_movies'] = True
+    args['insert_batch_size'] = 2
+    expected_manifests = run_pipeline(args, tmp_path / "file")
+
+    args['artifact_basedir'] = str(tmp_path / "db")
+    monkeypatch.setenv("TRANSFORM_HASH", "dummy_hash")
+    db_conn = MagicMock()
+    pipeline = transform_pipeline.TransformPipeline(input_data=args,
                                                     args=[])
-    pipeline.run(mock_db_conn_fixture)
-
-    expected_manifests = []
-    for meta in expected_manifest_metadata:
-        manifest = create_expected_manifest(
-                **meta, save_path=str(tmp_path), dtime=pipeline.timestamp)
-        expected_manifests.append(manifest)
-
-    # Assert downsample called with correct video path
-    mock_downsample_h5_video.assert_called_once_with(
-            Path(source_video),
-            input_data['input_fps'],
-            input_data['output_fps'],
-            input_data['downsampling_strategy'],
-            input_data['random_seed'])
-
-    # Assert imsaves are called with correct save paths (and in correct order)
-    for manifest in expected_manifests:
-        mask_save = call(Path(manifest['roi-mask-source-ref']), ANY,
-                         transparency=0)
-        max_save = call(Path(manifest['max-source-ref']), ANY)
-        avg_save = call(Path(manifest['avg-source-ref']), ANY)
-        outline_save = call(Path(manifest['source-ref']),
-                            ANY, transparency=255)
-        full_outline_save = call(Path(manifest['full-outline-source-ref']),
-                                 ANY, transparency=255)
-
-        calls = [mask_save, outline_save, full_outline_save,
-                 max_save, avg_save]
-        mock_imageio.imsave.assert_has_calls(calls, any_order=False)
-
-    assert mock_add_scale.call_count == 4
-
-    # Assert that created manifests are correct
-    expected_insert_statements = [
-            transform_pipeline.insert_str_template.format(
-                json.dumps(manifest),
-                os.environ['TRANSFORM_HASH'],
-                manifest['roi-id'])
-            for manifest in expected_manifests]
-
-    mock_db_conn_fixture.bulk_insert.assert_has_calls(
-            [call(expected_insert_statements)])
+    pipeline.run(db_conn)
+
+    db_conn.bulk_insert_rows.assert_called_once()
+    table, columns, rows = db_conn.bulk_insert_rows.call_args[0]
+    assert table == "roi_manifests"
+    assert columns == ["manifest", "transform_hash", "roi_id"]
+    assert db_conn.bulk_insert_rows.call_args[1] == {'batch_size': 2}
+    manifests = [json.loads(row[0]) for row in rows]
+    assert [row[1:] for row in rows] == [("dummy_hash", i)
+                                         for i in [101, 102, 103]]
+    assert_same_artifacts(manifests, expected_manifests)
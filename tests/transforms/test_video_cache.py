@@ -0,0 +1,102 @@
+import os
+
+import numpy as np
+import pytest
+
+from slapp.transforms.video_cache import VideoCache, VideoCacheEntry
+
+
+@pytest.fixture
+def source_file(tmp_path):
+    path = tmp_path / "movie.h5"
+    path.write_bytes(b"movie")
+    yield path
+
+
+def add_entry(cache, key, nbytes, with_video=True):
+    staging = cache.stage(key)
+    np.save(staging / VideoCacheEntry.avg_name, np.zeros((2, 2)))
+    np.save(staging / VideoCacheEntry.max_name, np.ones((2, 2)))
+    if with_video:
+        np.save(staging / VideoCacheEntry.video_name,
+                np.zeros(nbytes, dtype='uint8'))
+    return cache.commit(key, staging, {'movie': [0.0, 1.0]})
+
+
+def test_video_cache_key(source_file):
+    key = VideoCache.key(source_file, {'a': 1})
+    assert key == VideoCache.key(source_file, {'a': 1})
+    assert key != VideoCache.key(source_file, {'a': 2})
+    stat = source_file.stat()
+    os.utime(source_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert key != VideoCache.key(source_file, {'a': 1})
+
+
+def test_video_cache_get(tmp_path, source_file):
+    cache = VideoCache(tmp_path / "cache")
+    key = VideoCache.key(source_file, {})
+    assert cache.get(key) is None
+
+    add_entry(cache, key, 100, with_video=False)
+    assert cache.get(key) is None
+    entry = cache.get(key, require_video=False)
+    assert entry.metadata == {'movie': [0.0, 1.0]}
+    np.testing.assert_array_equal(entry.max_projection(), np.ones((2, 2)))
+
+    # a new entry replaces the old one
+    add_entry(cache, key, 100)
+    entry = cache.get(key)
+    video = entry.video()
+    assert isinstance(video, np.memmap)
+    assert video.shape == (100,)
+    assert [e[0] for e in cache.entries()] == [key]
+    # no staging directories are left behind
+    assert len(list(cache.cache_dir.iterdir())) == 1
+
+
+def test_video_cache_concurrent_commit(tmp_path, source_file, monkeypatch):
+    cache = VideoCache(tmp_path / "cache")
+    key = VideoCache.key(source_file, {})
+    stagings = []
+    for pid, value in [(1, 1), (2, 2)]:
+        # as if staged by two processes
+        monkeypatch.setattr(os, "getpid", lambda pid=pid: pid)
+        staging = cache.stage(key)
+        np.save(staging / VideoCacheEntry.avg_name, np.zeros((2, 2)))
+        np.save(staging / VideoCacheEntry.max_name, np.ones((2, 2)))
+        np.save(staging / VideoCacheEntry.video_name,
+                np.full(10, value, dtype='uint8'))
+        stagings.append(staging)
+
+    first = cache.commit(key, stagings[0], {'movie': [0.0, 1.0]})
+    video = first.video()
+    # the later commit keeps the entry in use
+    second = cache.commit(key, stagings[1], {'movie': [0.0, 2.0]})
+    assert second.path == first.path
+    assert second.metadata == {'movie': [0.0, 1.0]}
+    np.testing.assert_array_equal(second.video(), video)
+    np.testing.assert_array_equal(video, np.ones(10, dtype='uint8'))
+
+    # an entry without the movie does not replace one with it
+    add_entry(cache, key, 100, with_video=False)
+    assert cache.get(key).video().shape == (10,)
+    assert list(cache.cache_dir.iterdir()) == [first.path]
+
+
+def test_video_cache_evict(tmp_path):
+    cache = VideoCache(tmp_path / "cache", max_bytes=3500)
+    for i, key in enumerate(["a", "b", "c"]):
+        add_entry(cache, key, 1000)
+        os.utime(cache.cache_dir / key / VideoCacheEntry.metadata_name,
+                 (i, i))
+    # the oldest entry was evicted to make room for c
+    assert sorted(e[0] for e in cache.entries()) == ["b", "c"]
+
+    # using b makes c the least recently used
+    cache.get("b")
+    add_entry(cache, "d", 1000)
+    assert sorted(e[0] for e in cache.entries()) == ["b", "d"]
+
+    # an entry larger than the cache is kept until the next one
+    add_entry(cache, "e", 5000)
+    assert [e[0] for e in cache.entries()] == ["e"]
@@ -1,4 +1,5 @@
 from collections import defaultdict
+import threading
 
 import h5py
 import numpy as np
@@ -6,6 +7,7 @@ import pytest
 
 import imageio_ffmpeg as mpg
 import slapp.transforms.video_utils as transformations
+from slapp.transforms.array_utils import downsample_array
 
 
 @pytest.mark.parametrize(
@@ -180,3 +182,184 @@ def test_transform_to_webm(raw_video_fixture, tmp_path, ncpu):
                                       ncpu=ncpu)
 
     compare_videos(output_path, expected_video)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 40, 1000])
+@pytest.mark.parametrize("h5_chunks", [None, (1, 4, 5), (10, 4, 5)])
+@pytest.mark.parametrize("downsample, strategy", [
+    (False, 'average'),
+    (True, 'average'),
+    (True, 'first'),
+    (True, 'last'),
+    (True, 'random')])
+def test_h5_video_chunks(chunk_size, h5_chunks, downsample, strategy,
+                         tmp_path):
+    rng = np.random.default_rng(0)
+    array = rng.integers(0, 2**16, size=(100, 4, 5), dtype='uint16')
+    video_file = tmp_path / "sample_video_file.h5"
+    with h5py.File(video_file, "w") as h5f:
+        h5f.create_dataset('data', data=array, chunks=h5_chunks)
+
+    if downsample:
+        expected = downsample_array(
+                array, 31, 4, strategy, 5)
+    else:
+        expected = array
+
+    chunks = list(transformations.h5_video_chunks(
+            video_file, chunk_size, downsample, 31, 4, strategy, 5))
+    if not downsample:
+        assert all([len(c) <= chunk_size for c in chunks])
+    np.testing.assert_array_equal(np.concatenate(chunks), expected)
+
+
+@pytest.mark.parametrize("raw_video_fixture", [
+    ({"video_shape": (16, 16),
+      "nframes": 45})], indirect=["raw_video_fixture"])
+def test_encode_video_chunks(raw_video_fixture, tmp_path):
+    output_path = tmp_path / 'test_video.webm'
+
+    fps = raw_video_fixture["fps"]
+    expected_video = raw_video_fixture["raw_video"]
+
+    transformations.encode_video_chunks(
+            chunks=(c for c in np.array_split(expected_video, 4)),
+            output_path=output_path.as_posix(),
+            fps=fps)
+
+    compare_videos(output_path, expected_video)
+
+
+@pytest.mark.parametrize("ncpu, min_segment_frames, max_pending", [
+    (1, 500, None),
+    (2, 500, None),
+    (2, 10, None),
+    (3, 10, 1)])
+def test_webm_encoder(tmp_path, ncpu, min_segment_frames, max_pending):
+    """many jobs, long and short, through the same encoder workers"""
+    rng = np.random.default_rng(0)
+    videos = [rng.integers(0, 256, size=(nframes, 16, 16), dtype='uint8')
+              for nframes in [45, 5, 30, 12]]
+    output_paths = [str(tmp_path / f"video_{i}.webm")
+                    for i in range(len(videos))]
+
+    with transformations.WebmEncoder(
+            ncpu=ncpu, min_segment_frames=min_segment_frames,
+            max_pending=max_pending) as encoder:
+        for video, output_path in zip(videos, output_paths):
+            encoder.submit(video, output_path, fps=30)
+        finished = encoder.wait()
+        assert sorted(finished) == sorted(output_paths)
+        assert encoder.wait() == []
+        # encode() waits only for its own job
+        encode_path = str(tmp_path / "encoded.webm")
+        assert encoder.encode(videos[0], encode_path, fps=30) == encode_path
+        compare_videos(encode_path, videos[0])
+
+    for video, output_path in zip(videos, output_paths):
+        compare_videos(output_path, video)
+
+
+def test_webm_encoder_abort(tmp_path):
+    """an error stops the workers and removes the unfinished outputs"""
+    video = np.zeros((45, 16, 16), dtype='uint8')
+    output_path = tmp_path / "video.webm"
+    with pytest.raises(RuntimeError, match="stage failed"):
+        with transformations.WebmEncoder(ncpu=2,
+                                         min_segment_frames=10) as encoder:
+            encoder.submit(video, output_path, fps=30)
+            output_path.touch()
+            raise RuntimeError("stage failed")
+    assert encoder._pool is None
+    assert encoder.wait() == []
+    assert not output_path.exists()
+
+
+@pytest.mark.parametrize("max_writers", [1, 2, 10])
+@pytest.mark.parametrize("chunk_size", [1, 7, 100])
+def test_encode_crops(tmp_path, max_writers, chunk_size):
+    rng = np.random.default_rng(0)
+    video = rng.integers(0, 256, size=(20, 40, 48), dtype='uint8')
+    crops = [
+            # interior
+            ((4, 20, 10, 26), ((0, 0), (0, 0))),
+            # padded top and left
+            ((0, 12, 0, 14), ((4, 0), (2, 0))),
+            # padded bottom and right
+            ((30, 40, 40, 48), ((0, 6), (0, 8)))]
+    output_paths = [tmp_path / f"crop_{i}.webm" for i in range(len(crops))]
+
+    obtained = transformations.encode_crops(
+            video, crops, output_paths, fps=30, max_writers=max_writers,
+            chunk_size=chunk_size)
+
+    assert obtained == [str(i) for i in output_paths]
+    for (inds, pads), output_path in zip(crops, output_paths):
+        expected = np.pad(video[:, inds[0]:inds[1], inds[2]:inds[3]],
+                          ((0, 0), *pads))
+        compare_videos(output_path, expected)
+
+
+def test_encode_crops_exception(tmp_path):
+    with pytest.raises(ValueError):
+        transformations.encode_crops(
+                np.zeros((5, 16, 16), dtype='uint8'),
+                [((0, 16, 0, 16), ((0, 0), (0, 0)))],
+                [tmp_path / "a.webm", tmp_path / "b.webm"],
+                fps=30)
+
+
+@pytest.mark.parametrize("prefetch", [0, 1, 3])
+@pytest.mark.parametrize("chunks, block_size, expected_block_size", [
+    (None, 7, 7),
+    ((10, 4, 5), 25, 20),
+    ((10, 4, 5), 5, 10)])
+def test_h5_frame_reader(prefetch, chunks, block_size, expected_block_size,
+                         tmp_path):
+    rng = np.random.default_rng(1)
+    array = rng.integers(0, 2**16, size=(53, 4, 5), dtype='uint16')
+    video_file = tmp_path / "sample_video_file.h5"
+    with h5py.File(video_file, "w") as h5f:
+        h5f.create_dataset('data', data=array, chunks=chunks)
+
+    reader = transformations.H5FrameReader(video_file, block_size, prefetch)
+    assert reader.block_size == expected_block_size
+    assert reader.shape == array.shape
+    assert len(reader) == 53
+    blocks = list(reader)
+    assert all([len(b) == expected_block_size for b in blocks[:-1]])
+    np.testing.assert_array_equal(np.concatenate(blocks), array)
+    np.testing.assert_array_equal(reader.read(), array)
+
+    edges = [3, 10, 11, 40]
+    for block, start, end in zip(reader.blocks(edges), edges[:-1],
+                                 edges[1:]):
+        np.testing.assert_array_equal(block, array[start:end])
+
+
+def test_h5_frame_reader_early_stop(tmp_path):
+    video_file = tmp_path / "sample_video_file.h5"
+    with h5py.File(video_file, "w") as h5f:
+        h5f.create_dataset('data', data=np.zeros((100, 2, 2)))
+    reader = transformations.H5FrameReader(video_file, 1, prefetch=2)
+    nthreads = threading.active_count()
+    blocks = reader.blocks()
+    next(blocks)
+    blocks.close()
+    assert threading.active_count() == nthreads
+
+
+def test_h5_frame_reader_exceptions(tmp_path):
+    video_file = tmp_path / "sample_video_file.h5"
+    with h5py.File(video_file, "w") as h5f:
+        h5f.create_dataset('data', data=np.zeros((10, 2, 2)))
+    with pytest.raises(ValueError, match="block_size"):
+        transformations.H5FrameReader(video_file, 0)
+    with pytest.raises(ValueError, match="prefetch"):
+        transformations.H5FrameReader(video_file, 1, prefetch=-1)
+
+    # errors of the reading thread reach the consumer
+    reader = transformations.H5FrameReader(video_file, 5)
+    video_file.unlink()
+    with pytest.raises(OSError):
+        list(reader)
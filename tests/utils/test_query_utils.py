@@ -1,6 +1,9 @@
 import slapp.utils.query_utils as qu
 import pytest
+import numpy as np
 import os
+import threading
+import time
 
 
 @pytest.mark.parametrize(
@@ -84,3 +87,325 @@ def test_get_db_credentials_exceptions(
         if not skipos:
             os.environ.pop(env_prefix+'USER')
             os.environ.pop(env_prefix+'PASSWORD')
+
+
+class StubCursor():
+    def __init__(self, conn):
+        self.conn = conn
+        self.description = [("id",), ("name",)]
+        self.results = []
+
+    def execute(self, statement, params=None):
+        if self.conn.broken:
+            raise ConnectionError("connection lost")
+        self.conn.executed.append(statement)
+        self.conn.params.append(params)
+        # server-side cursors
+        if statement.startswith("FETCH FORWARD"):
+            n = int(statement.split()[2])
+            self.results = self.conn.rows[self.conn.offset:
+                                          self.conn.offset + n]
+            self.conn.offset += n
+        elif statement.startswith("DECLARE"):
+            self.conn.offset = 0
+        else:
+            self.results = self.conn.rows
+
+    def fetchall(self):
+        return self.results
+
+    def close(self):
+        pass
+
+
+class StubConnection():
+    def __init__(self, rows):
+        self.rows = rows
+        self.offset = 0
+        self.broken = False
+        self.closed = False
+        self.executed = []
+        self.params = []
+        self.commits = 0
+        self.rollbacks = 0
+
+    def cursor(self):
+        return StubCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        if self.broken:
+            raise ConnectionError("connection lost")
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+class StubDriver():
+    """DB-API driver stand-in which records the connections it opens"""
+    def __init__(self, rows=[(1, "a"), (2, "b")]):
+        self.rows = rows
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def connect(self, **kwargs):
+        conn = StubConnection(self.rows)
+        with self.lock:
+            self.connections.append(conn)
+        return conn
+
+
+credentials = {
+        'user': 'user',
+        'host': 'host',
+        'database': 'database',
+        'password': 'password',
+        'port': 5432}
+
+
+@pytest.mark.parametrize("pool_size, expected_connections", [
+    (None, 5),
+    (2, 1)])
+def test_db_connection_pooling(pool_size, expected_connections):
+    driver = StubDriver()
+    with qu.DbConnection(**credentials, pool_size=pool_size,
+                         connect=driver.connect) as db_conn:
+        for i in range(4):
+            results = db_conn.query(f"SELECT id, name FROM t WHERE i={i}")
+            assert results == [{'id': 1, 'name': 'a'},
+                               {'id': 2, 'name': 'b'}]
+        db_conn.bulk_insert(["INSERT 1", "INSERT 2"])
+    assert len(driver.connections) == expected_connections
+    assert all([c.closed for c in driver.connections])
+    executed = [s for c in driver.connections for s in c.executed]
+    assert executed[-2:] == ["INSERT 1", "INSERT 2"]
+    assert sum([c.commits for c in driver.connections]) == 1
+
+
+def test_connection_pool_threads():
+    driver = StubDriver()
+    pool = qu.ConnectionPool(driver.connect, maxsize=3)
+    nchecked = []
+    lock = threading.Lock()
+
+    def work():
+        for i in range(20):
+            with pool.connection():
+                with lock:
+                    nchecked.append(pool.size - pool.idle)
+                time.sleep(0.001)
+
+    threads = [threading.Thread(target=work) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(nchecked) == 160
+    assert max(nchecked) <= 3
+    assert len(driver.connections) <= 3
+    assert pool.idle == pool.size == len(driver.connections)
+    pool.close()
+    assert pool.size == 0
+    assert all([c.closed for c in driver.connections])
+    with pytest.raises(qu.ConnectionPoolException):
+        pool.acquire()
+
+
+def test_connection_pool_timeout():
+    driver = StubDriver()
+    pool = qu.ConnectionPool(driver.connect, maxsize=1, timeout=0.01)
+    conn = pool.acquire()
+    with pytest.raises(qu.ConnectionPoolException):
+        pool.acquire()
+    pool.release(conn)
+    assert pool.acquire() is conn
+
+
+def test_connection_pool_idle_eviction():
+    driver = StubDriver()
+    pool = qu.ConnectionPool(driver.connect, max_idle=0.01)
+    with pool.connection() as conn:
+        pass
+    time.sleep(0.02)
+    with pool.connection() as conn2:
+        pass
+    assert conn2 is not conn
+    assert conn.closed
+    assert pool.size == 1
+
+
+def test_connection_pool_health_check():
+    driver = StubDriver()
+    pool = qu.ConnectionPool(driver.connect, check_after=0.0)
+    with pool.connection() as conn:
+        pass
+    # healthy connections are reused after a check
+    time.sleep(0.001)
+    with pool.connection() as conn2:
+        assert conn2 is conn
+        assert conn.executed == ["SELECT 1"]
+    # broken connections are replaced
+    conn.broken = True
+    time.sleep(0.001)
+    with pool.connection() as conn3:
+        assert conn3 is not conn
+    assert conn.closed
+    assert pool.size == 1
+
+
+def test_connection_pool_discard_on_error():
+    driver = StubDriver()
+    pool = qu.ConnectionPool(driver.connect)
+    with pytest.raises(ValueError):
+        with pool.connection() as conn:
+            raise ValueError("query failed")
+    # rolled back and kept
+    assert conn.rollbacks == 1
+    assert pool.idle == 1
+    with pytest.raises(ConnectionError):
+        with pool.connection() as conn:
+            conn.broken = True
+            raise ConnectionError("connection lost")
+    # rollback failed, so the connection was discarded
+    assert conn.closed
+    assert pool.size == 0
+
+
+@pytest.mark.parametrize("pool_size", [None, 1])
+@pytest.mark.parametrize("nrows, batch_size, expected_batches", [
+    (0, 10, []),
+    (5, 10, [5]),
+    (5, 2, [2, 2, 1]),
+    (6, 3, [3, 3])])
+def test_bulk_insert_rows(nrows, batch_size, expected_batches, pool_size):
+    driver = StubDriver()
+    db_conn = qu.DbConnection(**credentials, pool_size=pool_size,
+                              connect=driver.connect)
+    rows = [(f"{{\"a\": {i}}}", "hash", i) for i in range(nrows)]
+    n = db_conn.bulk_insert_rows("roi_manifests",
+                                 ["manifest", "transform_hash", "roi_id"],
+                                 iter(rows), batch_size=batch_size)
+    db_conn.close()
+
+    assert n == nrows
+    assert len(driver.connections) == 1
+    conn = driver.connections[0]
+    assert conn.commits == 1
+    assert len(conn.executed) == len(expected_batches)
+    inserted = []
+    for statement, params, size in zip(conn.executed, conn.params,
+                                       expected_batches):
+        assert statement == (
+                "INSERT INTO roi_manifests (manifest, transform_hash, "
+                "roi_id) VALUES " + ", ".join(["(%s, %s, %s)"] * size))
+        assert len(params) == 3 * size
+        inserted.extend(zip(params[0::3], params[1::3], params[2::3]))
+    assert inserted == rows
+
+
+@pytest.mark.parametrize("table, columns, rows, batch_size", [
+    ("roi_manifests; DROP TABLE rois", ["a"], [(1,)], 10),
+    ("roi_manifests", ["a b"], [(1,)], 10),
+    ("roi_manifests", [], [()], 10),
+    ("roi_manifests", ["a"], [(1, 2)], 10),
+    ("roi_manifests", ["a"], [(1,)], 0)])
+def test_bulk_insert_rows_exceptions(table, columns, rows, batch_size):
+    driver = StubDriver()
+    db_conn = qu.DbConnection(**credentials, connect=driver.connect)
+    with pytest.raises(ValueError):
+        db_conn.bulk_insert_rows(table, columns, rows, batch_size=batch_size)
+    assert all([c.commits == 0 for c in driver.connections])
+
+
+@pytest.mark.parametrize("pool_size", [None, 1])
+@pytest.mark.parametrize("nrows, batch_size", [
+    (0, 2), (5, 2), (6, 3), (5, 10)])
+def test_iter_query(nrows, batch_size, pool_size):
+    rows = [(i, f"name{i}") for i in range(nrows)]
+    driver = StubDriver(rows)
+    db_conn = qu.DbConnection(**credentials, pool_size=pool_size,
+                              connect=driver.connect)
+
+    dicts = list(db_conn.iter_query("SELECT id, name FROM t",
+                                    batch_size=batch_size))
+    assert dicts == [{'id': i, 'name': n} for i, n in rows]
+    # one FETCH per batch, plus one returning no rows
+    conn = driver.connections[0]
+    assert conn.executed[0].startswith("DECLARE slapp_cursor_")
+    assert conn.executed[0].endswith(
+            "NO SCROLL CURSOR FOR SELECT id, name FROM t")
+    fetches = [s for s in conn.executed if s.startswith("FETCH")]
+    assert len(fetches) == -(-nrows // batch_size) + 1
+
+    assert dicts == db_conn.query("SELECT id, name FROM t")
+
+    tuples = list(db_conn.iter_query("SELECT id, name FROM t",
+                                     batch_size=batch_size,
+                                     row_format="namedtuple"))
+    assert [(t.id, t.name) for t in tuples] == rows
+
+    batches = list(db_conn.iter_query("SELECT id, name FROM t",
+                                      batch_size=batch_size,
+                                      row_format="columns"))
+    assert [len(b['id']) for b in batches] == \
+        [len(rows[i:i + batch_size]) for i in range(0, nrows, batch_size)]
+    if nrows != 0:
+        np.testing.assert_array_equal(
+                np.concatenate([b['id'] for b in batches]),
+                [r[0] for r in rows])
+        np.testing.assert_array_equal(
+                np.concatenate([b['name'] for b in batches]),
+                [r[1] for r in rows])
+
+    db_conn.close()
+    assert all([c.closed for c in driver.connections])
+
+
+def test_iter_query_early_close():
+    """a partially consumed iterator releases its connection"""
+    driver = StubDriver([(i, "a") for i in range(10)])
+    db_conn = qu.DbConnection(**credentials, pool_size=1,
+                              connect=driver.connect)
+    results = db_conn.iter_query("SELECT id, name FROM t", batch_size=2)
+    assert next(results) == {'id': 0, 'name': 'a'}
+    assert db_conn._pool.idle == 0
+    results.close()
+    assert db_conn._pool.idle == 1
+    assert driver.connections[0].rollbacks >= 1
+
+
+def test_iter_query_nested_query_timeout():
+    """a query inside an iter_query loop cannot wait forever on the
+    connection held by the loop"""
+    driver = StubDriver([(i, "a") for i in range(4)])
+    db_conn = qu.DbConnection(**credentials, pool_size=1, pool_timeout=0.01,
+                              connect=driver.connect)
+    assert qu.DbConnection(**credentials, pool_size=1)._pool.timeout == 60.0
+    with pytest.raises(qu.ConnectionPoolException,
+                       match="no connection available after 0.01 seconds"):
+        for row in db_conn.iter_query("SELECT id, name FROM t"):
+            db_conn.query("SELECT 1")
+    assert db_conn._pool.idle == 1
+    db_conn.close()
+
+
+def test_iter_query_array_columns():
+    driver = StubDriver([(1, [1, 2, 3]), (2, [4]), (3, None)])
+    db_conn = qu.DbConnection(**credentials, connect=driver.connect)
+    batch, = db_conn.iter_query("SELECT id, name FROM t", row_format="columns")
+    assert batch['id'].dtype == np.dtype('int')
+    assert batch['name'].dtype == np.dtype('O')
+    assert batch['name'].shape == (3,)
+    assert batch['name'][0] == [1, 2, 3]
+
+
+@pytest.mark.parametrize("batch_size, row_format", [
+    (0, "dict"), (10, "list")])
+def test_iter_query_exceptions(batch_size, row_format):
+    db_conn = qu.DbConnection(**credentials, connect=StubDriver().connect)
+    with pytest.raises(ValueError):
+        next(db_conn.iter_query("SELECT 1", batch_size=batch_size,
+                                row_format=row_format))